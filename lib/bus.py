@@ -0,0 +1,243 @@
+import asyncio
+import errno
+import json
+import os
+import socket
+from array import array
+from collections import deque
+from contextlib import suppress
+
+from loguru import logger as log
+
+from lib import metrics
+
+MAX_MESSAGE = 256 * 1024  # Bytes of one encoded message
+MAX_FDS = 4  # File descriptors passed with one message
+MAX_BACKLOG = 10000  # Messages held for a worker that is not keeping up
+
+
+class NullBus:
+    """
+    Bus of a worker running alone: there is nobody to talk to, messages are dropped.
+    Workers of one machine talk over a UnixBus, even in tests, because the room, session and
+    presence state they keep is per process.
+    """
+
+    worker = 0
+    workers = 1
+
+    def __init__(self):
+        self.on_message = None  # Callable(sender, topic, data, fds), never called
+
+    async def start(self, sock=None):
+        pass
+
+    def detach(self):
+        """
+        Nothing to hand to a successor.
+        :return: None
+        """
+        return None
+
+    def publish(self, topic: str, data: dict):
+        pass
+
+    def send(self, worker: int, topic: str, data: dict, fds=()) -> bool:
+        metrics.bus_dropped.inc(topic)
+        return False
+
+    def close(self):
+        pass
+
+
+class UnixBus:
+    """
+    Message bus between the worker processes of one machine.
+    Every worker binds a Unix datagram socket in `directory` and keeps one connected socket per peer;
+    a message is one JSON datagram and file descriptors travel with it as SCM_RIGHTS.
+    Sending never waits: messages for a busy worker are held in a bounded backlog,
+    messages for a worker that is down are dropped.
+    """
+
+    def __init__(self, worker: int, workers: int, directory: str):
+        self.worker = worker
+        self.workers = workers
+        self.directory = directory
+        self.on_message = None  # Callable(sender, topic, data, fds)
+        self.sock = None
+        self._peers = {}  # Worker -> connected socket
+        self._backlogs = {}  # Worker -> deque of (topic, message, fds) waiting for the peer
+
+    def path(self, worker: int) -> str:
+        return os.path.join(self.directory, f"worker-{worker}.sock")
+
+    async def start(self, sock=None):
+        """
+        Binds this worker's socket, replacing one left behind by a previous run.
+        :param sock: socket already bound to this worker's path, taken over from a predecessor.
+        Messages that arrived while it changed hands are still queued on it.
+        :return:
+        """
+        path = self.path(self.worker)
+        if sock is None:
+            os.makedirs(self.directory, exist_ok=True)
+            with suppress(FileNotFoundError):
+                os.unlink(path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(path)
+        self.sock = sock
+        self.sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(self.sock.fileno(), self._receive)
+        log.info(f"Worker {self.worker} of {self.workers} listening on {path}")
+
+    def publish(self, topic: str, data: dict):
+        """
+        Sends a message to every other worker.
+        :param topic:
+        :param data:
+        :return:
+        """
+        message = self._encode(topic, data)
+        for worker in range(self.workers):
+            if worker != self.worker:
+                self._send(worker, topic, message)
+
+    def send(self, worker: int, topic: str, data: dict, fds=()) -> bool:
+        """
+        Sends a message to one worker, the caller keeps ownership of the file descriptors.
+        :param worker:
+        :param topic:
+        :param data:
+        :param fds:
+        :return: False when the message was dropped.
+        """
+        return self._send(worker, topic, self._encode(topic, data), fds)
+
+    def _encode(self, topic, data) -> bytes:
+        return json.dumps({"from": self.worker, "topic": topic, "data": data}).encode()
+
+    def _peer(self, worker):
+        peer = self._peers.get(worker)
+        if peer is None:
+            peer = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            peer.setblocking(False)
+            try:
+                peer.connect(self.path(worker))
+            except OSError:
+                peer.close()
+                raise
+            self._peers[worker] = peer
+        return peer
+
+    def _reset_peer(self, worker):
+        peer = self._peers.pop(worker, None)
+        if peer is not None:
+            with suppress(ValueError):
+                asyncio.get_running_loop().remove_writer(peer.fileno())
+            peer.close()
+
+    def _send(self, worker, topic, message, fds=()) -> bool:
+        backlog = self._backlogs.get(worker)
+        if backlog:  # Keep the order, the peer drains the backlog first
+            return self._hold(worker, topic, message, fds)
+        for attempt in range(2):
+            try:
+                self._sendmsg(self._peer(worker), message, fds)
+            except BlockingIOError:
+                return self._hold(worker, topic, message, fds)
+            except OSError as e:
+                # A restarted worker has a new socket under the same path, reconnect once
+                self._reset_peer(worker)
+                if attempt == 0 and e.errno in (errno.ECONNREFUSED, errno.ENOTCONN):
+                    continue
+                metrics.bus_dropped.inc(topic)
+                log.warning(f"Dropped {topic} for worker {worker} ({e})")
+                return False
+            metrics.bus_messages.inc(topic, "out")
+            return True
+        return False
+
+    @staticmethod
+    def _sendmsg(peer, message, fds):
+        ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array("i", fds))] if fds else []
+        peer.sendmsg([message], ancillary)
+
+    def _hold(self, worker, topic, message, fds) -> bool:
+        backlog = self._backlogs.setdefault(worker, deque())
+        if len(backlog) >= MAX_BACKLOG:
+            metrics.bus_dropped.inc(topic)
+            log.warning(f"Dropped {topic} for worker {worker}, {len(backlog)} messages waiting")
+            return False
+        if not backlog:
+            asyncio.get_running_loop().add_writer(
+                self._peers[worker].fileno(), self._drain, worker
+            )
+        backlog.append((topic, message, [os.dup(fd) for fd in fds]))
+        return True
+
+    def _drain(self, worker):
+        backlog = self._backlogs[worker]
+        peer = self._peers[worker]
+        while backlog:
+            topic, message, fds = backlog[0]
+            try:
+                self._sendmsg(peer, message, fds)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                log.warning(f"Dropped {len(backlog)} messages for worker {worker} ({e})")
+                for topic, _, fds in backlog:
+                    metrics.bus_dropped.inc(topic)
+                    for fd in fds:
+                        os.close(fd)
+                backlog.clear()
+                self._reset_peer(worker)
+                return
+            backlog.popleft()
+            for fd in fds:
+                os.close(fd)
+            metrics.bus_messages.inc(topic, "out")
+        asyncio.get_running_loop().remove_writer(peer.fileno())
+
+    def _receive(self):
+        while True:
+            try:
+                message, fds, flags, _ = socket.recv_fds(self.sock, MAX_MESSAGE, MAX_FDS)
+            except BlockingIOError:
+                return
+            try:
+                if flags & (socket.MSG_TRUNC | socket.MSG_CTRUNC):
+                    raise ValueError("message truncated")
+                decoded = json.loads(message)
+                sender, topic, data = decoded["from"], decoded["topic"], decoded["data"]
+            except (ValueError, KeyError) as e:
+                log.error(f"Discarded a bus message ({e})")
+                for fd in fds:
+                    os.close(fd)
+                continue
+            self.on_message(sender, topic, data, fds)
+
+    def detach(self) -> int:
+        """
+        Stops receiving and returns a duplicate of the bound socket for a successor process.
+        Messages sent from now on wait on the socket, and close() leaves its path in place.
+        :return: file descriptor
+        """
+        asyncio.get_running_loop().remove_reader(self.sock.fileno())
+        for worker in list(self._peers):
+            self._reset_peer(worker)
+        fd = os.dup(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+        return fd
+
+    def close(self):
+        if self.sock is None:
+            return
+        asyncio.get_running_loop().remove_reader(self.sock.fileno())
+        for worker in list(self._peers):
+            self._reset_peer(worker)
+        self.sock.close()
+        self.sock = None
+        with suppress(FileNotFoundError):
+            os.unlink(self.path(self.worker))
@@ -1,24 +1,32 @@
 import os
+import socket
+import sys
 import urllib.error
 import urllib.request
-from asyncio import start_server, run, Lock
-from asyncio.exceptions import IncompleteReadError
-from charset_normalizer import from_bytes
+from asyncio import Event, get_running_loop, run
+from functools import partial
 from loguru import logger as log
-from lxml import objectify
 
 import lib.definitions as d
+from lib import discord_bridge, handover, logs, metrics
+from lib import templates as tpl
+from lib.bus import NullBus, UnixBus
+from lib.cluster import cluster
 from lib.config import get_config
 from lib.definitions import User
-from lib.events import event_handlers
-from lib.database import UserDatabase
+from lib.events import bus_handlers, event_handlers, remove_empty_rooms
+from lib.database import AsyncUserDatabase
+from lib.exceptions import MalformedFrame, RoomOnOtherWorker
+from lib.framing import FrameProtocol
+from lib.notifications import notifier
+from lib.presence import presence
+from lib.protocol import scan_envelope
+from lib.watchdog import watchdog
 
 # Load Configuration
 config = get_config()
-# Set Logging Level
-os.environ["LOGURU_LEVEL"] = (
-    "DEBUG" if config["logging"]["level"] == "debug" else "INFO"
-)
+
+POLICY_REQUEST = b"<policy-file-request/>"
 
 
 def get_latest_version() -> int:
@@ -41,73 +49,6 @@ def get_latest_version() -> int:
         return config["settings"]["version"]
 
 
-def append_new_line(file_name: str, text_to_append: str) -> None:
-    """Append given text as a new line at the end of file"""
-    # Open the file in append & read mode ('a+')
-    with open(file_name, "a+") as file_object:
-        # Move read cursor to the start of file.
-        file_object.seek(0)
-        # If file is not empty then append '\n'
-        data = file_object.read(100)
-        if len(data) > 0:
-            file_object.write("\n")
-        # Append text at the end of file
-        file_object.write(text_to_append)
-
-
-async def listen_for_messages(user: User) -> None:
-    """
-    Reads Data from user stream until null terminator is found.
-    :param user:
-    :return:
-    """
-    data = await user.reader.readuntil(b"\x00")
-    try:
-        message = data.decode("ascii")
-    except UnicodeDecodeError:
-        try:
-            message = data.decode("utf-8")
-        except UnicodeDecodeError:
-            try:
-                log.warning("Using fallback")
-                message = from_bytes(data).best()
-                log.warning(f"Decode failed on : {str(message)}")
-                # Write the failed data into file for analysis later on.
-                append_new_line("unparsed.log", data)
-            except Exception:
-                return ""
-
-    log.debug(f"Received :{str(message)}")
-    if len(message) == 0:
-        log.info(f"{user.name}, {user.address} has disconnected")
-        return
-    return message
-
-
-def get_commands(xml: objectify.ObjectifiedElement):
-    """
-    Returns an action and the room from the xml string.
-    :param xml:
-    :return:
-    """
-    return xml.body.attrib["action"]
-
-
-def parse_xml(message: str):
-    """
-    Convert xml to a dictionary like object from string.
-    :param message:
-    :return:
-    """
-    try:
-        xml = objectify.fromstring(message)
-        return xml
-    except Exception as e:
-        log.error(
-            f"Parse Error Occurred! ({e}) (message)",
-        )
-
-
 async def call_handlers(self, command, xml, user):
     """
     Calls the correct handler function given a command from xml.
@@ -117,10 +58,22 @@ async def call_handlers(self, command, xml, user):
     :param user:
     :return:
     """
+    action = str(command) if str(command) in event_handlers else "unknown"
+    metrics.handler_calls.inc(action)
     try:
-        await event_handlers[str(command)](self, xml, user)
+        with metrics.handler_seconds.time(action), watchdog.handler(action, xml.room):
+            await event_handlers[str(command)](self, xml, user)
     except KeyError as e:
+        metrics.handler_errors.inc(action)
         log.error(f"Command Failed to Execute! ({command}) ({e})")
+    except RoomOnOtherWorker:
+        raise  # Not a failure, the connection moves to the worker owning the room
+    except MalformedFrame:
+        # Only the action could be read, the frame is dropped like any other unparsable one
+        log.error(f"Dropped a malformed {command} frame ({xml.raw})")
+    except Exception:
+        metrics.handler_errors.inc(action)
+        raise
 
 
 async def ensure_disconnect(self, user):
@@ -131,137 +84,389 @@ async def ensure_disconnect(self, user):
     :return:
     """
     try:
-        for room_id in d.rms:
-            room = d.rms[room_id]
-            if user.id in room.users:
-                async with self.lock:
-                    await room.remove_user(user.id)
-                for usr in room.users:
-                    await room.users[usr].send(
-                        f"<msg t='sys'><body action='userGone' r='{user.room}'><user id='{user.id}' /></body></msg>"
-                    )
-                    await room.users[usr].send(
-                        f"<msg t='sys'><body action='uCount' r='{user.room}' u='{len(room.users)}'></body></msg>"
-                    )
+        room = d.rms.get(user.room)
+        if room is not None and user.id in room.users:
+            async with room.lock:
+                await room.remove_user(user.id)
+            await room.broadcast(tpl.user_gone(user.room, user.id))
+            notifier.user_count(room)
         # Buddy Exit Event
         if "guest_" not in user.name:
-            buddies = self.database.get_buddies(user.name)
-            for buddy_name in buddies:
-                usr_found = await d.find_user(name=buddy_name)
-                if usr_found is not None:
-                    msg_bu = f"<msg t='sys'><body action='bUpd' r='-1'><b s='0' i='-1'><n><![CDATA[{user.name}]]></n></b></body></msg>"
-                    await usr_found.send(msg_bu)
+            presence.offline(user)
     except Exception as e:
         log.error(f"Error in ensure_disconnect! ({e})")
     finally:
-        if user.id in d.current_guests_ids:
-            async with self.lock:
-                d.current_guests_ids.remove(user.id)
+        presence.unsubscribe(user)
+        d.sessions.remove(user)
+        user.stop_writer()
+        self.release_id(user.id)
         log.info(f"Connection lost to {user.address}")
 
 
 class Server:
-    def __init__(self):
+    def __init__(self, bus=None):
+        """
+        :param bus: connects this worker to the others, a NullBus when running alone.
+        """
         self.user_count = 0
-        self.lock = Lock()
+        self.lock = metrics.TimedLock("server")  # Room table only, rooms have their own locks
         self.version = get_latest_version()
-        self.database = UserDatabase(db_name=config["database"]["path"])
+        self.database = AsyncUserDatabase(
+            db_name=config["database"]["path"],
+            slow_query=float(config["database"]["slow_query_ms"]) / 1000,
+            batch_size=int(config["database"]["batch_size"]),
+            flush_interval=float(config["database"]["flush_interval_ms"]) / 1000,
+            cache_size=int(config["database"]["cache_size"]),
+        )
+        self.ids = None
+        self.metrics_server = None
+        self.bus = bus if bus is not None else NullBus()
+        self.control = None  # Pipe to the supervisor, set when a successor process can take over
+        self.listener = None
+        self.stopping = False  # Handing over, connections stop processing frames
+        self.stopped = None  # Future resolved with the exit code
+        self.restored = Event()  # Connections taken over from a predecessor are all back
+        self.unprocessed = {}  # User -> frames set aside while handing over
 
-    async def get_new_id(self):
+    async def start(self, resume=None):
         """
-        Get a new id for the user.
+        Joins the other workers and loads the state the server needs from the database before accepting connections.
+        :param resume: (state, fds) received from the process this one replaces.
         :return:
         """
-        counter = 0
-        counters = self.database.get_all_ids()
-        while True:
-            counter += 1
-            if counter not in counters:
-                break
-        async with self.lock:
-            while True:
-                counter += 1
-                if counter not in d.current_guests_ids:
-                    break
-        return counter
+        self.stopped = get_running_loop().create_future()
+        cluster.attach(self.bus)
+        if resume is None:
+            await self.bus.start()
+        else:
+            state, fds = resume
+            bus = state["bus"]
+            await self.bus.start(None if bus is None else socket.socket(fileno=fds[bus]))
+        self.ids = d.IdAllocator(
+            await self.database.get_all_ids(), cluster.worker, cluster.workers
+        )
+        if resume is not None:
+            for id_ in resume[0]["ids"]:
+                self.ids.claim(id_)
+        if cluster.workers > 1:
+            # A pending batch holds the write lock of the shared database file, stalling the other workers
+            self.database.batch_size = 1
+        self.subscribe()
+        self.register_metrics()
+        if config["watchdog"]["enabled"] == "true":
+            watchdog.start(
+                float(config["watchdog"]["threshold_ms"]) / 1000,
+                float(config["watchdog"]["interval_ms"]) / 1000,
+            )
+        await self.serve_metrics()
+        if resume is None:
+            # The other workers drop what they knew about a previous run of this one and send their state
+            cluster.publish("hello", {})
+            self.restored.set()
+
+    async def serve_metrics(self):
+        if config["metrics"]["enabled"] == "true":
+            port = int(config["metrics"]["port"])
+            port = port + cluster.worker if port else 0
+            try:
+                self.metrics_server = await metrics.serve(config["metrics"]["address"], port)
+            except OSError as e:
+                # Metrics are optional, a taken port must not keep the game server down
+                log.warning(f"Could not serve metrics on port {port}: {e}")
+
+    def subscribe(self):
+        """
+        Handles the messages other workers send to the server.
+        :return:
+        """
+        cluster.subscribe("hand_off", self.adopt)
+        cluster.subscribe("release_id", lambda sender, data, fds: self.ids.release(data["id"]))
+        cluster.subscribe("register_id", lambda sender, data, fds: self.ids.register(data["id"]))
+        cluster.subscribe("claim_ids", self._on_claim_ids)
+        cluster.subscribe("hello", self._on_hello)
+        for topic, handler in bus_handlers.items():
+            cluster.subscribe(topic, partial(handler, self))
 
-    async def handle(self, reader, writer):
+    def release_id(self, id_: int):
         """
-        Handles in coming packets from the user.
-        :param reader:
-        :param writer:
+        Returns a connection id to the worker that allocated it.
+        :param id_:
         :return:
         """
-        new_id = await self.get_new_id()
-        user = User(reader, writer, new_id)
+        owner = self.ids.owner(id_)
+        if owner == cluster.worker:
+            self.ids.release(id_)
+        else:
+            cluster.send(owner, "release_id", {"id": id_})
+
+    def register_id(self, id_: int):
+        """
+        Marks an id as a registered user's here and on the worker that allocated it.
+        :param id_:
+        :return:
+        """
+        self.ids.register(id_)
+        owner = self.ids.owner(id_)
+        if owner != cluster.worker:
+            cluster.send(owner, "register_id", {"id": id_})
+
+    def _on_hello(self, sender, data, fds):
+        # Connections handed over from a worker that restarted still use ids it allocated
+        ids = [usr.id for usr in d.sessions if self.ids.owner(usr.id) == sender]
+        if ids:
+            cluster.send(sender, "claim_ids", {"ids": ids})
+
+    def _on_claim_ids(self, sender, data, fds):
+        for id_ in data["ids"]:
+            self.ids.claim(id_)
+
+    def register_metrics(self):
+        """
+        Exposes the state of this server that is read at scrape time.
+        :return:
+        """
+        registry = metrics.registry
+        registry.collected("users", "Connected users.", lambda: len(d.sessions))
+        registry.collected("rooms", "Open rooms.", lambda: len(d.rms))
+        registry.collected(
+            "outbound_queued_frames",
+            "Frames waiting in outbound queues.",
+            lambda: sum(usr.outbound.qsize() for usr in d.sessions),
+        )
+        registry.collected(
+            "db_cache_requests_total",
+            "Database cache lookups by cache and result.",
+            lambda: {
+                (cache, result): stats[result]
+                for cache, stats in self.database.cache_stats().items()
+                for result in ("hits", "misses")
+            },
+            "counter",
+            ("cache", "result"),
+        )
+
+    async def handle(self, connection: FrameProtocol, handoff=None):
+        """
+        Handles in coming frames from the user.
+        :param connection:
+        :param handoff: the user and its unprocessed frames, for a connection taken over from another worker
+        or from the process this one replaces.
+        :return:
+        """
+        pending = None
+        if handoff is None:
+            user = User(connection, self.ids.allocate())
+        else:
+            user = User(connection, handoff["user"]["id"])
+            user.restore(handoff["user"])
+            pending = [frame.encode("latin-1") for frame in handoff["frames"]]
+        d.sessions.add(user)
+        user.start_writer()
         log.info(f"User {user.address} connected!")
+        handed_off = False
         try:
-            while True:
-                try:
-                    message = await listen_for_messages(user)
-                except IncompleteReadError:
-                    break
-                if message is None:
+            if handoff is not None:
+                await self.take_over(user, handoff.get("resume", False))
+            while not handed_off:
+                frames = pending or await connection.read_frames()
+                pending = None
+                if frames is None:
+                    if not self.stopping:
+                        log.info(f"{user.name}, {user.address} has disconnected")
                     break
-                messages = message.split("\00")
-
-                try:
-                    messages.remove("")
-                except ValueError:
-                    pass
-
                 try:
-                    await self._process_messages(messages, user)
+                    handed_off = await self._process_messages(frames, user)
                 except ConnectionResetError:
                     break
         finally:
-            # Ensure Disconnection
-            await ensure_disconnect(self, user)
+            # Ensure Disconnection, unless the user now belongs to another worker or process
+            if not (handed_off or self.stopping):
+                await ensure_disconnect(self, user)
+
+    async def hand_off(self, user, worker, frames) -> bool:
+        """
+        Passes the user's connection to the worker owning the room it is joining.
+        Reading stops, whatever was queued for the user is written, and the user leaves its room here
+        without anyone being told it disconnected. The socket then travels over the bus together
+        with the user's state and the frames that were not processed yet, starting with the join.
+        :param user:
+        :param worker:
+        :param frames:
+        :return: True when the other worker took the connection.
+        """
+        connection = user.connection
+        pending, partial_frame = connection.detach()
+        if not await user.drain_outbound():
+            log.warning(f"Handing off {user.name}({user.id}) with frames still queued")
+        room = d.rms.get(user.room)
+        if room is not None and user.id in room.users:
+            async with room.lock:
+                await room.remove_user(user.id)
+            notifier.user_count(room)
+            await remove_empty_rooms(self)
+        presence.unsubscribe(user)
+        d.sessions.remove(user)
+        user.stop_writer()
+        state = {
+            "user": user.state(),
+            "frames": [frame.decode("latin-1") for frame in frames + pending],
+            "partial": partial_frame.decode("latin-1"),
+        }
+        sock = connection.get_extra_info("socket")
+        handed_off = cluster.send(worker, "hand_off", state, fds=[sock.fileno()])
+        # Closes this process's descriptor only, the connection stays open in the other worker
+        connection.transport.abort()
+        if not handed_off:
+            log.error(f"Could not hand {user.name}({user.id}) to worker {worker}")
+            return False
+        metrics.handoffs.inc()
+        logs.rooms.log.info("User ({}, {}) handed to worker {}", user.id, user.name, worker)
+        return True
+
+    async def adopt(self, sender, data, fds):
+        """
+        Takes over a connection handed off by another worker.
+        :param sender:
+        :param data:
+        :param fds:
+        :return:
+        """
+        for fd in fds[1:]:
+            os.close(fd)
+        sock = socket.socket(fileno=fds[0])
+        received = data["partial"].encode("latin-1")
+        await get_running_loop().connect_accepted_socket(
+            lambda: FrameProtocol(partial(self.handle, handoff=data), received), sock
+        )
 
-    async def _process_messages(self, messages, user):
+    async def take_over(self, user, resume=False):
         """
-        Send the connection string and processes the messages.
-        :param messages:
+        Puts a user handed off by another worker in this worker's lobby, from where its join frame moves it.
+        A user resumed from the process this one replaces goes back to its room, and waits for the
+        other users to be back before its frames are processed.
         :param user:
+        :param resume:
         :return:
         """
-        for msg in messages:
-            if msg == "<policy-file-request/>":
-                await user.send(
-                    f"<cross-domain-policy><allow-access-from domain='*'"
-                    f" to-ports='{config['connection']['port']}' /></cross-domain-policy>"
-                )
+        if resume:
+            room = d.rms.get(user.room)
+            if room is not None:
+                async with room.lock:
+                    await room.add_user(user)
+            if user.name and "guest_" not in user.name:
+                presence.subscribe(user, await self.database.get_buddies(user.name))
+            await self.restored.wait()
+            return
+        if user.room != -1:
+            lobby = d.rms[1]
+            async with lobby.lock:
+                await lobby.add_user(user)
+        if user.name and "guest_" not in user.name:
+            presence.subscribe(user, await self.database.get_buddies(user.name))
+            presence.online(user)  # The other workers learn it is now connected here
+        logs.rooms.log.info("User ({}, {}) taken over from another worker", user.id, user.name)
+
+    async def _process_messages(self, frames, user):
+        """
+        Send the connection string and processes the frames.
+        :param frames:
+        :param user:
+        :return: True when the connection was handed to another worker or is being handed over.
+        """
+        metrics.inbound_frames.inc(amount=len(frames))
+        metrics.inbound_bytes.inc(amount=sum(map(len, frames)))
+        for index, frame in enumerate(frames):
+            if self.stopping:
+                # Handing over, the successor processes the rest
+                self.unprocessed[user] = frames[index:]
+                return True
+            if logs.protocol.should_trace():
+                logs.protocol.log.debug(f"Received :{frame}")
+            if frame == POLICY_REQUEST:
+                await user.send(tpl.policy(config["connection"]["port"]))
                 continue
-            xml = parse_xml(msg)
-            if xml is None:
+            envelope = scan_envelope(frame)
+            if envelope is None:
                 continue
-            command = get_commands(xml)
 
-            await call_handlers(self, command, xml, user)
+            try:
+                await call_handlers(self, envelope.action, envelope, user)
+            except RoomOnOtherWorker as e:
+                return await self.hand_off(user, e.worker, frames[index:])
+        return False
 
 
-async def main():
+async def main(worker=0, workers=1, control=None, resume=False):
     """
     Main Loop of the Program initializes Server object, pass in config parameters and starts listening for users
-    :return:
+    With several workers every one runs main, sharing the listening port through SO_REUSEPORT.
+    :param worker: index of this worker.
+    :param workers: number of workers.
+    :param control: supervisor pipe used to report readiness and ask for a successor on /restart and /update.
+    :param resume: take over the listening socket, connections and rooms of the process this one replaces.
+    :return: exit code.
     """
-    server_obj = Server()
-    server = await start_server(
-        server_obj.handle, config["connection"]["address"], config["connection"]["port"]
-    )
+    if workers > 1:
+        bus = UnixBus(worker, workers, config["workers"]["socket_dir"])
+    else:
+        bus = NullBus()
+    server_obj = Server(bus)
+    server_obj.control = control
+    state = None
+    if resume:
+        state, fds = handover.receive(worker, float(config["restart"]["timeout_s"]))
+        await server_obj.start((state, fds))
+    else:
+        await server_obj.start()
+    loop = get_running_loop()
+    if state is None:
+        server = await loop.create_server(
+            lambda: FrameProtocol(server_obj.handle),
+            config["connection"]["address"],
+            config["connection"]["port"],
+            reuse_port=workers > 1,
+        )
+    else:
+        server = await loop.create_server(
+            lambda: FrameProtocol(server_obj.handle),
+            sock=socket.socket(fileno=fds[state["listener"]]),
+        )
+        await handover.restore(server_obj, state, fds)
+    server_obj.listener = server
     address = server.sockets[0].getsockname()
-    log.info(f"Serving on Ip: {address[0]} Port: {address[1]}")
-    async with server:
-        await server.serve_forever()
+    log.info(f"Worker {worker} Serving on Ip: {address[0]} Port: {address[1]}")
+    if control is not None:
+        control.send({"type": "ready", "worker": worker})
+    try:
+        async with server:
+            return await server_obj.stopped
+    finally:
+        bus.close()
+        # Make batched writes durable before the process exits
+        server_obj.database.close()
 
 
-def start():
+def start(worker=0, workers=1, control=None, resume=False, joins=None):
     """
     Starts the main function and the program.
+    :param worker:
+    :param workers:
+    :param control: pipe to the supervisor.
+    :param resume: take over from the process this one replaces.
+    :param joins: game server end of the discord bridge's channel.
     :return:
     """
-    run(main())
+    logs.setup(config)
+    if joins is not None:
+        discord_bridge.joins.attach(joins)
+    sys.exit(run(main(worker, workers, control, resume)))
 
 
-def launch_discord():
-    d.dc.run(os.getenv("DISCORD_API"))
+def launch_discord(joins):
+    """
+    Runs the discord bot.
+    :param joins: bot end of the discord bridge's channel.
+    :return:
+    """
+    logs.setup(config)
+    discord_bridge.run(joins, os.getenv("DISCORD_API"))
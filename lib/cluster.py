@@ -0,0 +1,116 @@
+import asyncio
+import os
+
+from loguru import logger as log
+
+from lib import metrics
+
+SHARED_ROOMS = (1, 42)  # Lobby and team channel, every worker has its own copy
+
+# Handlers running as tasks, referenced until they are done
+background_tasks = set()
+
+
+class Cluster:
+    """
+    This worker's place among the workers sharing the listening port.
+    Game rooms belong to the worker their id maps to, the shared rooms exist on every worker.
+    Modules subscribe handlers to bus topics at import time; they only receive messages once
+    a bus is attached, and with a single worker nothing is ever published.
+    """
+
+    def __init__(self):
+        self.worker = 0
+        self.workers = 1
+        self.bus = None
+        self.handlers = {}  # Topic -> handlers called with (sender, data, fds)
+
+    def attach(self, bus):
+        """
+        Routes the bus's messages to the subscribed handlers.
+        :param bus: a NullBus or UnixBus.
+        :return:
+        """
+        self.bus = bus
+        self.worker = bus.worker
+        self.workers = bus.workers
+        bus.on_message = self.dispatch
+
+    @property
+    def enabled(self) -> bool:
+        return self.bus is not None and self.workers > 1
+
+    def owner(self, room_id: int):
+        """
+        Worker that owns a room, None for the shared rooms.
+        :param room_id:
+        :return:
+        """
+        if room_id in SHARED_ROOMS:
+            return None
+        return room_id % self.workers
+
+    def is_remote(self, room_id: int) -> bool:
+        owner = self.owner(room_id)
+        return owner is not None and owner != self.worker
+
+    def next_room_id(self, last: int, taken) -> int:
+        """
+        Next free room id after `last` that this worker owns.
+        :param last:
+        :param taken: ids in use.
+        :return:
+        """
+        room_id = last + 1
+        while room_id in taken or self.owner(room_id) != self.worker:
+            room_id += 1
+        return room_id
+
+    def subscribe(self, topic: str, handler):
+        self.handlers.setdefault(topic, []).append(handler)
+
+    def publish(self, topic: str, data: dict):
+        if self.enabled:
+            self.bus.publish(topic, data)
+
+    def send(self, worker: int, topic: str, data: dict, fds=()) -> bool:
+        if self.bus is None:
+            return False
+        return self.bus.send(worker, topic, data, fds)
+
+    def dispatch(self, sender, topic, data, fds):
+        """
+        Calls the handlers of a message, coroutines run as tasks.
+        :param sender:
+        :param topic:
+        :param data:
+        :param fds: file descriptors now owned by the handler.
+        :return:
+        """
+        metrics.bus_messages.inc(topic, "in")
+        handlers = self.handlers.get(topic)
+        if not handlers:
+            log.warning(f"No handler for {topic} from worker {sender}")
+            for fd in fds:
+                os.close(fd)
+            return
+        for handler in handlers:
+            try:
+                result = handler(sender, data, fds)
+            except Exception as e:
+                log.error(f"Bus handler for {topic} failed ({e})")
+                continue
+            if asyncio.iscoroutine(result):
+                task = asyncio.create_task(_run(topic, result))
+                background_tasks.add(task)
+                task.add_done_callback(background_tasks.discard)
+
+
+async def _run(topic, coroutine):
+    try:
+        await coroutine
+    except Exception as e:
+        log.error(f"Bus handler for {topic} failed ({e})")
+
+
+cluster = Cluster()
@@ -1,46 +1,36 @@
 import sqlite3
-from loguru import logger as log
+from collections import OrderedDict
+from asyncio import create_task, get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from lib import logs, metrics
+from lib.cluster import cluster
+from lib.migrations import migrate
+
+UNKNOWN_CACHE_SIZE = 256  # Names without a users row, kept apart so they can't push rows out
+
 
 class UserDatabase:
     def __init__(self, db_name):
-        log.info(f"Connecting to {db_name}")
+        logs.db.log.info(f"Connecting to {db_name}")
         self.conn = sqlite3.connect(database=str(db_name))
-        self.create_table()
+        # WAL lets commits append to the log instead of rewriting pages, NORMAL only fsyncs on checkpoints
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.write_behind = False  # When set, writes stay in the open transaction until commit()
+        migrate(self.conn)
 
-    def create_table(self):
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE,
-                password TEXT,
-                games_played INTEGER DEFAULT 0,
-                games_won INTEGER DEFAULT 0,
-                consecutive_wins INTEGER DEFAULT 0,
-                rank INTEGER DEFAULT 0
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS buddies (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                buddy_id INTEGER,
-                FOREIGN KEY (user_id) REFERENCES users(id),
-                FOREIGN KEY (buddy_id) REFERENCES users(id)
-            )
-        """)
-        self.conn.commit()
-
-    def add_user(self, username, password=None):
+    def add_user(self, username, password=None, user_id=None):
         cursor = self.conn.cursor()
         try:
             cursor.execute(
                 """
-                INSERT INTO users (username, password) VALUES (?, ?)
+                INSERT INTO users (id, username, password) VALUES (?, ?, ?)
             """,
-                (username, password),
+                (user_id, username, password),
             )
-            self.conn.commit()
+            self.save()
             return True
         except sqlite3.IntegrityError:
             return False  # User already exists
@@ -49,17 +39,18 @@ class UserDatabase:
         cursor = self.conn.cursor()
         cursor.execute(
             """
-            DELETE FROM users WHERE username = ?
+            DELETE FROM buddies WHERE user_id = (SELECT id FROM users WHERE username = ?)
+                OR buddy_id = (SELECT id FROM users WHERE username = ?)
         """,
-            (username,),
+            (username, username),
         )
         cursor.execute(
             """
-            DELETE FROM buddies WHERE username = ? OR buddy = ?
+            DELETE FROM users WHERE username = ?
         """,
-            (username, username),
+            (username,),
         )
-        self.conn.commit()
+        self.save()
         return cursor.rowcount > 0
 
     def update_stats(self, username, games_played, games_won, consecutive_wins, rank):
@@ -75,7 +66,7 @@ class UserDatabase:
         """,
             (games_played, games_won, consecutive_wins, rank, username),
         )
-        self.conn.commit()
+        self.save()
 
     def get_user_info(self, username):
         cursor = self.conn.cursor()
@@ -91,14 +82,14 @@ class UserDatabase:
         cursor = self.conn.cursor()
         cursor.execute(
             """
-            INSERT INTO buddies (user_id, buddy_id)
+            INSERT OR IGNORE INTO buddies (user_id, buddy_id)
             SELECT u1.id, u2.id
             FROM users u1, users u2
             WHERE u1.username = ? AND u2.username = ?
         """,
             (username, buddy),
         )
-        self.conn.commit()
+        self.save()
 
     def get_buddies(self, username):
         cursor = self.conn.cursor()
@@ -151,6 +142,279 @@ class UserDatabase:
         )
         return bool(cursor.fetchone()[0])
 
+    def save(self):
+        if not self.write_behind:
+            self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+class LRUCache:
+    """
+    Bounded mapping that evicts the least recently used entry, with hit/miss counters.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Returns (True, value) on a hit and (False, None) on a miss.
+        :param key:
+        :return:
+        """
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True, value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+class AsyncUserDatabase:
+    """
+    Runs UserDatabase queries on a dedicated thread so disk I/O never blocks the event loop.
+    The connection is created and used only by that thread.
+    Per query, the time spent waiting for the thread and running the query is recorded in `stats`.
+
+    Writes are applied right away but committed in batches: the transaction is committed once
+    `batch_size` writes are pending or `flush_interval` seconds after the first one.
+    Reads share the connection, so they always see pending writes.
+
+    User rows and buddy lists are served from LRU caches, which writes invalidate once they have run,
+    here and on the other workers sharing the database file.
+    """
+
+    def __init__(
+        self,
+        db_name,
+        slow_query=0.05,
+        batch_size=100,
+        flush_interval=0.5,
+        cache_size=10000,
+    ):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+        self.db = self._executor.submit(UserDatabase, db_name).result()
+        self.db.write_behind = True
+        self.slow_query = slow_query  # Seconds, queries above this are logged
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = {}  # Query name -> {"calls", "wait", "run", "max"}
+        self.flush_stats = {
+            "flushes": 0,
+            "writes": 0,
+            "max_batch": 0,
+            "latency": 0.0,
+            "max_latency": 0.0,
+        }
+        self._pending = 0  # Uncommitted writes
+        self._flush_timer = None
+        self._flush_task = None
+        self.profiles = LRUCache(cache_size)  # Username -> users row
+        self.unknown = LRUCache(min(cache_size, UNKNOWN_CACHE_SIZE))  # Usernames without a row
+        self.buddies = LRUCache(cache_size)  # Username -> buddy names
+        self.caches = {"profiles": self.profiles, "buddies": self.buddies}
+        cluster.subscribe("cache", self._on_invalidate)
+
+    async def _call(self, name, *args):
+        """
+        Runs a UserDatabase method on the database thread.
+        :param name:
+        :param args:
+        :return:
+        """
+        method = getattr(self.db, name)
+        submitted = perf_counter()
+
+        def run():
+            started = perf_counter()
+            return method(*args), started, perf_counter()
+
+        result, started, finished = await get_running_loop().run_in_executor(
+            self._executor, run
+        )
+        self._record(name, started - submitted, finished - started)
+        return result
+
+    def _record(self, name, wait, run):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = {"calls": 0, "wait": 0.0, "run": 0.0, "max": 0.0}
+        stats["calls"] += 1
+        stats["wait"] += wait
+        stats["run"] += run
+        stats["max"] = max(stats["max"], run)
+        metrics.db_queue_seconds.observe(wait, name)
+        metrics.db_query_seconds.observe(run, name)
+        if run > self.slow_query:
+            logs.db.log.warning(
+                f"Slow query {name} took {run * 1000:.1f}ms ({wait * 1000:.1f}ms queued)"
+            )
+
+    async def _write(self, name, *args):
+        """
+        Runs a write without committing it and schedules the batch commit.
+        :param name:
+        :param args:
+        :return:
+        """
+        result = await self._call(name, *args)
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            await self.flush()
+        elif self._flush_timer is None:
+            self._flush_timer = get_running_loop().call_later(
+                self.flush_interval, self._start_flush
+            )
+        return result
+
+    def _start_flush(self):
+        self._flush_timer = None
+        self._flush_task = create_task(self.flush())
+
+    async def flush(self):
+        """
+        Commits every pending write in one transaction.
+        :return:
+        """
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        batch, self._pending = self._pending, 0
+        if batch == 0:
+            return
+        started = perf_counter()
+        await self._call("commit")
+        latency = perf_counter() - started
+        stats = self.flush_stats
+        stats["flushes"] += 1
+        stats["writes"] += batch
+        stats["max_batch"] = max(stats["max_batch"], batch)
+        stats["latency"] += latency
+        stats["max_latency"] = max(stats["max_latency"], latency)
+        metrics.db_commit_seconds.observe(latency)
+        metrics.db_commit_writes.observe(batch)
+        if logs.db.debug_enabled:
+            logs.db.log.debug(f"Committed {batch} writes in {latency * 1000:.1f}ms")
+
+    async def add_user(self, username, password=None, user_id=None):
+        result = await self._write("add_user", username, password, user_id)
+        self._invalidate("profiles", username)
+        return result
+
+    async def delete_user(self, username):
+        result = await self._write("delete_user", username)
+        self._invalidate("profiles", username)
+        self._invalidate("buddies")  # Any list may have contained the user
+        return result
+
+    async def update_stats(self, username, games_played, games_won, consecutive_wins, rank):
+        result = await self._write(
+            "update_stats", username, games_played, games_won, consecutive_wins, rank
+        )
+        self._invalidate("profiles", username)
+        return result
+
+    async def get_user_info(self, username):
+        hit, row = self.profiles.get(username)
+        if hit:
+            return row
+        if self.unknown.get(username)[0]:
+            return None
+        row = await self._call("get_user_info", username)
+        if row is not None:
+            self.profiles.put(username, row)
+        elif "guest_" not in username:  # Every guest has a new name, remembering them is useless
+            self.unknown.put(username, None)
+        return row
+
+    async def add_buddy(self, username, buddy):
+        result = await self._write("add_buddy", username, buddy)
+        self._invalidate("buddies", username)
+        return result
+
+    async def get_buddies(self, username):
+        hit, buddies = self.buddies.get(username)
+        if not hit:
+            buddies = await self._call("get_buddies", username)
+            self.buddies.put(username, buddies)
+        return buddies
+
+    def _invalidate(self, cache, key=None):
+        """
+        Drops a cached entry, or the whole cache when no key is given, on every worker.
+        :param cache:
+        :param key:
+        :return:
+        """
+        self._on_invalidate(None, {"cache": cache, "key": key}, ())
+        cluster.publish("cache", {"cache": cache, "key": key})
+
+    def _on_invalidate(self, sender, data, fds):
+        caches = [self.caches[data["cache"]]]
+        if data["cache"] == "profiles":
+            caches.append(self.unknown)  # A write can create the row of an unknown name
+        for cache in caches:
+            if data["key"] is None:
+                cache.clear()
+            else:
+                cache.invalidate(data["key"])
+
+    def cache_stats(self) -> dict:
+        return {
+            "profiles": self.profiles.stats(),
+            "unknown": self.unknown.stats(),
+            "buddies": self.buddies.stats(),
+        }
+
+    async def authenticate(self, username, password):
+        return await self._call("authenticate", username, password)
+
+    async def get_counter(self):
+        return await self._call("get_counter")
+
+    async def get_all_ids(self):
+        return await self._call("get_all_ids")
+
+    async def buddy_check(self, user1, user2):
+        return await self._call("buddy_check", user1, user2)
+
+    def close(self):
+        """
+        Commits pending writes and closes the connection on its thread, once every queued query has run.
+        :return:
+        """
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        self._executor.submit(self.db.close).result()
+        self._executor.shutdown(wait=True)
+
 
 if __name__ == "__main__":
     # Example usage:
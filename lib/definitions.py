@@ -1,32 +1,42 @@
 import asyncio
-from multiprocessing import Queue
-from queue import Empty
-
-import discord
+import heapq
+from contextlib import AsyncExitStack, asynccontextmanager
 from loguru import logger as log
 
-from lib.exceptions import UserNotFoundInRoom
-
-dc = discord.Client(intents=discord.Intents.default())
+from lib import logs, metrics
+from lib import templates as tpl
+from lib.cluster import SHARED_ROOMS, cluster
+from lib.config import get_config
+from lib.exceptions import RoomNotFound, UserNotFoundInRoom
 
-message_channel = Queue()
+# Load Configuration
+config = get_config()
+QUEUE_SIZE = int(config["outbound"]["queue_size"])
+OVERFLOW_POLICY = config["outbound"]["overflow"]
 
-
-@dc.event
-async def on_ready():
-    log.info(f"{dc.user} has connected to Discord!")
-    channel = dc.get_channel(934229000392433675)
-    while True:
-        try:
-            # If `False`, the program is not blocked, it will throw the Queue.Empty exception.
-            user = message_channel.get(False)
-            await channel.send(f"{user} has joined the lobby!")
-        except Empty:
-            await asyncio.sleep(1)
+# User attributes that travel with a connection handed to another worker
+HANDOFF_FIELDS = (
+    "id",
+    "room",
+    "mod",
+    "name",
+    "password",
+    "race",
+    "rank",
+    "games_played",
+    "games_won",
+    "games_consecutive_wins",
+    "team",
+    "color",
+    "pts",
+    "client_version",
+)
+# User attributes the other workers show for a member of a shared room
+MEMBER_FIELDS = ("id", "mod", "name", "rank", "games_played")
 
 
 class User:
-    def __init__(self, reader, writer, id_):
+    def __init__(self, connection, id_):
         self.room = -1
         self.id = id_
         self.mod = 0
@@ -40,9 +50,13 @@ class User:
         self.team = 0
         self.color = 0
         self.pts = 0
-        self.reader = reader
-        self.writer = writer
-        self.address = writer.get_extra_info("peername")
+        self.connection = connection
+        self.address = connection.get_extra_info("peername")
+        self.outbound = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.bytes_queued = 0
+        self.frames_dropped = 0
+        self.evicted = False
+        self._writer_task = None
 
     @staticmethod
     def clean(a):
@@ -59,14 +73,135 @@ class User:
 
     async def send(self, data):
         """
-        Send Data to the target
+        Queue Data to be sent to the target
         :param data:
         :return:
         """
-        data = self.clean(data)
-        self.writer.write(data)
-        log.debug(f"Sent: {data}")
-        await self.writer.drain()
+        await self.send_bytes(self.clean(data))
+
+    async def send_bytes(self, payload: bytes):
+        """
+        Queue an already encoded payload, waiting for room only under the 'block' overflow policy.
+        :param payload:
+        :return:
+        """
+        if not self.enqueue(payload):
+            await self.outbound.put(payload)
+            self.bytes_queued += len(payload)
+
+    def enqueue(self, payload: bytes) -> bool:
+        """
+        Queues an encoded payload without waiting and applies the overflow policy when the queue is full.
+        Returns False when the payload was not queued and the caller has to wait for room ('block' policy).
+        :param payload:
+        :return:
+        """
+        if self.evicted:
+            return True
+        try:
+            self.outbound.put_nowait(payload)
+        except asyncio.QueueFull:
+            if OVERFLOW_POLICY == "block":
+                return False
+            if OVERFLOW_POLICY == "drop":
+                self.frames_dropped += 1
+                metrics.outbound_dropped.inc()
+            else:
+                self.evict()
+            return True
+        self.bytes_queued += len(payload)
+        return True
+
+    def evict(self):
+        """
+        Drops a slow consumer, discarding whatever is still waiting in its queue.
+        :return:
+        """
+        if self.evicted:
+            return
+        self.evicted = True
+        metrics.evictions.inc()
+        log.warning(
+            f"Evicting slow client {self.name}({self.id}) {self.address}: "
+            f"{self.outbound.qsize()} frames / {self.bytes_queued} bytes queued"
+        )
+        self.connection.transport.abort()
+
+    def start_writer(self):
+        """
+        Starts the task that drains the outbound queue into the socket.
+        :return:
+        """
+        self._writer_task = asyncio.create_task(self._write_loop())
+
+    def stop_writer(self):
+        """
+        Stops the outbound writer task.
+        :return:
+        """
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            self._writer_task = None
+
+    async def _write_loop(self):
+        """
+        Writes queued frames, coalescing everything that is waiting into a single write call.
+        :return:
+        """
+        try:
+            while True:
+                batch = [await self.outbound.get()]
+                while not self.outbound.empty():
+                    batch.append(self.outbound.get_nowait())
+                data = b"".join(batch)
+                self.bytes_queued -= len(data)
+                self.connection.write(data)
+                metrics.outbound_writes.inc()
+                metrics.outbound_frames.inc(amount=len(batch))
+                metrics.outbound_bytes.inc(amount=len(data))
+                if logs.protocol.should_trace():
+                    logs.protocol.log.debug(f"Sent: {data}")
+                await self.connection.drain()
+        except (ConnectionError, RuntimeError) as e:
+            logs.protocol.log.debug("Writer stopped for {} ({})", self.address, e)
+
+    async def drain_outbound(self, timeout=5.0) -> bool:
+        """
+        Waits until everything queued for the user has been written to the socket.
+        :param timeout:
+        :return: False when the queue did not drain in time.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        transport = self.connection.transport
+        while not self.outbound.empty() or transport.get_write_buffer_size():
+            if transport.is_closing() or loop.time() > deadline:
+                return False
+            await asyncio.sleep(0.005)
+        return True
+
+    def state(self) -> dict:
+        """
+        The attributes another worker needs to take over this user's connection.
+        :return:
+        """
+        return {field: getattr(self, field) for field in HANDOFF_FIELDS if hasattr(self, field)}
+
+    def restore(self, state: dict):
+        for field in HANDOFF_FIELDS:
+            if field in state:
+                setattr(self, field, state[field])
+
+    def queue_stats(self) -> dict:
+        """
+        Returns the outbound queue counters for this user.
+        :return:
+        """
+        return {
+            "depth": self.outbound.qsize(),
+            "bytes_queued": self.bytes_queued,
+            "frames_dropped": self.frames_dropped,
+        }
 
 
 class Room:
@@ -89,6 +224,9 @@ class Room:
         self.remove_room = False
         self.client_version = 0
         self.ally = 0  # all chat or ally chat
+        self.remote = False  # Room list entry of a room owned by another worker
+        self.remote_users = {}  # User id -> member connected to another worker, shared rooms only
+        self.lock = metrics.TimedLock("room")  # Guards membership and game state of this room
 
     async def add_user(self, user: User):
         """
@@ -99,6 +237,9 @@ class Room:
         user.room = self.id
         self.users[user.id] = user
         self.ucnt += 1
+        self.remove_room = False
+        self._joined(user)
+        room_list.touch(self.id)
 
     async def remove_user(self, user_id: int):
         """
@@ -109,7 +250,9 @@ class Room:
         user = self.users.pop(user_id)
         if user is not None:
             self.ucnt -= 1
+            self._left(user_id)
             self.is_room_empy()
+            room_list.touch(self.id)
         else:
             raise UserNotFoundInRoom
 
@@ -123,27 +266,106 @@ class Room:
             user.room = self.id
             self.users[user.id] = user
             self.ucnt += 1
+            self._joined(user)
+            room_list.touch(self.id)
             return
+        destination = rms.get(dst)
+        if destination is None:
+            # Checked first, the user stays where it is
+            raise RoomNotFound
         user = self.users.pop(user_id, None)
         if user is not None:
             self.ucnt -= 1
             user.room = dst
-            rms[dst].users[user.id] = user
-            rms[dst].ucnt += 1
+            destination.users[user.id] = user
+            destination.ucnt += 1
+            destination.remove_room = False
+            self._left(user_id)
+            destination._joined(user)
             self.is_room_empy()
+            room_list.touch(self.id)
+            room_list.touch(dst)
         else:
             raise UserNotFoundInRoom
 
+    def members(self) -> list:
+        """
+        Everyone in the room, with the members of a shared room connected to other workers.
+        :return:
+        """
+        return [*self.users.values(), *self.remote_users.values()]
+
+    def _joined(self, user):
+        """
+        Tells the other workers a user joined a shared room. A member that was known as connected
+        to another worker, and just moved here, is now counted as a local user.
+        :param user:
+        :return:
+        """
+        if self.id not in SHARED_ROOMS:
+            return
+        if self.remote_users.pop(user.id, None) is not None:
+            self.ucnt -= 1
+        if cluster.enabled:
+            state = {field: getattr(user, field) for field in MEMBER_FIELDS}
+            cluster.publish("members", {"room": self.id, "entered": [state], "left": []})
+
+    def _left(self, user_id: int):
+        if self.id in SHARED_ROOMS and cluster.enabled:
+            cluster.publish("members", {"room": self.id, "entered": [], "left": [user_id]})
+
+    async def broadcast(self, data, exclude=None):
+        """
+        Sends a message to every user in the room, encoding it only once.
+        Recipients with a full queue under the 'block' policy are waited on concurrently.
+        :param data:
+        :param exclude: user id that should not receive the message.
+        :return:
+        """
+        payload = User.clean(data)
+        if logs.protocol.should_trace():
+            logs.protocol.log.debug(f"Broadcast ({self.id}): {payload}")
+        await self.deliver(payload, exclude)
+        if self.id in SHARED_ROOMS and cluster.enabled:
+            # The other workers deliver it to their members of the room
+            cluster.publish(
+                "broadcast",
+                {"room": self.id, "payload": payload.decode("latin-1"), "exclude": exclude},
+            )
+
+    async def deliver(self, payload: bytes, exclude=None):
+        """
+        Queues an encoded message for the room's members on this worker.
+        :param payload:
+        :param exclude:
+        :return:
+        """
+        blocked = [
+            usr.send_bytes(payload)
+            for usr in list(self.users.values())
+            if usr.id != exclude and not usr.enqueue(payload)
+        ]
+        if blocked:
+            await asyncio.gather(*blocked, return_exceptions=True)
+
     def is_room_empy(self):
         """
-        Checks if the Room is Empty and Returns True/False
+        Checks if the Room is Empty and Returns True/False, flagging empty rooms for removal.
         :return:
         """
-        if len(self.users) == 0 and self.id != 1 and self.id != 42:
+        if self.is_empty():
             self.remove_room = True
             return True
         return False
 
+    def is_empty(self):
+        """
+        Checks if the Room is Empty without flagging it, the default rooms never are.
+        Rooms owned by another worker have no members here and are removed when their owner says so.
+        :return:
+        """
+        return len(self.users) == 0 and self.id not in SHARED_ROOMS and not self.remote
+
     def is_user_in_room(self, user):
         """
         Checks if the user is in the room.
@@ -153,32 +375,220 @@ class Room:
         return user.id in self.users
 
 
+@asynccontextmanager
+async def lock_rooms(*rooms):
+    """
+    Holds the locks of the given rooms, acquired in room id order so concurrent moves can't deadlock.
+    None entries and duplicates are ignored.
+    :param rooms:
+    :return:
+    """
+    unique = {room.id: room for room in rooms if room is not None}
+    ordered = [unique[room_id] for room_id in sorted(unique)]
+    async with AsyncExitStack() as stack:
+        for room in ordered:
+            await stack.enter_async_context(room.lock)
+        yield
+
+
+class RoomList:
+    """
+    Encoded rmList payload, rebuilt only when the room table version changes and then
+    only re-rendering the rooms that were touched since the last build.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._entries = {}  # Room id -> serialized <rm> entry
+        self._dirty = set()
+        self._built_version = -1
+        self._payload = b""
+
+    def touch(self, room_id: int):
+        """
+        Marks a room as created, changed or removed.
+        :param room_id:
+        :return:
+        """
+        self.version += 1
+        self._dirty.add(room_id)
+
+    def payload(self, rooms: dict) -> bytes:
+        """
+        Returns the encoded rmList message for the given room table.
+        :param rooms:
+        :return:
+        """
+        if self._built_version != self.version:
+            for room_id in self._dirty:
+                room = rooms.get(room_id)
+                if room is None or room.is_empty():
+                    self._entries.pop(room_id, None)
+                else:
+                    self._entries[room_id] = tpl.room_entry(room)
+            self._dirty.clear()
+            self._payload = User.clean(tpl.room_list(self._entries.values()))
+            self._built_version = self.version
+        return self._payload
+
+
+class SessionRegistry:
+    """
+    Process wide index of connected users keyed by user id and by lower-cased name.
+    """
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_name = {}
+        self._keys = {}  # User -> (id, name key) it is currently indexed under
+
+    def add(self, user: User):
+        """
+        Indexes the user under its current id and name, replacing any stale keys.
+        :param user:
+        :return:
+        """
+        self.remove(user)
+        name_key = user.name.lower() if user.name else None
+        self.by_id[user.id] = user
+        if name_key is not None:
+            self.by_name[name_key] = user
+        self._keys[user] = (user.id, name_key)
+
+    def remove(self, user: User):
+        """
+        Drops the user from the index, only removing keys that still point at this user.
+        :param user:
+        :return:
+        """
+        keys = self._keys.pop(user, None)
+        if keys is None:
+            return
+        id_, name_key = keys
+        if self.by_id.get(id_) is user:
+            del self.by_id[id_]
+        if name_key is not None and self.by_name.get(name_key) is user:
+            del self.by_name[name_key]
+
+    def find(self, user_id=None, name=None):
+        """
+        Find a connected user by id or by name.
+        :param user_id:
+        :param name:
+        :return:
+        """
+        if name is not None:
+            return self.by_name.get(str(name).lower())
+        return self.by_id.get(user_id)
+
+    def __contains__(self, user):
+        return user in self._keys
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class IdAllocator:
+    """
+    Hands out user ids for new connections without touching the database.
+    Registered ids are loaded once at startup; ids of connections that never became
+    registered users (guests, or users that logged into an existing account) are recycled lowest first.
+    With several workers each one owns the ids where (id - 1) % workers == worker.
+    """
+
+    def __init__(self, registered_ids, worker=0, workers=1):
+        self.worker = worker
+        self.workers = workers
+        self.registered = set(registered_ids)
+        self.issued = set()  # Connection ids currently in use
+        self._next = self._first_owned(max(self.registered, default=0) + 1)
+        self._free = [
+            id_ for id_ in range(worker + 1, self._next, workers) if id_ not in self.registered
+        ]  # Sorted, so already a heap
+
+    def owner(self, id_: int) -> int:
+        return (id_ - 1) % self.workers
+
+    def _first_owned(self, id_: int) -> int:
+        return id_ + (self.worker - (id_ - 1)) % self.workers
+
+    def allocate(self) -> int:
+        """
+        Returns the lowest free id.
+        :return:
+        """
+        if self._free:
+            id_ = heapq.heappop(self._free)
+        else:
+            id_ = self._next
+            self._next += self.workers
+        self.issued.add(id_)
+        return id_
+
+    def release(self, id_: int):
+        """
+        Returns a connection id to the pool, registered ids are never recycled.
+        :param id_:
+        :return:
+        """
+        if id_ in self.issued:
+            self.issued.discard(id_)
+            if id_ not in self.registered:
+                heapq.heappush(self._free, id_)
+
+    def register(self, id_: int):
+        """
+        Marks an id as belonging to a registered user, i.e. a row in the users table.
+        :param id_:
+        :return:
+        """
+        self.registered.add(id_)
+        if self.owner(id_) == self.worker and id_ >= self._next:
+            self._free.extend(range(self._next, id_, self.workers))
+            heapq.heapify(self._free)
+            self._next = id_ + self.workers
+
+    def claim(self, id_: int):
+        """
+        Marks an owned id as in use by a connection this worker did not allocate,
+        i.e. one it handed to another worker before it restarted.
+        :param id_:
+        :return:
+        """
+        if self.owner(id_) != self.worker or id_ in self.issued or id_ in self.registered:
+            return
+        if id_ >= self._next:
+            self._free.extend(range(self._next, id_, self.workers))
+            self._next = id_ + self.workers
+        elif id_ in self._free:
+            self._free.remove(id_)
+        heapq.heapify(self._free)
+        self.issued.add(id_)
+
+    def is_guest(self, id_: int) -> bool:
+        return id_ in self.issued and id_ not in self.registered
+
+
 # Global Counter
 counter = 1
-current_guests_ids = []
+
+# Connected Users
+sessions = SessionRegistry()
 
 # Default Rooms
 rms = {1: Room("MLX_6_Lobby", 1), 42: Room("MLX_6_Team_Channel", 42)}
+room_list = RoomList()
+for _room_id in rms:
+    room_list.touch(_room_id)
 
 
-async def find_user(user=None, user_id=None, name=None):
-    """
-    Find a user in the room.
-    :param user:
-    :return:
-    """
-    if user is not None and isinstance(user, User):
-        for room in rms.values():
-            if user.id in room.users:
-                return room.users[user.id]
-    elif name is not None:
-        for room in rms.values():
-            for usr in room.users.values():
-                if usr.name == name:
-                    return usr
-    else:
-        for room in rms.values():
-            for usr in room.users.values():
-                if usr.id == user_id:
-                    return room.users[user_id]
-    return None
+async def _on_broadcast(sender, data, fds):
+    room = rms.get(data["room"])
+    if room is not None:
+        await room.deliver(data["payload"].encode("latin-1"), data["exclude"])
+
+
+cluster.subscribe("broadcast", _on_broadcast)
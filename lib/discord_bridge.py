@@ -0,0 +1,200 @@
+import asyncio
+import socket
+
+import discord
+
+from lib import logs, metrics
+from lib.config import get_config
+
+# Load Configuration
+config = get_config()
+
+MAX_NAME = 256  # Bytes of a name in one datagram
+MAX_MESSAGE = 2000  # Discord's limit on a message
+RETRY_INITIAL = 1.0  # Seconds before retrying a failed send, doubling up to RETRY_MAX
+RETRY_MAX = 60.0
+
+
+def channel():
+    """
+    The pipe between the game servers and the discord bot: a datagram socketpair, one join per
+    datagram. Both ends are non-blocking, a full buffer means the bot is not keeping up and the
+    join is dropped.
+    :return: (bot end, game server end)
+    """
+    bot, game = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    bot.setblocking(False)
+    game.setblocking(False)
+    return bot, game
+
+
+class JoinFeed:
+    """
+    Game server side: hands lobby joins to the bot without ever waiting for it.
+    """
+
+    def __init__(self):
+        self.sock = None
+
+    def attach(self, sock):
+        self.sock = sock
+
+    def publish(self, name: str):
+        if self.sock is None:
+            return
+        try:
+            self.sock.send(name.encode()[:MAX_NAME])
+        except OSError:  # Full buffer or no bot on the other end
+            metrics.discord_joins_dropped.inc()
+
+
+class DiscordBridge:
+    """
+    Bot side: wakes up when joins arrive on the socket and posts them as digests.
+    Joins arriving within `window` of the first one share a message, sends are spaced by
+    `min_interval` to stay under the channel's rate limit, and joins keep collecting while
+    a send waits, so a burst costs a few messages instead of one per player.
+    When Discord is unreachable the bridge retries with a growing delay, keeping at most
+    `max_pending` names.
+    """
+
+    def __init__(self, sock, window=3.0, min_interval=1.2, max_pending=1000):
+        """
+        :param sock: bot end of channel().
+        :param window: seconds joins are collected before a digest is sent.
+        :param min_interval: least seconds between two messages.
+        :param max_pending: names kept while messages cannot be sent.
+        """
+        self.sock = sock
+        self.window = window
+        self.min_interval = min_interval
+        self.max_pending = max_pending
+        self.target = None  # Anything with an async send(text), the Discord channel
+        self.pending = []
+        self.dropped = 0
+        self._flush_task = None
+        self._last_sent = 0.0
+
+    def start(self, target):
+        """
+        Starts posting to the target, again after a reconnect with the new channel object.
+        :param target:
+        :return:
+        """
+        self.target = target
+        loop = asyncio.get_running_loop()
+        loop.remove_reader(self.sock.fileno())
+        loop.add_reader(self.sock.fileno(), self._on_readable)
+        self._on_readable()  # Joins that queued up while the bot was down
+
+    def _on_readable(self):
+        while True:
+            try:
+                name = self.sock.recv(MAX_NAME)
+            except BlockingIOError:
+                break
+            self.pending.append(name.decode(errors="replace"))
+        self._trim()
+        if self.pending and self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush())
+
+    def _trim(self):
+        excess = len(self.pending) - self.max_pending
+        if excess > 0:
+            self.dropped += excess
+            del self.pending[:excess]
+
+    async def _flush(self):
+        loop = asyncio.get_running_loop()
+        retry = RETRY_INITIAL
+        try:
+            await asyncio.sleep(self.window)
+            while self.pending:
+                wait = self._last_sent + self.min_interval - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                text, count = digest(self.pending)
+                batch = self.pending[:count]
+                del self.pending[:count]  # Joins arriving during the send may trim pending
+                try:
+                    await self.target.send(text)
+                except discord.RateLimited as e:
+                    self._requeue(batch)
+                    logs.discord.log.warning(f"Rate limited, retrying in {e.retry_after:.1f}s")
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                except (discord.DiscordException, OSError, asyncio.TimeoutError) as e:
+                    self._requeue(batch)
+                    logs.discord.log.error(
+                        f"Could not post {count} joins ({e}), retrying in {retry:.0f}s"
+                    )
+                    await asyncio.sleep(retry)
+                    retry = min(retry * 2, RETRY_MAX)
+                    continue
+                retry = RETRY_INITIAL
+                self._last_sent = loop.time()
+                if self.dropped:
+                    logs.discord.log.warning(
+                        f"Dropped {self.dropped} joins while Discord was unreachable"
+                    )
+                    self.dropped = 0
+        finally:
+            self._flush_task = None
+
+    def _requeue(self, batch):
+        self.pending[:0] = batch
+        self._trim()
+
+
+def digest(names):
+    """
+    One message announcing as many of the names as fit.
+    :param names:
+    :return: (text, number of names it covers)
+    """
+    if len(names) == 1:
+        return f"{names[0]} has joined the lobby!", 1
+    shown = []
+    length = 0
+    for name in names:
+        if length + len(name) + 2 > MAX_MESSAGE - 100:
+            break
+        shown.append(name)
+        length += len(name) + 2
+    if len(shown) == 1:
+        return f"{shown[0]} has joined the lobby!", 1
+    return f"{', '.join(shown[:-1])} and {shown[-1]} have joined the lobby!", len(shown)
+
+
+joins = JoinFeed()
+
+dc = discord.Client(intents=discord.Intents.default())
+bridge = None
+
+
+@dc.event
+async def on_ready():
+    logs.discord.log.info(f"{dc.user} has connected to Discord!")
+    target = dc.get_channel(int(config["discord"]["channel_id"]))
+    if target is None:
+        logs.discord.log.error(f"Channel {config['discord']['channel_id']} not found")
+        return
+    bridge.start(target)
+
+
+def run(sock, token):
+    """
+    Runs the bot, posting the joins read from the socket.
+    :param sock: bot end of channel().
+    :param token:
+    :return:
+    """
+    global bridge
+    settings = config["discord"]
+    bridge = DiscordBridge(
+        sock,
+        window=float(settings["digest_window_s"]),
+        min_interval=float(settings["min_interval_s"]),
+        max_pending=int(settings["max_pending"]),
+    )
+    dc.run(token)
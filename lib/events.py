@@ -1,18 +1,27 @@
-from asyncio import sleep
+from asyncio import create_task, sleep
 from loguru import logger as log
 from sys import exit as sys_exit
-from xml.etree import ElementTree as Et
-from lxml import objectify
 
 import lib.definitions as d
+from lib import handover, logs, metrics
+from lib import templates as tpl
 from lib.admin import is_mod
+from lib.cluster import cluster
 from lib.config import get_config
 from lib.definitions import Room
+from lib.discord_bridge import joins
 
 # Load Configuration
-from lib.exceptions import NewVarCase
+from lib.exceptions import NewVarCase, RoomNotFound, RoomOnOtherWorker
+from lib.notifications import notifier
+from lib.presence import presence
+from lib.profiler import profile
 
 config = get_config()
+PROFILE_MIN_SECONDS = 1.0  # Shorter runs take too few samples to show anything
+
+# Tasks nothing awaits, referenced until they are done
+background_tasks = set()
 
 
 async def enable_communication(self, xml, user):
@@ -23,16 +32,12 @@ async def enable_communication(self, xml, user):
     :param user:
     :return:
     """
-    comm_port = config["connection"]["port"]
-    await user.send(
-        f"<cross-domain-policy><allow-access-from domain='*' to-ports='{comm_port}' /></cross-domain-policy>"
-    )
+    await user.send(tpl.policy(config["connection"]["port"]))
     version = xml.body.ver.attrib["v"]
 
-    async with self.lock:
-        user.client_version = int(version)
+    user.client_version = int(version)
 
-    await user.send("<msg t='sys'><body action='apiOK' r='0'></body></msg>")
+    await user.send(tpl.sys_msg("apiOK", 0))
 
 
 async def login(self, xml, user):
@@ -43,21 +48,25 @@ async def login(self, xml, user):
     :param user:
     :return:
     """
-    msg = "<msg t='sys'><body action='logOK' r='0'><login n='{}' id='{}' mod='{}'/></body></msg>"
     if xml.body.login.nick.text != "":
         name = xml.body.login.nick.text
     else:
         name = f"guest_{user.id}"
-        async with self.lock:
-            d.current_guests_ids.append(user.id)
     mod = 1 if is_mod(str(name).lower()) else 0
-    user_db_data = self.database.get_user_info(name)
-    async with self.lock:
-        user.name = name
-        user.mod = mod
-        if user_db_data is not None:
-            user.id = user_db_data[0]
-    await user.send(msg.format(user.name, user.id, user.mod))
+    user_db_data = await self.database.get_user_info(name)
+    user.name = name
+    user.mod = mod
+    if user_db_data is not None:
+        self.release_id(user.id)
+        user.id = user_db_data[0]
+    d.sessions.add(user)
+    await user.send(
+        tpl.sys_msg(
+            "logOK",
+            0,
+            f"<login n='{tpl.escape_attr(user.name)}' id='{user.id}' mod='{user.mod}'/>",
+        )
+    )
     log.info(f"{user.name}({user.id}) logged in!")
 
     # Kick User if Version does not Match
@@ -66,20 +75,18 @@ async def login(self, xml, user):
             user, msg="You do not have the Latest Version of the Game!"
         )
         await sleep(5)
-        user.writer.close()
+        user.connection.close()
     # Create a new entry for user if not exists
-    if "guest_" not in user.name:
-        self.database.add_user(user.name)
-    d.message_channel.put(user.name, block=False)
+    if "guest_" not in user.name and user_db_data is None:
+        # The account keeps the id of the connection that created it
+        if await self.database.add_user(user.name, user_id=user.id):
+            self.register_id(user.id)
+    joins.publish(user.name)
 
     # Buddy Join Event
     if "guest_" not in user.name:
-        buddies = self.database.get_buddies(user.name)
-        for buddy_name in buddies:
-            usr_found = await d.find_user(name=buddy_name)
-            if usr_found is not None:
-                msg_bu = f"<msg t='sys'><body action='bUpd' r='-1'><b s='1' i='{user.id}'><n><![CDATA[{user.name}]]></n></b></body></msg>"
-                await usr_found.send(msg_bu)
+        presence.subscribe(user, await self.database.get_buddies(user.name))
+        presence.online(user)
 
 
 async def send_admin_message(user, msg):
@@ -89,10 +96,7 @@ async def send_admin_message(user, msg):
     :param msg:
     :return:
     """
-    await user.send(
-        f"<msg t='sys'><body action='dmnMsg' r='{user.room}'><user id='{user.id}'"
-        f" /><txt><![CDATA[{msg}]]></txt></body></msg>"
-    )
+    await user.send(tpl.admin_message(user.room, user.id, msg))
 
 
 async def load_buddy_list(self, xml, user):
@@ -104,16 +108,15 @@ async def load_buddy_list(self, xml, user):
     :return:
     """
     # Load Buddy List
-    buddies = self.database.get_buddies(user.name)
-    data_out = ""
+    buddies = await self.database.get_buddies(user.name)
+    entries = []
     for buddy in buddies:
-        bdy = await d.find_user(name=buddy)
-        if bdy:
-            data_out += f"<b s='1' i='{bdy.id}'><n><![CDATA[{buddy}]]></n></b>"
+        buddy_id = presence.find(buddy)
+        if buddy_id is not None:
+            entries.append(tpl.buddy(buddy, True, buddy_id))
         else:
-            data_out += f"<b s='0' i='-1'><n><![CDATA[{buddy}]]></n></b>"
-    msg = f"<msg t='sys'><body action='bList' r='-1'><bList>{data_out}</bList></body></msg>"
-    await user.send(msg)
+            entries.append(tpl.buddy(buddy, False))
+    await user.send(tpl.buddy_list(entries))
 
 
 async def get_room_list(self, xml, user):
@@ -124,17 +127,7 @@ async def get_room_list(self, xml, user):
     :param user:
     :return:
     """
-    msg = "<msg t='sys'><body action='rmList' r='0'><rmList>"
-    rms = {k: d.rms[k] for k in d.rms if not d.rms[k].is_room_empy()}
-    for r in rms:
-        room = rms[r]
-        msg += (
-            f"<rm id='{room.id}' priv='{room.priv}' temp='{room.temp}'"
-            f" game='{room.game}' ucnt='{room.ucnt}' maxu='{room.maxu}' "
-            f"maxs='{room.maxs}'><n><![CDATA[{room.name}]]></n></rm>"
-        )
-    msg += "</rmList></body></msg>"
-    await user.send(msg)
+    await user.send_bytes(d.room_list.payload(d.rms))
 
 
 def game_room(rm_id):
@@ -155,77 +148,64 @@ async def join_room(self, xml, user, room_join_id=None):
     r = xml.body.room.attrib
     if room_join_id is not None:
         r = {"id": room_join_id}
-    selected_room = d.rms[int(r["id"])]
-    msg = f"<msg t='sys'><body action='joinOK' r='{r['id']}'><pid id='{user.id}'/>"
+    owner = cluster.owner(int(r["id"]))
+    if owner is not None and owner != cluster.worker:
+        # The connection moves to the owner, which handles this frame again
+        raise RoomOnOtherWorker(owner)
+    selected_room = d.rms.get(int(r["id"]))
+    if selected_room is None:
+        await user.send(tpl.join_failed("The room no longer exists"))
+        return
     if game_room(selected_room.id):
-        msg += "<vars>"
-        properties = {
-            "gameStart": (0, "b"),
-            "gs": (d.rms[selected_room.id].gs, "n"),
-            "randomFactor": (d.rms[selected_room.id].random_factor, "n"),
-            "roomLeader": (d.rms[selected_room.id].room_leader, "n"),
-        }
-        for p in properties:
-            msg += f"<var n='{p}' t='{properties[p][1]}'><![CDATA[{properties[p][0]}]]></var>"
-        msg += f"</vars><uLs r='{r['id']}'>"
+        room_vars = (
+            f"<vars>{tpl.cdata_var('gameStart', 'b', 0)}"
+            f"{tpl.cdata_var('gs', 'n', selected_room.gs)}"
+            f"{tpl.cdata_var('randomFactor', 'n', selected_room.random_factor)}"
+            f"{tpl.cdata_var('roomLeader', 'n', selected_room.room_leader)}</vars>"
+        )
     else:
-        msg += f"<vars /><uLs r='{r['id']}'>"
-
-    async with self.lock:
+        room_vars = "<vars />"
+    room_id = r["id"]
+    left_room = d.rms.get(user.room)
+    destination = d.rms[1] if left_room is None else selected_room
+
+    async with d.lock_rooms(left_room, destination):
+        # The last member may have left and the room been removed while waiting for the locks
+        if d.rms.get(selected_room.id) is not selected_room:
+            await user.send(tpl.join_failed("The room no longer exists"))
+            return
         if user.room == -1:
             await d.rms[1].add_user(user)
         else:  # move
-            if room_join_id is not None:
-                await d.rms[user.room].move_user(user.id, room_join_id, user)
-            else:
-                await d.rms[user.room].move_user(
-                    user.id, int(xml.body.room.attrib["id"]), user
-                )
-
-        # Remove Empty Rooms
-        for r in d.rms.copy():
-            room_to_be_removed = d.rms[r].id
-            if d.rms[r].remove_room:
-                removed_room = d.rms.pop(r, None)
-                if removed_room is None:
-                    log.error("Room not found in the dict!")
-
-                for rm in d.rms:
-                    for u in d.rms[rm].users:
-                        await (
-                            d.rms[rm]
-                            .users[u]
-                            .send(
-                                f"<msg t='sys'><body action='roomDel'><rm id='{room_to_be_removed}'/></body></msg>"
-                            )
-                        )
-
-    for u in selected_room.users:
-        us = selected_room.users[u]
-        msg += (
-            f"<u i='{us.id}' m='{us.mod}'><n><![CDATA[{us.name}]]></n><vars></vars></u>"
+            try:
+                await left_room.move_user(user.id, destination.id, user)
+            except RoomNotFound:
+                await user.send(tpl.join_failed("The room no longer exists"))
+                return
+    d.sessions.add(user)
+    await remove_empty_rooms(self)
+
+    user_list = "".join([tpl.room_user(us) for us in selected_room.members()])
+    await user.send(
+        tpl.sys_msg(
+            "joinOK",
+            room_id,
+            f"<pid id='{tpl.escape_attr(user.id)}'/>{room_vars}"
+            f"<uLs r='{tpl.escape_attr(room_id)}'>{user_list}</uLs>",
         )
-    msg += "</uLs></body></msg>"
-    await user.send(msg)
-    if len(selected_room.users) > 1:
-        for u in selected_room.users:
-            await selected_room.users[u].send(
-                f"<msg t='sys'><body action='uCount' r='{selected_room.id}' u='{selected_room.ucnt}'></body></msg>"
-            )
-            if selected_room.users[u].id != user.id:
-                await selected_room.users[u].send(
-                    f"<msg t='sys'><body action='uER' r='{selected_room.id}'><u i ='{user.id}' m='{user.mod}' s='0'"
-                    f" p='2'><n><![CDATA[{user.name}]]></n><vars><var n='rank' t='n'><![CDATA[{user.rank}]]></var>"
-                    f"<var n='gamesPlayed' t='n'><![CDATA[{user.games_played}]]></var></vars></u></body></msg>"
-                )
-
+    )
+    notifier.user_count(selected_room)
+    if left_room is not None and left_room is not selected_room and left_room.id in d.rms:
+        notifier.user_count(left_room)
+    if len(selected_room.members()) > 1:
+        # Members of a shared room on other workers get it through the broadcast as well
+        await selected_room.broadcast(
+            tpl.user_enter(selected_room.id, user), exclude=user.id
+        )
+        for other in selected_room.members():
             # New user receives existing users' details
-            if selected_room.users[u].id != user.id:  # Exclude the new user
-                await user.send(
-                    f"<msg t='sys'><body action='uER' r='{selected_room.id}'><u i ='{selected_room.users[u].id}' m='{selected_room.users[u].mod}' s='0'"
-                    f" p='2'><n><![CDATA[{selected_room.users[u].name}]]></n><vars><var n='rank' t='n'><![CDATA[{selected_room.users[u].rank}]]></var>"
-                    f"<var n='gamesPlayed' t='n'><![CDATA[{selected_room.users[u].games_played}]]></var></vars></u></body></msg>"
-                )
+            if other.id != user.id:  # Exclude the new user
+                await user.send(tpl.user_enter(selected_room.id, other))
 
     # Display welcome message when user enters main lobby.
     if int(d.rms[user.room].id) == 1:
@@ -238,14 +218,34 @@ async def join_room(self, xml, user, room_join_id=None):
             f"<font size='20' color='#008000'>{config['welcome']['message']}</font>"
         )
 
-        welcome_msg = f"<msg t='sys'><body action='prvMsg' r='{d.rms[user.room].id}'><user id='-1' /><txt><![CDATA[ColonyBot!!&amp;&amp;!!<br>{welcome_msg}]]></txt></body></msg>"
-        await user.send(welcome_msg)
+        await user.send(
+            tpl.private_message(
+                d.rms[user.room].id, -1, f"ColonyBot!!&amp;&amp;!!<br>{welcome_msg}"
+            )
+        )
 
-    log.info(
-        f"User ({user.id}, {user.name}) Joined {d.rms[user.room].name} ({d.rms[user.room].id})"
+    logs.rooms.log.info(
+        "User ({}, {}) Joined {} ({})", user.id, user.name, destination.name, destination.id
     )
 
 
+async def remove_empty_rooms(self):
+    """
+    Removes the rooms flagged for removal that nobody joined since.
+    :param self:
+    :return:
+    """
+    async with self.lock:
+        for r in d.rms.copy():
+            room_to_be_removed = d.rms[r].id
+            if d.rms[r].remove_room and d.rms[r].is_empty():
+                removed_room = d.rms.pop(r, None)
+                if removed_room is None:
+                    log.error("Room not found in the dict!")
+                d.room_list.touch(room_to_be_removed)
+                notifier.room_deleted(room_to_be_removed)
+
+
 async def set_usr_variables(self, xml, user):
     """
     Sets User variables and updates other users of the changes.
@@ -269,26 +269,19 @@ async def set_usr_variables(self, xml, user):
     }
     for var in xml.body.vars.var:
         if var.attrib["n"] in usr_vars:
-            async with self.lock:
-                setattr(user, var.attrib["n"], var.text)
+            setattr(user, var.attrib["n"], var.text)
         else:
             raise NewVarCase(var.attrib["n"])
 
+    notifier.user_count(d.rms[user.room])
     for usr_id in room:
-        for room_ in d.rms:
-            for user_id in d.rms[room_].users:
-                await (
-                    d.rms[room_]
-                    .users[user_id]
-                    .send(
-                        f"<msg t='sys'><body action='uCount' "
-                        f"r='{d.rms[user.room].id}' u='{d.rms[user.room].ucnt}'></body></msg>"
-                    )
-                )
         if room[usr_id].id != room[usr_id].id:
             await room[usr_id].send(
-                f"<msg t='sys'><body action='uVarsUpdate' r='{room[usr_id].room}'><user id='{room[usr_id].id}' />"
-                f"<vars></vars></body></msg>"
+                tpl.sys_msg(
+                    "uVarsUpdate",
+                    room[usr_id].room,
+                    f"<user id='{tpl.escape_attr(room[usr_id].id)}' /><vars></vars>",
+                )
             )
 
 
@@ -299,7 +292,7 @@ def check_for_commands(string: str):
     :return:
     """
     prefix = "/"
-    commands = ["restart", "update", "showrooms"]
+    commands = ["restart", "update", "showrooms", "profile"]
     pr_cmd = [f"{prefix}{x}" for x in commands]
     for cmd in pr_cmd:
         if cmd in string or cmd == string:
@@ -318,37 +311,84 @@ async def notify_all_users(msg):
             await send_admin_message(d.rms[room].users[usr], msg)
 
 
-async def restart(user, sleep_time=10):
+async def restart(self, user, sleep_time=10):
     """
-    Exits the subprocess with code 42 causing the main thread to restart subprocess.
+    Hands every worker over to a new process keeping the connections, or when that is not possible
+    exits the subprocess with code 42 causing the main thread to restart subprocess.
+    :param self:
     :param user:
     :param sleep_time:
     :return:
     """
     log.info(f"Restart Triggered by {user.name} id: (user.id) addr: ({user.address})")
-    await notify_all_users(f"Server is about to restart in {sleep_time}s.")
-    await sleep(sleep_time)
-    sys_exit(42)
+    if can_hand_over(self):
+        hand_over_workers(self)
+        return
+    await shut_down_workers(self, 42, f"Server is about to restart in {sleep_time}s.", sleep_time)
 
 
-async def update(user, sleep_time=10):
+async def update(self, user, sleep_time=10):
     """
-    Exits the subprocess with code 43 causing the main thread to execute 'git pull' and restart subprocess.
+    Has the main thread execute 'git pull' and hands every worker over to a new process running the
+    pulled code, or when that is not possible exits the subprocess with code 43 causing the main thread
+    to execute 'git pull' and restart subprocess.
+    :param self:
     :param user:
     :param sleep_time:
     :return:
     """
     log.info(f"Update Triggered by {user.name} id: ({user.id}) addr: ({user.address})")
-    await notify_all_users(
-        f"Server is about to restart for an update in {sleep_time}s."
+    if can_hand_over(self):
+        # The launcher pulls before it starts the successors
+        self.control.send({"type": "update"})
+        hand_over_workers(self)
+        return
+    await shut_down_workers(
+        self, 43, f"Server is about to restart for an update in {sleep_time}s.", sleep_time
     )
+
+
+def can_hand_over(self) -> bool:
+    return self.control is not None and config["restart"]["hot"] == "true"
+
+
+def hand_over_workers(self):
+    """
+    Makes every worker hand its connections to a new process.
+    Runs in the background, the handover waits for the handlers still running, this one included.
+    :param self:
+    :return:
+    """
+    cluster.publish("hand_over", {})
+    task = create_task(handover.hand_over(self))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def shut_down_workers(self, code, msg, sleep_time):
+    """
+    Makes every worker warn its users, wait and exit with the code the launcher acts on.
+    :param self:
+    :param code:
+    :param msg:
+    :param sleep_time:
+    :return:
+    """
+    cluster.publish("shut_down", {"code": code, "msg": msg, "sleep_time": sleep_time})
+    await shut_down(self, code, msg, sleep_time)
+
+
+async def shut_down(self, code, msg, sleep_time):
+    await notify_all_users(msg)
     await sleep(sleep_time)
-    sys_exit(43)
+    await self.database.flush()
+    sys_exit(code)
 
 
 async def show_rooms(user):
     """
-    Prints a list of rooms with users in lobby
+    Prints a list of rooms with users in lobby, the clients with frames waiting in their queue
+    and how many slow clients were evicted
     :param user:
     :return:
     """
@@ -358,29 +398,82 @@ async def show_rooms(user):
             f"{d.rms[room].name} ({d.rms[room].id}):"
             f" [{[(d.rms[room].users[usr].name, d.rms[room].users[usr].id) for usr in d.rms[room].users]}]\n"
         )
-    for usr_id in d.rms[user.room].users:
-        await (
-            d.rms[user.room]
-            .users[usr_id]
-            .send(
-                f"<msg t='sys'><body action='pubMsg' r='{d.rms[user.room].id}'>"
-                f"<user id='{user.id}' /><txt><![CDATA[{msg}]]></txt></body></msg>"
-            )
+    # Clients the server is waiting on, with their outbound queue
+    backlog = [
+        (usr.name, usr.id, usr.queue_stats())
+        for usr in d.sessions
+        if usr.outbound.qsize() or usr.frames_dropped
+    ]
+    if backlog:
+        msg += f"Queued: {backlog}\n"
+    msg += f"Slow clients evicted: {metrics.evictions.values.get((), 0)}\n"
+    await d.rms[user.room].broadcast(
+        tpl.public_message(d.rms[user.room].id, user.id, msg)
+    )
+
+
+async def profile_server(user, text):
+    """
+    Samples the server for the requested number of seconds without interrupting it,
+    then sends the moderator the busiest functions.
+    :param user:
+    :param text: the chat message, '/profile <seconds>'.
+    :return:
+    """
+    max_seconds = float(config["profiler"]["max_seconds"])
+    args = text.split("/profile", 1)[1].split()
+    try:
+        seconds = float(args[0]) if args else min(10.0, max_seconds)
+    except ValueError:
+        seconds = None
+    if seconds is None or not PROFILE_MIN_SECONDS <= seconds <= max_seconds:
+        await send_admin_message(
+            user, f"Usage: /profile [seconds], from {PROFILE_MIN_SECONDS:g} to {max_seconds:g}"
+        )
+        return
+    await send_admin_message(user, f"Profiling the server for {seconds:g}s.")
+    try:
+        result = await profile(
+            seconds,
+            config["profiler"]["directory"],
+            float(config["profiler"]["interval_ms"]) / 1000,
         )
+    except Exception as e:
+        # Nobody awaits this task, the moderator is the one to hear about it
+        log.exception(f"Profile requested by {user.name} failed")
+        await send_admin_message(user, f"Profiling failed: {e}")
+        return
+    if result is None:
+        await send_admin_message(user, "A profile is already running.")
+        return
+    path, profiler = result
+    lines = [f"{own:.0%} self, {total:.0%} total: {name}" for name, own, total in profiler.top()]
+    idle = profiler.idle / max(profiler.samples, 1)
+    await send_admin_message(
+        user,
+        f"{profiler.samples} samples ({idle:.0%} idle) written to {path}\n" + "\n".join(lines),
+    )
 
 
-async def process_custom_commands(cmd, user):
+async def process_custom_commands(self, cmd, user, text=""):
     """
     Execute text commands from in game chat room.
+    :param self:
     :param cmd:
     :param user:
+    :param text: the whole chat message, for commands that take arguments.
     :return:
     """
     if cmd is not None and is_mod(user.name):
         if cmd == "/restart":
-            await restart(user)
+            await restart(self, user)
         if cmd == "/update":
-            await restart(user)
+            await update(self, user)
+        if cmd == "/profile":
+            # Runs in the background so the moderator's own messages keep being handled
+            task = create_task(profile_server(user, text))
+            background_tasks.add(task)  # The loop only keeps a weak reference
+            task.add_done_callback(background_tasks.discard)
     if cmd == "/showrooms":
         await show_rooms(user)
 
@@ -393,14 +486,12 @@ async def publish_message(self, xml, user):
     :param user:
     :return:
     """
-    cmd = check_for_commands(xml.body.txt)
-    await process_custom_commands(cmd, user)
-    room = d.rms[user.room].users
-    for usr_id in room:
-        await room[usr_id].send(
-            f"<msg t='sys'><body action='pubMsg' r='{d.rms[user.room].id}'>"
-            f"<user id='{user.id}' /><txt><![CDATA[{xml.body.txt}]]></txt></body></msg>"
-        )
+    text = str(xml.body.txt)
+    cmd = check_for_commands(text)
+    await process_custom_commands(self, cmd, user, text)
+    await d.rms[user.room].broadcast(
+        tpl.public_message(d.rms[user.room].id, user.id, xml.body.txt)
+    )
 
 
 async def create_room(self, xml, user):
@@ -411,35 +502,38 @@ async def create_room(self, xml, user):
     :param user:
     :return:
     """
+    room_attrib = xml.body.room.attrib
+    new_room = Room(xml.body.room.name.text, 0)
+    new_room.temp = room_attrib["tmp"]
+    new_room.game = room_attrib["gam"]
+    new_room.maxu = 4
+    new_room.maxs = room_attrib["spec"]
     async with self.lock:
-        d.counter += 1
-
-    msg = f"<msg t='sys'><body action='roomAdd' r='{d.rms[user.room].id}'>"
-    msg += (
-        f"<rm id = '{d.counter}' priv = '0' temp = '{xml.body.room.attrib['tmp']}'"
-        f" game = '{xml.body.room.attrib['gam']}' max = '4' spec = '{xml.body.room.attrib['spec']}'"
-        f" limbo = '0' ><name><![CDATA[{xml.body.room.name.text}]]></name><vars /></rm></body></msg>"
+        d.counter = cluster.next_room_id(d.counter, d.rms)
+        new_room.id = d.counter
+        d.rms[new_room.id] = new_room
+        d.room_list.touch(new_room.id)
+
+    msg = tpl.sys_msg(
+        "roomAdd",
+        d.rms[user.room].id,
+        f"<rm id = '{new_room.id}' priv = '0' temp = '{tpl.escape_attr(room_attrib['tmp'])}'"
+        f" game = '{tpl.escape_attr(room_attrib['gam'])}' max = '4' spec = '{tpl.escape_attr(room_attrib['spec'])}'"
+        f" limbo = '0' ><name>{tpl.cdata(xml.body.room.name.text)}</name><vars /></rm>",
     )
-
-    async with self.lock:
-        d.rms[d.counter] = Room(xml.body.room.name.text, d.counter)
-        d.rms[d.counter].temp = xml.body.room.attrib["tmp"]
-        d.rms[d.counter].game = xml.body.room.attrib["gam"]
-        d.rms[d.counter].maxu = 4
-        d.rms[d.counter].maxs = xml.body.room.attrib["spec"]
-    for usr_id in d.rms[user.room].users:
-        await d.rms[user.room].users[usr_id].send(msg)
-    log.info(f"{user.name}({user.id}) created the room {d.rms[d.counter].name}")
+    await d.rms[user.room].broadcast(msg)
+    logs.rooms.log.info("{}({}) created the room {}", user.name, user.id, new_room.name)
     if int(xml.body.attrib["r"]) in d.rms:
-        await join_room(self, xml, user, d.counter)
+        await join_room(self, xml, user, new_room.id)
 
         try:
             room_exited = int(xml.body.room.attrib["exit"])
-            msg = f"<msg t='sys'><body action='userGone' r='{room_exited}'><user id='{user.id}' /></body></msg>"
-            for usr_id in d.rms[room_exited].users:
-                await d.rms[room_exited].users[usr_id].send(msg)
+            await d.rms[room_exited].broadcast(tpl.user_gone(room_exited, user.id))
         except Exception as e:
             log.error(e)
+    if new_room.is_room_empy():
+        # Nobody joined it, nothing else would ever remove it from the room list
+        await remove_empty_rooms(self)
 
 
 async def set_room_variables(self, xml, user):
@@ -450,20 +544,20 @@ async def set_room_variables(self, xml, user):
     :param user:
     :return:
     """
-    msg = f"<msg t='sys'><body action='rVarsUpdate' r='{user.room}'><vars>"
-    for x in xml.body.vars.var:
-        msg += f"<var n='{x.attrib['n']}' t='{x.attrib['t']}'><![CDATA[{xml.body.vars.var.text}]]></var>"
-        if x.attrib["n"] == "gs":
-            async with self.lock:
-                d.rms[user.room].gs = x.text
-        elif x.attrib["n"] == "roomLeader":
-            async with self.lock:
-                d.rms[user.room].room_leader = x.text
-        elif x.attrib["n"] == "randomFactor":
-            async with self.lock:
-                d.rms[user.room].random_factor = x.text
-    msg += "</vars></body></msg>"
-    await user.send(msg)
+    room_vars = []
+    room = d.rms[user.room]
+    async with room.lock:
+        for x in xml.body.vars.var:
+            room_vars.append(tpl.cdata_var(x.attrib["n"], x.attrib["t"], xml.body.vars.var.text))
+            if x.attrib["n"] == "gs":
+                room.gs = x.text
+            elif x.attrib["n"] == "roomLeader":
+                room.room_leader = x.text
+            elif x.attrib["n"] == "randomFactor":
+                room.random_factor = x.text
+    await user.send(
+        tpl.sys_msg("rVarsUpdate", user.room, f"<vars>{''.join(room_vars)}</vars>")
+    )
 
 
 async def as_obj(self, xml, user):
@@ -474,36 +568,39 @@ async def as_obj(self, xml, user):
     :param user:
     :return:
     """
-    room_id = xml.body.attrib["r"]
-    dict_format_obj = objectify.fromstring(xml.body.text)
+    room_id = xml.room
+    dict_format_obj = xml.data
     rm_vars = get_room_vars(dict_format_obj)
     rm_vars["rm_id"] = room_id
 
     if rm_vars["id"] == "updateIncome":
         # Get User Position and "Race"
         user_data = {}
-        for var in dict_format_obj.obj.var:
-            user_data[var.attrib["n"]] = var.text
-        msg = (
-            f"<msg t='sys'><body action='dataObj' r='{room_id}'><user id='{user.id}' /><dataObj>"
-            f"<![CDATA[<dataObj><var n='id' t='s'>updateIncome</var><obj t='o' o='sub'><var n='pos'"
-            f" t='n'>{user_data['pos']}</var><var n='race' t='n'>{user_data['race']}</var></obj>"
-            f"</dataObj>]]></dataObj></body></msg>"
+        for var in dict_format_obj.obj.vars:
+            user_data[var.n] = var.text
+        msg = tpl.data_obj(
+            room_id,
+            user.id,
+            tpl.var("id", "s", "updateIncome")
+            + tpl.obj(
+                "sub",
+                "o",
+                tpl.var("pos", "n", user_data["pos"]) + tpl.var("race", "n", user_data["race"]),
+            ),
         )
 
-        for usr in d.rms[int(rm_vars["rm_id"])].users:
-            if int(user.id) != int(usr):
-                await d.rms[int(rm_vars["rm_id"])].users[usr].send(msg)
+        await d.rms[int(rm_vars["rm_id"])].broadcast(msg, exclude=int(user.id))
 
     elif rm_vars["id"] == "sendChat":
         await send_ally_chat(user, rm_vars, dict_format_obj)
 
     if rm_vars["id"] == "updateTeamDisplay":
-        array = get_array_objects(dict_format_obj, xml.body.text)
+        array = get_array_objects(dict_format_obj, xml.payload_bytes)
         array_key = "arrayId" if "arrayId" in array else "array"
-        for idx, var in enumerate(array[array_key]):
-            async with self.lock:
-                d.rms[int(room_id)].usr_pos[int(idx)] = var
+        room = d.rms[int(room_id)]
+        async with room.lock:
+            for idx, var in enumerate(array[array_key]):
+                room.usr_pos[int(idx)] = var
 
 
 async def kill_unit(rm_vars, dict_format_obj):
@@ -514,17 +611,14 @@ async def kill_unit(rm_vars, dict_format_obj):
     :return:
     """
     data = {}
-    for var in dict_format_obj.obj.var:
-        data[var.attrib["n"]] = (var.text, var.attrib["t"])
-    msg = (
-        f"<msg t='sys'><body action='dataObj' r='{rm_vars['rm_id']}'><user id='{rm_vars['_$$_']}'/><dataObj>"
-        f"<![CDATA[<dataObj><var n='id' t='s'>killUnit</var><obj o='sub' t='a'>"
+    for var in dict_format_obj.obj.vars:
+        data[var.n] = var
+    msg = tpl.data_obj(
+        rm_vars["rm_id"],
+        rm_vars["_$$_"],
+        tpl.var("id", "s", "killUnit") + tpl.obj("sub", "a", tpl.var_list(data.values())),
     )
-    for item in data:
-        msg += f"<var n='{item}' t='{data[item][1]}'>{data[item][0]}</var>"
-    msg = f"{msg}</obj></dataObj>]]></dataObj></body></msg>"
-    for usr in d.rms[int(rm_vars["rm_id"])].users:
-        await d.rms[int(rm_vars["rm_id"])].users[usr].send(msg)
+    await d.rms[int(rm_vars["rm_id"])].broadcast(msg)
 
 
 async def send_stats(user, rm_vars, dict_format_obj):
@@ -535,12 +629,12 @@ async def send_stats(user, rm_vars, dict_format_obj):
     :param dict_format_obj:
     :return:
     """
-    msg = f"<msg t='sys'><body action='dataObj' r='{rm_vars['rm_id']}'>" \
-          f"<user id='{user.id}' />" \
-          f"<dataObj><![CDATA[<dataObj><obj t='o' o='sub'>"
-    for var in dict_format_obj.obj.var:
-        msg += f"<var n='{var.attrib['n']}' t='{var.attrib['t']}'>{var.text}</var>"
-    msg = f"{msg}</obj><var n='id' t='s'>{rm_vars['id']}</var></dataObj>]]></dataObj></body></msg>"
+    msg = tpl.data_obj(
+        rm_vars["rm_id"],
+        user.id,
+        tpl.obj("sub", "o", tpl.var_list(dict_format_obj.obj.vars))
+        + tpl.var("id", "s", rm_vars["id"]),
+    )
 
     target_user_id = int(rm_vars['_$$_'])
     await d.rms[int(rm_vars["rm_id"])].users[target_user_id].send(msg)
@@ -555,23 +649,20 @@ async def send_ally_chat(user, rm_vars, dict_format_obj, ally=False):
     :param dict_format_obj:
     :return:
     """
-    msg = (
-        f"<msg t='sys'><body action='dataObj' r='{rm_vars['rm_id']}'>"
-        f"<user id='{user.id if not ally else rm_vars['_$$_']}' />"
-        f"<dataObj><![CDATA[<dataObj><obj t='o' o='sub'>"
+    msg = tpl.data_obj(
+        rm_vars["rm_id"],
+        user.id if not ally else rm_vars["_$$_"],
+        tpl.obj("sub", "o", tpl.var_list(dict_format_obj.obj.vars))
+        + tpl.var("id", "s", rm_vars["id"]),
     )
-    for var in dict_format_obj.obj.var:
-        msg += f"<var n='{var.attrib['n']}' t='{var.attrib['t']}'>{var.text}</var>"
-    msg = f"{msg}</obj><var n='id' t='s'>{rm_vars['id']}</var></dataObj>]]></dataObj></body></msg>"
-
-    for usr in d.rms[int(rm_vars["rm_id"])].users:
-        if ally:
-            if int(usr) == int(rm_vars["_$$_"]):
-                await d.rms[int(rm_vars["rm_id"])].users[usr].send(msg)
-        else:
-            if usr == user.id:
-                continue
-            await d.rms[int(rm_vars["rm_id"])].users[usr].send(msg)
+
+    room = d.rms[int(rm_vars["rm_id"])]
+    if ally:
+        target = room.users.get(int(rm_vars["_$$_"]))
+        if target is not None:
+            await target.send(msg)
+    else:
+        await room.broadcast(msg, exclude=user.id)
 
 
 async def update_player_colors(xml, rm_vars, dict_obj):
@@ -582,31 +673,26 @@ async def update_player_colors(xml, rm_vars, dict_obj):
     :param dict_obj:
     :return:
     """
-    from lxml import etree
-    import json
-    
     colors = {}
-    if hasattr(dict_obj, 'obj'):
-        colors_obj = dict_obj.obj
-        for var_elem in colors_obj.findall("var"):
-            n = var_elem.get("n")
-            if n:
-                colors[n] = var_elem.text
+    if dict_obj.objs:
+        for var in dict_obj.obj.vars:
+            if var.n:
+                colors[var.n] = var.text
     
     if not colors:
         return
     
     room = d.rms[int(rm_vars["rm_id"])]
     
-    msg = (
-        f"<msg t='sys'><body action='dataObj' r='{rm_vars['rm_id']}'><user id='{rm_vars['_$$_']}' /><dataObj>"
-        f"<![CDATA[<dataObj><var n='id' t='s'>updatePlayerColors</var><obj t='o' o='sub'><obj t='o' o='colors'>"
-        f"{''.join(f'<var n=\"{pos}\" t=\"n\">{color}</var>' for pos, color in colors.items())}"
-        f"</obj></obj></dataObj>]]></dataObj></body></msg>"
+    color_vars = "".join([tpl.var(pos, "n", color) for pos, color in colors.items()])
+    msg = tpl.data_obj(
+        rm_vars["rm_id"],
+        rm_vars["_$$_"],
+        tpl.var("id", "s", "updatePlayerColors")
+        + tpl.obj("sub", "o", tpl.obj("colors", "o", color_vars)),
     )
 
-    for user in room.users.values():
-        await user.send(msg)
+    await room.broadcast(msg)
 
 
 async def as_obj_g(self, xml, user):
@@ -617,8 +703,8 @@ async def as_obj_g(self, xml, user):
     :param user:
     :return:
     """
-    room_id = xml.body.attrib["r"]
-    dict_format_obj = objectify.fromstring(xml.body.text)
+    room_id = xml.room
+    dict_format_obj = xml.data
     rm_vars = get_room_vars(dict_format_obj)
     rm_vars["rm_id"] = room_id
 
@@ -661,14 +747,15 @@ async def kick_user(xml, user_id):
     """
     Kick a user from the room.
     """
-    room_id = int(xml.body.attrib["r"])
-    msg = f"<msg t='sys'><body action='dataObj' r='{room_id}'><user id='{user_id}' /><dataObj><![CDATA[<dataObj><obj o='sub' t='a'></obj><var n='id' t='s'>getKicked</var></dataObj>]]></dataObj></body></msg>"
-    exit_msg = f"<msg t='sys'><body action='userGone' r='{room_id}'><user id='{user_id}' /></body></msg>"
-    found_user = await d.find_user(user_id=user_id)
+    room_id = int(xml.room)
+    msg = tpl.data_obj(
+        room_id, user_id, tpl.obj("sub", "a", "") + tpl.var("id", "s", "getKicked")
+    )
+    exit_msg = tpl.user_gone(room_id, user_id)
+    found_user = d.sessions.find(user_id=user_id)
     if found_user is not None:
         await found_user.send(msg)
-        for usr_id in d.rms[room_id].users:
-            await d.rms[room_id].users[usr_id].send(exit_msg)
+        await d.rms[room_id].broadcast(exit_msg)
 
 
 async def order_unit(rm_vars, dict_format_obj):
@@ -679,36 +766,34 @@ async def order_unit(rm_vars, dict_format_obj):
     :return:
     """
     unt_cmd = dict_format_obj.obj.var.text
-    msg = (
-        f"<msg t='sys'><body action='dataObj' r='{rm_vars['rm_id']}'><user id='{rm_vars['_$$_']}' />"
-        f"<dataObj><![CDATA[<dataObj>"
-        f"<var n='id' t='s'>orderUnit</var><obj o='sub' t='a'>"
-        f"<var n='id' t='n'>{unt_cmd}</var><obj o='orderArray' t='a'>"
+    msg = tpl.data_obj(
+        rm_vars["rm_id"],
+        rm_vars["_$$_"],
+        tpl.var("id", "s", "orderUnit")
+        + tpl.obj(
+            "sub",
+            "a",
+            tpl.var("id", "n", unt_cmd)
+            + tpl.obj("orderArray", "a", tpl.var_list(dict_format_obj.obj.obj.vars)),
+        ),
     )
 
-    for x in dict_format_obj.obj.obj.var:
-        msg += f"<var n='{x.attrib['n']}' t='{x.attrib['t']}'>{x.text}</var>"
-    msg += "</obj></obj></dataObj>]]></dataObj></body></msg>"
-
-    for usr in d.rms[int(rm_vars["rm_id"])].users:
-        await d.rms[int(rm_vars["rm_id"])].users[usr].send(msg)
+    await d.rms[int(rm_vars["rm_id"])].broadcast(msg)
 
 
 async def update_team_display(self, xml, rm_vars, dict_obj):
-    arrays = get_array_objects(dict_obj, xml.body.text)
-    msg = (
-        f"<msg t='sys'><body action='dataObj' r='{rm_vars['rm_id']}'><user id='{rm_vars['_$$_']}' />"
-        f"<dataObj><![CDATA[<dataObj><var n='id' t='s'>updateTeamDisplay</var>"
-        f"<obj t='o' o='sub'><obj t='a' o='array'>"
+    arrays = get_array_objects(dict_obj, xml.payload_bytes)
+    msg = tpl.data_obj(
+        rm_vars["rm_id"],
+        rm_vars["_$$_"],
+        tpl.var("id", "s", "updateTeamDisplay")
+        + tpl.obj("sub", "o", tpl.obj("array", "a", tpl.indexed_vars(arrays["array"]))),
     )
-    for idx, item in enumerate(arrays["array"]):
-        msg += f"<var n='{idx}' t='s'>{item}</var>"
-    msg += "</obj></obj></dataObj>]]></dataObj></body></msg>"
-    async with self.lock:
+    room = d.rms[int(rm_vars["rm_id"])]
+    async with room.lock:
         for idx, var in enumerate(arrays["array"]):
-            d.rms[int(rm_vars["rm_id"])].usr_pos[idx] = var
-    for usr in d.rms[int(rm_vars["rm_id"])].users:
-        await d.rms[int(rm_vars["rm_id"])].users[usr].send(msg)
+            room.usr_pos[idx] = var
+    await d.rms[int(rm_vars["rm_id"])].broadcast(msg)
 
 
 async def begin_game(xml, rm_vars, dict_obj):
@@ -719,48 +804,36 @@ async def begin_game(xml, rm_vars, dict_obj):
     :param dict_obj:
     :return:
     """
-    arrays = get_array_objects(dict_obj, xml.body.text)
+    arrays = get_array_objects(dict_obj, xml.payload_bytes)
     rm_vars["randName"] = dict_obj.obj.var.text
     
     player_colors = {}
-    for var in dict_obj.obj.var:
-        if var.attrib["n"] == "playerColors":
+    for var in dict_obj.obj.vars:
+        if var.n == "playerColors":
             # Parse player colors from the XML
-            for color_var in var.var:
-                player_colors[color_var.attrib["n"]] = color_var.text
+            for color_var in var.vars:
+                player_colors[color_var.n] = color_var.text
             break
     
-    msg = (
-        f"<msg t='sys'><body action='dataObj' r='{rm_vars['rm_id']}'><user id='{rm_vars['_$$_']}' /><dataObj>"
-        f"<![CDATA[<dataObj><var n='id' t='s'>beginGame</var><obj t='o' o='sub'>"
-        f"<var n='randName' t='s'>{rm_vars['randName']}</var>"
-    )
-    
+    sub = [tpl.var("randName", "s", rm_vars["randName"])]
     if player_colors:
-        msg += f"<obj t='o' o='playerColors'>"
-        for pos, color in player_colors.items():
-            msg += f"<var n='{pos}' t='n'>{color}</var>"
-        msg += "</obj>"
-    
+        color_vars = "".join([tpl.var(pos, "n", color) for pos, color in player_colors.items()])
+        sub.append(tpl.obj("playerColors", "o", color_vars))
     for obj_type in arrays:
-        msg += f"<obj t='a' o='{obj_type}'>"
-        for idx, item in enumerate(arrays[obj_type]):
-            msg += f"<var n='{idx}' t='s'>{item}</var>"
-        msg += "</obj>"
-    msg += "</obj></dataObj>]]></dataObj></body></msg>"
-    for usr in d.rms[int(rm_vars["rm_id"])].users:
-        await d.rms[int(rm_vars["rm_id"])].users[usr].send(msg)
-
-    user_names = [
-        (
-            d.rms[int(rm_vars["rm_id"])].users[user].name,
-            d.rms[int(rm_vars["rm_id"])].users[user].id,
-        )
-        for user in d.rms[int(rm_vars["rm_id"])].users
-    ]
-    log.info(
-        f"A game has started in room {d.rms[int(rm_vars['rm_id'])].name}({rm_vars['rm_id']}) with {user_names}"
+        sub.append(tpl.obj(obj_type, "a", tpl.indexed_vars(arrays[obj_type])))
+    msg = tpl.data_obj(
+        rm_vars["rm_id"],
+        rm_vars["_$$_"],
+        tpl.var("id", "s", "beginGame") + tpl.obj("sub", "o", "".join(sub)),
     )
+    await d.rms[int(rm_vars["rm_id"])].broadcast(msg)
+
+    if logs.rooms.info_enabled:
+        room = d.rms[int(rm_vars["rm_id"])]
+        user_names = [(usr.name, usr.id) for usr in room.users.values()]
+        logs.rooms.log.info(
+            f"A game has started in room {room.name}({rm_vars['rm_id']}) with {user_names}"
+        )
 
 
 async def xt_req(self, xml, user):
@@ -772,23 +845,23 @@ async def xt_req(self, xml, user):
     :param user:
     :return:
     """
-    room_id = xml.body.attrib["r"]
-    dict_format_obj = objectify.fromstring(xml.body.text)
+    room_id = xml.room
+    dict_format_obj = xml.data
     rm_vars = get_room_vars(dict_format_obj)
     rm_vars["rm_id"] = room_id
-    tree = Et.ElementTree(Et.fromstring(xml.body.text))
     if "cmd" in rm_vars:
         data_to_send = {}
         da = [5, 0, 0, 0, 0, 0, 0, 0]
 
         if rm_vars["cmd"] == "s":
-            async with self.lock:
-                # Set user ids and position.
-                arrays = get_array_objects(dict_format_obj, xml.body.text)
-                d.rms[int(rm_vars["rm_id"])].user_pos_id = arrays["setArray"]
+            # Set user ids and position.
+            arrays = get_array_objects(dict_format_obj, xml.payload_bytes)
+            room = d.rms[int(rm_vars["rm_id"])]
+            async with room.lock:
+                room.user_pos_id = arrays["setArray"]
         if rm_vars["cmd"] == "m":
-            for var in dict_format_obj.obj.var:
-                data_to_send[var.attrib["n"]] = var.text
+            for var in dict_format_obj.obj.vars:
+                data_to_send[var.n] = var.text
 
             da[1] = room_id
             da[2] = ""
@@ -800,8 +873,10 @@ async def xt_req(self, xml, user):
             # Used by Buildings
             if data_to_send["cmd"] == "0":
                 building_vars = {}
-                for var in tree.findall("obj/obj/var"):
-                    building_vars[var.attrib["n"]] = var.text
+                for obj in dict_format_obj.objs:
+                    for sub_obj in obj.objs:
+                        for var in sub_obj.vars:
+                            building_vars[var.n] = var.text
                 da[5] = building_vars["building"]
                 da[6] = int(building_vars["cancelOrder"])
                 da[7] = int(building_vars["auto"])
@@ -809,9 +884,9 @@ async def xt_req(self, xml, user):
             # Used by Units
             elif data_to_send["cmd"] == "1":
                 unit_vars = {"random": []}
-                for var in dict_format_obj.obj.obj.var:
-                    unit_vars[var.attrib["n"]] = var.text
-                for var in dict_format_obj.obj.obj.obj.var:
+                for var in dict_format_obj.obj.obj.vars:
+                    unit_vars[var.n] = var.text
+                for var in dict_format_obj.obj.obj.obj.vars:
                     unit_vars["random"].append(var.text)
 
                 da[5] = unit_vars["setId"]
@@ -828,18 +903,13 @@ async def xt_req(self, xml, user):
             # Used by Missiles
             elif data_to_send["cmd"] == "2":
                 missile_vars = {}
-                for var in dict_format_obj.obj.obj.var:
-                    missile_vars[var.attrib["n"]] = var.text
+                for var in dict_format_obj.obj.obj.vars:
+                    missile_vars[var.n] = var.text
                 da[5] = missile_vars["tar"]
                 da[6] = missile_vars["px"]
                 da[7] = missile_vars["py"]
 
-            msg = "%xt%"
-            for item in da:
-                msg += f"{item}%"
-            users = d.rms[int(rm_vars["rm_id"])].users
-            for usr in users:
-                await users[usr].send(msg)
+            await d.rms[int(rm_vars["rm_id"])].broadcast(tpl.xt(da))
 
 
 def get_array_objects(dict_obj, xml_text):
@@ -850,11 +920,11 @@ def get_array_objects(dict_obj, xml_text):
     :return:
     """
     arrays = {}
-    if "array" in xml_text.lower():
-        for obj in dict_obj.obj.obj:
-            arrays[obj.attrib["o"]] = []
-            for var in obj.var:
-                arrays[obj.attrib["o"]].append(var.text)
+    if b"array" in xml_text.lower():
+        for obj in dict_obj.obj.objs:
+            arrays[obj.o] = []
+            for var in obj.vars:
+                arrays[obj.o].append(var.text)
     return arrays
 
 
@@ -865,8 +935,8 @@ def get_room_vars(obj):
     :return:
     """
     rm_vars = {}
-    for var in obj.var:
-        rm_vars[var.attrib["n"]] = var.text
+    for var in obj.vars:
+        rm_vars[var.n] = var.text
     return rm_vars
 
 
@@ -878,10 +948,10 @@ async def add_to_buddy_list(self, xml, user):
     :param user:
     :return:
     """
-    if self.database.get_user_info(xml.body.n.text) is not None:
-        self.database.add_buddy(user.name, xml.body.n.text)
-        msg = f"<msg t='sys'><body action='bAdd' r='-1'><b s='1' i='0'><n><![CDATA[{xml.body.n.text}]]></n></b></body></msg>"
-        await user.send(msg)
+    if await self.database.get_user_info(xml.body.n.text) is not None:
+        await self.database.add_buddy(user.name, xml.body.n.text)
+        presence.watch(user, xml.body.n.text)
+        await user.send(tpl.sys_msg("bAdd", -1, tpl.buddy(xml.body.n.text, True, 0)))
     else:
         log.error(f"User {user.name} not found in database!")
 
@@ -899,17 +969,65 @@ async def send_private_message(self, xml, user):
         target_user_id = xml.body.txt.attrib["rcp"]
         target_msg = msg_obj.split("!")[-1]
 
-        target_user = await d.find_user(user_id=int(target_user_id))
+        target_user = d.sessions.find(user_id=int(target_user_id))
+        if target_user is None and cluster.enabled:
+            # Delivered by the worker the user is connected to
+            cluster.publish(
+                "private_message",
+                {"to": int(target_user_id), "sender": user.name, "text": target_msg},
+            )
+            return
         if target_user is None:
             log.error("User not found in Rooms")
             return
         log.info(f"Private Message from {user.name} to {target_user.name}")
-        msg = f"<msg t='sys'><body action='prvMsg' r='{target_user.room}'><user id='{target_user.id}' /><txt><![CDATA[{user.name}!!&amp;&amp;!!{target_msg}]]></txt></body></msg>"
-        await target_user.send(msg)
+        await target_user.send(
+            tpl.private_message(
+                target_user.room, target_user.id, f"{user.name}!!&amp;&amp;!!{target_msg}"
+            )
+        )
     except Exception as e:
         log.error(f"Error: {e}")
 
 
+async def deliver_private_message(self, sender, data, fds):
+    """
+    Delivers a private message sent by a user on another worker.
+    :param self:
+    :param sender: worker that sent it.
+    :param data:
+    :param fds:
+    :return:
+    """
+    target_user = d.sessions.find(user_id=data["to"])
+    if target_user is None:
+        return
+    log.info(f"Private Message from {data['sender']} to {target_user.name}")
+    await target_user.send(
+        tpl.private_message(
+            target_user.room, target_user.id, f"{data['sender']}!!&amp;&amp;!!{data['text']}"
+        )
+    )
+
+
+async def remote_shut_down(self, sender, data, fds):
+    await shut_down(self, data["code"], data["msg"], data["sleep_time"])
+
+
+async def remote_hand_over(self, sender, data, fds):
+    if can_hand_over(self):
+        await handover.hand_over(self)
+    else:
+        await shut_down(self, 42, "Server is about to restart in 10s.", 10)
+
+
+# Messages from other workers mapped to their handling functions
+bus_handlers = {
+    "private_message": deliver_private_message,
+    "shut_down": remote_shut_down,
+    "hand_over": remote_hand_over,
+}
+
 # Dictionary of Client Commands mapped to their handling functions
 event_handlers = {
     "verChk": enable_communication,
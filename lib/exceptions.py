@@ -9,7 +9,20 @@ class UserNotFoundInRoom(Exception):
     pass
 
 
+class RoomNotFound(Exception):
+    pass
+
+
+class MalformedFrame(Exception):
+    pass
+
+
 class NewVarCase(Exception):
     def __init__(self, case):
         self.case = case
         log.error(f"Found a new var case.(%s)", case)
+
+
+class RoomOnOtherWorker(Exception):
+    def __init__(self, worker):
+        self.worker = worker
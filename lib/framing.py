@@ -0,0 +1,180 @@
+import asyncio
+from collections import deque
+
+from loguru import logger as log
+
+FRAME_DELIMITER = 0  # Frames sent by the flash client are terminated by a NUL byte
+READ_BUFFER_SIZE = 64 * 1024
+MAX_FRAME_SIZE = 1024 * 1024
+MAX_PENDING_FRAMES = 1024  # Stop reading from the socket while this many frames are unprocessed
+
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    """
+    Reads the NUL delimited client stream straight into a reusable buffer and splits it into frames.
+    The protocol is also the write side of the connection (write/drain/close) used by User.
+    """
+
+    def __init__(self, on_connect, received=b""):
+        """
+        :param on_connect: coroutine function started with the protocol once connected.
+        :param received: start of a frame already read, for a connection taken over from another worker.
+        """
+        self.on_connect = on_connect
+        self.transport = None
+        self.handler_task = None
+        self._buffer = bytearray(max(READ_BUFFER_SIZE, 2 * len(received)))
+        self._buffer[: len(received)] = received
+        self._view = memoryview(self._buffer)
+        self._start = 0  # Start of the frame currently being received
+        self._end = len(received)  # End of the received data
+        self._frames = deque()
+        self._frame_waiter = None
+        self._eof = False
+        self._reading_paused = False
+        self._writing_paused = False
+        self._drain_waiter = None
+
+    # Read side
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.handler_task = asyncio.create_task(self.on_connect(self))
+
+    def get_buffer(self, sizehint):
+        if self._end == len(self._buffer):
+            self._compact()
+        return self._view[self._end :]
+
+    def buffer_updated(self, nbytes):
+        buffer = self._buffer
+        scan_from = self._end
+        self._end += nbytes
+        pos = buffer.find(FRAME_DELIMITER, scan_from, self._end)
+        if pos == -1:
+            return
+        start = self._start
+        while pos != -1:
+            if pos > start:
+                self._frames.append(bytes(self._view[start:pos]))
+            start = pos + 1
+            pos = buffer.find(FRAME_DELIMITER, start, self._end)
+        if start == self._end:
+            self._start = self._end = 0
+        else:
+            self._start = start
+        self._wake_reader()
+        if len(self._frames) >= MAX_PENDING_FRAMES and not self._reading_paused:
+            self._reading_paused = True
+            self.transport.pause_reading()
+
+    def _compact(self):
+        """
+        Moves the partial frame to the front of the buffer, growing it when a single frame does not fit.
+        :return:
+        """
+        pending = self._end - self._start
+        if self._start == 0:
+            if pending >= MAX_FRAME_SIZE:
+                log.warning(
+                    f"Frame larger than {MAX_FRAME_SIZE} bytes from {self.get_extra_info('peername')}"
+                )
+                self.transport.abort()
+                self._start = self._end = 0
+                return
+            self._view.release()
+            self._buffer.extend(bytes(len(self._buffer)))
+            self._view = memoryview(self._buffer)
+            return
+        self._buffer[:pending] = self._view[self._start : self._end]
+        self._start, self._end = 0, pending
+
+    def eof_received(self):
+        self._eof = True
+        self._wake_reader()
+        return False
+
+    def connection_lost(self, exc):
+        self._eof = True
+        self._wake_reader()
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    def _wake_reader(self):
+        waiter = self._frame_waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def read_frames(self):
+        """
+        Waits for data and returns every complete frame received so far, None once the client has gone.
+        :return:
+        """
+        while not self._frames:
+            if self._eof:
+                return None
+            self._frame_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._frame_waiter
+            finally:
+                self._frame_waiter = None
+        frames = list(self._frames)
+        self._frames.clear()
+        if self._reading_paused and not self._eof:
+            self._reading_paused = False
+            self.transport.resume_reading()
+        return frames
+
+    def detach(self):
+        """
+        Stops reading and returns what was received but not handed out by read_frames yet:
+        the complete frames and the start of the next one. A reader waiting for frames gets None.
+        The socket stays open, so it can be passed to another process.
+        :return: (frames, partial frame)
+        """
+        self.transport.pause_reading()
+        self._reading_paused = True
+        self._eof = True
+        self._wake_reader()
+        frames = list(self._frames)
+        self._frames.clear()
+        partial = bytes(self._view[self._start : self._end])
+        self._start = self._end = 0
+        return frames, partial
+
+    # Write side
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    def write(self, data: bytes):
+        self.transport.write(data)
+
+    async def drain(self):
+        """
+        Waits until the transport buffer is below its high-water mark.
+        :return:
+        """
+        if self.transport.is_closing():
+            raise ConnectionResetError("Connection lost")
+        if not self._writing_paused:
+            return
+        self._drain_waiter = asyncio.get_running_loop().create_future()
+        try:
+            await self._drain_waiter
+        finally:
+            self._drain_waiter = None
+
+    def is_closing(self) -> bool:
+        return self.transport.is_closing()
+
+    def close(self):
+        self.transport.close()
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
@@ -0,0 +1,229 @@
+import asyncio
+import json
+import os
+import socket
+from contextlib import suppress
+from functools import partial
+from types import SimpleNamespace
+
+from loguru import logger as log
+
+import lib.definitions as d
+from lib import logs, metrics
+from lib.cluster import cluster
+from lib.config import get_config
+from lib.framing import FrameProtocol
+from lib.notifications import notifier
+from lib.presence import presence
+from lib.supervisor import HANDED_OVER, RESTART
+
+# Load Configuration
+config = get_config()
+
+MAX_FDS = 250  # File descriptors per message, below the kernel's SCM_MAX_FD
+CHUNK_SIZE = 64 * 1024  # Bytes of state per message
+ROOM_EXCLUDED = ("users", "lock", "remote_users")  # Room attributes rebuilt by the successor
+
+
+def path(worker: int) -> str:
+    return os.path.join(config["workers"]["socket_dir"], f"handover-{worker}.sock")
+
+
+def room_snapshot(room) -> dict:
+    state = {key: value for key, value in vars(room).items() if key not in ROOM_EXCLUDED}
+    state["remote_users"] = [vars(member) for member in room.remote_users.values()]
+    return state
+
+
+async def hand_over(server) -> bool:
+    """
+    Restarts this worker without dropping anyone: the launcher starts a successor, which connects to
+    this worker's handover socket and receives the listening socket, the bus socket, every client
+    connection and the room and session state. This worker then exits with HANDED_OVER.
+    When no successor connects in time the worker carries on serving. Once it stopped serving there is
+    no way back: a transfer that fails exits with RESTART and the players reconnect to a fresh process.
+    :param server:
+    :return: False when the worker is still serving.
+    """
+    loop = asyncio.get_running_loop()
+    location = path(cluster.worker)
+    os.makedirs(os.path.dirname(location), exist_ok=True)
+    with suppress(FileNotFoundError):
+        os.unlink(location)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    listener.bind(location)
+    listener.listen(1)
+    listener.setblocking(False)
+    if server.metrics_server is not None:
+        server.metrics_server.close()  # The successor binds the metrics port
+    server.control.send({"type": "successor", "worker": cluster.worker})
+    log.info(f"Worker {cluster.worker} waiting for its successor on {location}")
+    try:
+        conn, _ = await asyncio.wait_for(
+            loop.sock_accept(listener), float(config["restart"]["timeout_s"])
+        )
+    except TimeoutError:
+        log.error(f"No successor for worker {cluster.worker} connected, carrying on")
+        await server.serve_metrics()
+        return False
+    finally:
+        listener.close()
+        with suppress(FileNotFoundError):
+            os.unlink(location)
+
+    try:
+        with conn:
+            state, fds = await freeze(server)
+            conn.setblocking(True)
+            try:
+                await asyncio.to_thread(_send, conn, json.dumps(state, default=str).encode(), fds)
+            finally:
+                for fd in fds:
+                    os.close(fd)
+    except Exception:
+        # The listener is closed and the connections are detached, this worker can't serve anymore
+        log.exception(f"Worker {cluster.worker} failed to hand over, restarting")
+        code = RESTART
+    else:
+        log.info(f"Worker {cluster.worker} handed {len(state['users'])} connections to its successor")
+        code = HANDED_OVER
+    for usr in list(d.sessions):
+        # Closes this process's descriptors, after a failed transfer the players reconnect
+        usr.connection.transport.abort()
+    server.stopped.set_result(code)
+    return True
+
+
+async def freeze(server):
+    """
+    Stops serving and captures everything the successor needs.
+    Accepting stops first, then reading: the frames each connection received but did not process
+    travel with it, in order, while whatever was queued for the clients is written before the sockets change hands.
+    :param server:
+    :return: (state, file descriptors), duplicates owned by the caller.
+    """
+    listening = server.listener.sockets[0]
+    fds = [os.dup(listening.fileno())]
+    server.listener.close()
+    server.stopping = True
+    detached = {usr: usr.connection.detach() for usr in list(d.sessions)}
+    current = asyncio.current_task()
+    handlers = [
+        usr.connection.handler_task
+        for usr in detached
+        if usr.connection.handler_task not in (None, current)
+    ]
+    if handlers:
+        # Handlers finish the frame they are on and set the rest of their batch aside
+        await asyncio.wait(handlers, timeout=5)
+    # Room list and buddy updates queued by the last handlers go out before the writers stop
+    await notifier.flush()
+    await presence.flush()
+    await asyncio.gather(*(usr.drain_outbound() for usr in detached))
+    for usr in detached:
+        usr.stop_writer()
+    await server.database.flush()
+
+    bus_fd = server.bus.detach()
+    if bus_fd is not None:
+        fds.append(bus_fd)
+    users = []
+    for usr, (queued, partial_frame) in detached.items():
+        frames = server.unprocessed.pop(usr, []) + queued
+        users.append(
+            {
+                "user": usr.state(),
+                "frames": [frame.decode("latin-1") for frame in frames],
+                "partial": partial_frame.decode("latin-1"),
+                "resume": True,
+                "fd": len(fds),
+            }
+        )
+        fds.append(os.dup(usr.connection.get_extra_info("socket").fileno()))
+    state = {
+        "listener": 0,
+        "bus": 1 if bus_fd is not None else None,
+        "counter": d.counter,
+        "rooms": [room_snapshot(room) for room in d.rms.values()],
+        "users": users,
+        "ids": sorted(server.ids.issued),
+        "presence": presence.remote,
+    }
+    return state, fds
+
+
+def _send(conn, state: bytes, fds):
+    conn.send(json.dumps({"fds": len(fds), "bytes": len(state)}).encode())
+    for start in range(0, len(fds), MAX_FDS):
+        socket.send_fds(conn, [b"f"], fds[start : start + MAX_FDS])
+    for start in range(0, len(state), CHUNK_SIZE):
+        conn.send(state[start : start + CHUNK_SIZE])
+
+
+def receive(worker: int, timeout: float):
+    """
+    Connects to the worker being replaced and receives its state and file descriptors.
+    Blocks, it runs before the successor starts serving.
+    :param worker:
+    :param timeout:
+    :return: (state, fds)
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET) as conn:
+        conn.settimeout(timeout)
+        conn.connect(path(worker))
+        header = json.loads(conn.recv(4096))
+        fds = []
+        while len(fds) < header["fds"]:
+            _, received, flags, _ = socket.recv_fds(conn, 16, MAX_FDS)
+            fds.extend(received)
+            if flags & socket.MSG_CTRUNC or not received:
+                for fd in fds:
+                    os.close(fd)
+                raise ConnectionError("file descriptors lost in transit")
+        chunks = []
+        size = 0
+        while size < header["bytes"]:
+            chunk = conn.recv(CHUNK_SIZE)
+            if not chunk:
+                raise ConnectionError("predecessor went away")
+            chunks.append(chunk)
+            size += len(chunk)
+    return json.loads(b"".join(chunks)), fds
+
+
+async def restore(server, state: dict, fds):
+    """
+    Rebuilds the rooms and connections of the predecessor. Rooms come back empty and every user
+    rejoins its room as its connection is set up, frames are processed once all of them are back.
+    :param server:
+    :param state:
+    :param fds:
+    :return:
+    """
+    loop = asyncio.get_running_loop()
+    d.counter = state["counter"]
+    for room_state in state["rooms"]:
+        room = d.rms.get(room_state["id"])
+        if room is None:
+            room = d.Room(room_state["name"], room_state["id"])
+        for key, value in room_state.items():
+            setattr(room, key, value)
+        room.remote_users = {
+            member["id"]: SimpleNamespace(**member) for member in room_state["remote_users"]
+        }
+        if not room.remote:
+            room.ucnt = len(room.remote_users)  # Local users are counted again as they rejoin
+        d.rms[room.id] = room
+        d.room_list.touch(room.id)
+    presence.remote = {key: tuple(value) for key, value in state["presence"].items()}
+    for entry in state["users"]:
+        sock = socket.socket(fileno=fds[entry["fd"]])
+        received = entry["partial"].encode("latin-1")
+        await loop.connect_accepted_socket(
+            partial(FrameProtocol, partial(server.handle, handoff=entry), received), sock
+        )
+    server.restored.set()
+    metrics.handoffs.inc(amount=len(state["users"]))
+    logs.rooms.log.info(
+        "Resumed {} rooms and {} connections", len(state["rooms"]), len(state["users"])
+    )
@@ -0,0 +1,77 @@
+import sys
+from random import random
+
+from loguru import logger as log
+
+FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | "
+    "{extra[category]: <8} | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - "
+    "<level>{message}</level>"
+)
+DEFAULT_CATEGORY = "server"
+
+
+class Category:
+    """
+    Logger bound to a category with its own level.
+    Hot paths check `debug_enabled`/`info_enabled` (plain attributes) or `should_trace()`
+    before building a message, so a disabled category costs one attribute lookup.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.log = log.bind(category=name)
+        self.sample_rate = 1.0
+        self.set_level("INFO")
+
+    def set_level(self, level: str):
+        self.level_no = log.level(level.upper()).no
+        self.debug_enabled = self.level_no <= log.level("DEBUG").no
+        self.info_enabled = self.level_no <= log.level("INFO").no
+
+    def should_trace(self) -> bool:
+        """
+        True when a per-frame debug trace should be written, applying the sample rate.
+        :return:
+        """
+        return self.debug_enabled and (self.sample_rate >= 1 or random() < self.sample_rate)
+
+
+protocol = Category("protocol")  # Frames in and out, very high volume
+rooms = Category("rooms")  # Joins, room lifecycle, games
+db = Category("db")
+discord = Category("discord")
+categories = {c.name: c for c in (protocol, rooms, db, discord)}
+
+_default_level = log.level("INFO").no
+
+
+def _filter(record) -> bool:
+    category = categories.get(record["extra"].get("category"))
+    minimum = category.level_no if category is not None else _default_level
+    return record["level"].no >= minimum
+
+
+def setup(config: dict):
+    """
+    Replaces the default sink with a queued one honouring per-category levels from [logging].
+    Records are handed to a background thread, so writing them never blocks the event loop.
+    :param config:
+    :return:
+    """
+    global _default_level
+    settings = config["logging"]
+    _default_level = log.level(settings["level"].upper()).no
+    for name, category in categories.items():
+        category.set_level(settings.get(name, settings["level"]))
+    protocol.sample_rate = float(settings.get("protocol_sample_rate", 1))
+
+    log.remove()
+    log.configure(extra={"category": DEFAULT_CATEGORY})
+    log.add(
+        sys.stderr,
+        level=min([_default_level] + [c.level_no for c in categories.values()]),
+        format=FORMAT,
+        filter=_filter,
+        enqueue=True,
+    )
@@ -0,0 +1,276 @@
+import asyncio
+from bisect import bisect_left
+from time import perf_counter
+
+from loguru import logger as log
+
+# Seconds, from a fast relay up to a handler that stalls the loop
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+)
+PREFIX = "colony_"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(names, values, extra="") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """
+    Monotonic count, optionally split by label values.
+    """
+
+    type = "counter"
+
+    def __init__(self, name, help_, labels=()):
+        self.name = PREFIX + name
+        self.help = help_
+        self.labels = labels
+        self.values = {}  # Label values tuple -> count
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        for label_values, value in self.values.items():
+            yield f"{self.name}{_label_text(self.labels, label_values)} {value}"
+
+
+class Histogram:
+    """
+    Cumulative bucketed distribution with sum and count, optionally split by label values.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help_, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = PREFIX + name
+        self.help = help_
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # Label values tuple -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, *label_values):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *label_values):
+        """
+        Context manager observing the duration of its block.
+        """
+        return _Timer(self, label_values)
+
+    def render(self):
+        for label_values, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = _label_text(self.labels, label_values, f'le="{bound}"')
+                yield f"{self.name}_bucket{le} {cumulative}"
+            cumulative += series[len(self.buckets)]
+            le = _label_text(self.labels, label_values, 'le="+Inf"')
+            yield f"{self.name}_bucket{le} {cumulative}"
+            labels = _label_text(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {series[-1]}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class _Timer:
+    __slots__ = ("histogram", "label_values", "started")
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(perf_counter() - self.started, *self.label_values)
+
+
+class Collected:
+    """
+    Metric read from the server state at scrape time, `collect` returns a value or
+    a dict of label values tuple -> value.
+    """
+
+    def __init__(self, name, help_, collect, type_="gauge", labels=()):
+        self.name = PREFIX + name
+        self.help = help_
+        self.collect = collect
+        self.type = type_
+        self.labels = labels
+
+    def render(self):
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            yield f"{self.name}{_label_text(self.labels, label_values)} {value}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_, labels=()):
+        return self.add(Counter(name, help_, labels))
+
+    def histogram(self, name, help_, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help_, labels, buckets))
+
+    def collected(self, name, help_, collect, type_="gauge", labels=()):
+        return self.add(Collected(name, help_, collect, type_, labels))
+
+    def render(self) -> str:
+        """
+        Renders every metric in the Prometheus text exposition format.
+        :return:
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                log.error(f"Failed to collect {metric.name} ({e})")
+        return "\n".join(lines) + "\n"
+
+
+class TimedLock(asyncio.Lock):
+    """
+    asyncio.Lock that records how long each acquire waited.
+    """
+
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+
+    async def acquire(self):
+        started = perf_counter()
+        result = await super().acquire()
+        lock_wait.observe(perf_counter() - started, self.name)
+        return result
+
+
+registry = Registry()
+
+handler_calls = registry.counter(
+    "handler_calls_total", "Handled messages by action.", ("action",)
+)
+handler_errors = registry.counter(
+    "handler_errors_total", "Messages whose handler raised, by action.", ("action",)
+)
+handler_seconds = registry.histogram(
+    "handler_seconds", "Time spent in message handlers by action.", ("action",)
+)
+inbound_frames = registry.counter("inbound_frames_total", "Frames received from clients.")
+inbound_bytes = registry.counter(
+    "inbound_bytes_total", "Bytes of frames received from clients."
+)
+outbound_frames = registry.counter("outbound_frames_total", "Frames written to clients.")
+outbound_bytes = registry.counter("outbound_bytes_total", "Bytes written to clients.")
+outbound_writes = registry.counter(
+    "outbound_writes_total", "Socket writes, each may carry several frames."
+)
+outbound_dropped = registry.counter(
+    "outbound_dropped_total", "Frames dropped because a queue was full."
+)
+evictions = registry.counter(
+    "evictions_total", "Clients disconnected because their queue was full."
+)
+lock_wait = registry.histogram(
+    "lock_wait_seconds", "Time spent waiting for a lock.", ("lock",)
+)
+db_query_seconds = registry.histogram(
+    "db_query_seconds", "Time spent running database queries.", ("query",)
+)
+db_queue_seconds = registry.histogram(
+    "db_queue_seconds", "Time database queries waited for the database thread.", ("query",)
+)
+db_commit_seconds = registry.histogram(
+    "db_commit_seconds", "Latency of batched commits."
+)
+db_commit_writes = registry.histogram(
+    "db_commit_writes",
+    "Writes per batched commit.",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500),
+)
+bus_messages = registry.counter(
+    "bus_messages_total", "Messages exchanged with other workers by topic.", ("topic", "direction")
+)
+bus_dropped = registry.counter(
+    "bus_dropped_total", "Messages for other workers that could not be delivered.", ("topic",)
+)
+handoffs = registry.counter(
+    "handoffs_total", "Connections passed to the worker owning the room they joined."
+)
+discord_joins_dropped = registry.counter(
+    "discord_joins_dropped_total",
+    "Lobby joins not passed to the discord bot, which was not keeping up.",
+)
+
+
+async def _handle_scrape(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        if request.split(b" ")[1:2] == [b"/metrics"]:
+            body = registry.render().encode()
+            status = b"200 OK"
+        else:
+            body = b"Not found\n"
+            status = b"404 Not Found"
+        writer.write(
+            b"HTTP/1.1 " + status + b"\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body
+        )
+        await writer.drain()
+    except (ConnectionError, IndexError) as e:
+        log.debug(f"Metrics scrape failed ({e})")
+    finally:
+        writer.close()
+
+
+async def serve(address, port):
+    """
+    Serves the registry at http://address:port/metrics.
+    :param address:
+    :param port:
+    :return:
+    """
+    server = await asyncio.start_server(_handle_scrape, address, port)
+    host, port = server.sockets[0].getsockname()[:2]
+    log.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
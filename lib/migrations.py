@@ -0,0 +1,77 @@
+from lib import logs
+
+
+def create_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE,
+            password TEXT,
+            games_played INTEGER DEFAULT 0,
+            games_won INTEGER DEFAULT 0,
+            consecutive_wins INTEGER DEFAULT 0,
+            rank INTEGER DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS buddies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            buddy_id INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (buddy_id) REFERENCES users(id)
+        )
+    """)
+
+
+def index_buddies(conn):
+    """
+    Drops duplicated buddy rows, keeping the oldest, then makes (user_id, buddy_id) unique.
+    The unique index also serves lookups by user_id, buddy_id gets its own for deletes.
+    :param conn:
+    :return:
+    """
+    removed = conn.execute("""
+        DELETE FROM buddies WHERE id NOT IN (
+            SELECT MIN(id) FROM buddies GROUP BY user_id, buddy_id
+        )
+    """).rowcount
+    if removed:
+        logs.db.log.info(f"Removed {removed} duplicated buddy rows")
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS buddies_user_buddy ON buddies (user_id, buddy_id)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS buddies_buddy ON buddies (buddy_id)")
+
+
+# Append only, the position of a migration is the schema version it upgrades to.
+MIGRATIONS = [create_tables, index_buddies]
+
+
+def migrate(conn):
+    """
+    Brings the schema up to date, each migration runs in its own transaction together with
+    the bump of PRAGMA user_version, so an interrupted upgrade resumes where it stopped.
+    The version is read inside a write transaction, so workers starting together migrate once.
+    :param conn:
+    :return:
+    """
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version > len(MIGRATIONS):
+                raise RuntimeError(
+                    f"Database schema version {version} is newer than this server ({len(MIGRATIONS)})"
+                )
+            if version == len(MIGRATIONS):
+                conn.rollback()
+                return
+            migration = MIGRATIONS[version]
+            logs.db.log.info(f"Migrating database to version {version + 1} ({migration.__name__})")
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
@@ -0,0 +1,215 @@
+import asyncio
+from types import SimpleNamespace
+
+import lib.definitions as d
+from lib import logs
+from lib import templates as tpl
+from lib.cluster import SHARED_ROOMS, cluster
+
+LOBBY_ID = 1  # Lobby members see the room list, so they follow every room's lifecycle
+ROOM_FIELDS = ("name", "priv", "temp", "game", "ucnt", "maxu", "maxs")  # Shown in the room list
+
+
+class Notifier:
+    """
+    Collects room lifecycle and user count changes made while handling a message and
+    delivers them once the handler has yielded, outside of any lock, to the users that show them.
+    Only the latest count per room is sent, and each subscriber gets all its frames in one write.
+
+    With several workers, changes to the rooms this worker owns are published too, and the other
+    workers keep a remote Room per owned room so their lobby members see it in the room list.
+    The shared rooms exist on every worker, each one mirrors the members connected to the others
+    so user lists and counts cover all of them.
+    """
+
+    def __init__(self):
+        self._deleted = []
+        self._counts = {}  # Room id -> latest user count
+        self._flush_task = None
+        cluster.subscribe("rooms", self._on_rooms)
+        cluster.subscribe("members", self._on_members)
+        cluster.subscribe("hello", self._on_hello)
+        cluster.subscribe("hello", self._on_hello_members)
+
+    def room_deleted(self, room_id: int):
+        """
+        Queues a roomDel for lobby members.
+        :param room_id:
+        :return:
+        """
+        self._deleted.append(room_id)
+        self._counts.pop(room_id, None)
+        self._schedule()
+
+    def user_count(self, room):
+        """
+        Queues a uCount for the room's members and lobby members.
+        :param room:
+        :return:
+        """
+        self._counts[room.id] = room.ucnt
+        self._schedule()
+
+    def _schedule(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        """
+        Sends the pending notifications, one batched payload per subscriber.
+        :return:
+        """
+        await asyncio.sleep(0)  # Let the handler that queued the changes finish its step
+        self._flush_task = None
+        deleted, self._deleted = self._deleted, []
+        counts, self._counts = self._counts, {}
+        if cluster.enabled:
+            self._publish(counts, deleted)
+
+        lobby = d.rms.get(LOBBY_ID)
+        lobby_users = list(lobby.users.values()) if lobby is not None else []
+        outgoing = {}  # User -> list of encoded frames
+
+        for room_id in deleted:
+            frame = d.User.clean(tpl.room_deleted(room_id))
+            for usr in lobby_users:
+                outgoing.setdefault(usr, []).append(frame)
+
+        for room_id, count in counts.items():
+            frame = d.User.clean(tpl.user_count(room_id, count))
+            room = d.rms.get(room_id)
+            members = list(room.users.values()) if room is not None else []
+            subscribers = members if room_id == LOBBY_ID else members + lobby_users
+            for usr in subscribers:
+                outgoing.setdefault(usr, []).append(frame)
+
+        if not outgoing:
+            return
+        if logs.rooms.debug_enabled:
+            logs.rooms.log.debug(
+                f"Notifying {len(outgoing)} users of {len(deleted)} removed rooms and {len(counts)} counts"
+            )
+        await asyncio.gather(
+            *[usr.send_bytes(b"".join(frames)) for usr, frames in outgoing.items()],
+            return_exceptions=True,
+        )
+
+    def _publish(self, counts, deleted):
+        owned = [
+            d.rms[room_id]
+            for room_id in counts
+            if room_id in d.rms and cluster.owner(room_id) == cluster.worker
+        ]
+        removed = [room_id for room_id in deleted if cluster.owner(room_id) == cluster.worker]
+        if owned or removed:
+            cluster.publish(
+                "rooms", {"rooms": [room_state(room) for room in owned], "deleted": removed}
+            )
+
+    def _on_rooms(self, sender, data, fds):
+        """
+        Applies another worker's room changes to the remote rooms and notifies the lobby.
+        :param sender:
+        :param data:
+        :param fds:
+        :return:
+        """
+        for state in data["rooms"]:
+            room = d.rms.get(state["id"])
+            if room is None:
+                room = d.rms[state["id"]] = d.Room(state["name"], state["id"])
+                room.remote = True
+            elif not room.remote:
+                continue
+            for field in ROOM_FIELDS:
+                setattr(room, field, state[field])
+            d.room_list.touch(room.id)
+            self.user_count(room)
+        for room_id in data["deleted"]:
+            self._drop_remote(room_id)
+
+    def _on_hello(self, sender, data, fds):
+        """
+        A worker (re)started: forget the rooms it had and send it the rooms owned here.
+        :param sender:
+        :param data:
+        :param fds:
+        :return:
+        """
+        for room_id in [r for r in d.rms if d.rms[r].remote and cluster.owner(r) == sender]:
+            self._drop_remote(room_id)
+        owned = [room for room in d.rms.values() if cluster.owner(room.id) == cluster.worker]
+        if owned:
+            cluster.send(
+                sender, "rooms", {"rooms": [room_state(room) for room in owned], "deleted": []}
+            )
+
+    def _on_members(self, sender, data, fds):
+        """
+        Mirrors the users that joined or left a shared room on another worker.
+        A user moving between workers can be announced by its new worker before its old one
+        reports it left, so only the worker a member is known on can remove it.
+        :param sender:
+        :param data:
+        :param fds:
+        :return:
+        """
+        room = d.rms.get(data["room"])
+        if room is None or room.id not in SHARED_ROOMS:
+            return
+        for state in data["entered"]:
+            if state["id"] in room.users:
+                continue  # Already moved here
+            if state["id"] not in room.remote_users:
+                room.ucnt += 1
+            room.remote_users[state["id"]] = SimpleNamespace(worker=sender, **state)
+        for user_id in data["left"]:
+            member = room.remote_users.get(user_id)
+            if member is not None and member.worker == sender:
+                del room.remote_users[user_id]
+                room.ucnt -= 1
+        d.room_list.touch(room.id)
+        self.user_count(room)
+
+    async def _on_hello_members(self, sender, data, fds):
+        """
+        A worker (re)started: its members of the shared rooms are gone, and it needs the ones here.
+        :param sender:
+        :param data:
+        :param fds:
+        :return:
+        """
+        for room_id in SHARED_ROOMS:
+            room = d.rms.get(room_id)
+            if room is None:
+                continue
+            gone = [m.id for m in room.remote_users.values() if m.worker == sender]
+            for user_id in gone:
+                del room.remote_users[user_id]
+                room.ucnt -= 1
+                await room.deliver(d.User.clean(tpl.user_gone(room.id, user_id)))
+            if gone:
+                d.room_list.touch(room.id)
+                self.user_count(room)
+            if room.users:
+                members = [
+                    {field: getattr(usr, field) for field in d.MEMBER_FIELDS}
+                    for usr in room.users.values()
+                ]
+                cluster.send(sender, "members", {"room": room.id, "entered": members, "left": []})
+
+    def _drop_remote(self, room_id):
+        room = d.rms.get(room_id)
+        if room is not None and room.remote:
+            del d.rms[room_id]
+            d.room_list.touch(room_id)
+            self.room_deleted(room_id)
+
+
+def room_state(room) -> dict:
+    state = {field: getattr(room, field) for field in ROOM_FIELDS}
+    state["id"] = room.id
+    return state
+
+
+notifier = Notifier()
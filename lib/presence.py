@@ -0,0 +1,182 @@
+import asyncio
+
+import lib.definitions as d
+from lib import logs
+from lib import templates as tpl
+from lib.cluster import cluster
+
+
+class Presence:
+    """
+    Reverse buddy index: for every name, the online users that have it on their buddy list.
+    Status changes fan out to those watchers only, and all updates a watcher collects while a
+    handler runs are delivered in a single send.
+
+    With several workers, status changes are also published to the other workers, which notify
+    their own watchers and remember who is online elsewhere for buddy lists.
+    """
+
+    def __init__(self):
+        self.watchers = {}  # Lower-cased name -> users watching it
+        self.watching = {}  # User -> lower-cased names it watches
+        self.remote = {}  # Lower-cased name -> (name, user id, worker) of users online on other workers
+        self._pending = {}  # Lower-cased name -> latest bUpd frame
+        self._changes = {}  # Name -> user id, None when offline, for the other workers
+        self._flush_task = None
+        cluster.subscribe("presence", self._on_presence)
+        cluster.subscribe("hello", self._on_hello)
+
+    def subscribe(self, user, buddy_names):
+        """
+        Registers an online user as a watcher of every name on its buddy list.
+        :param user:
+        :param buddy_names:
+        :return:
+        """
+        for name in buddy_names:
+            self.watch(user, name)
+
+    def watch(self, user, buddy_name):
+        """
+        Registers an online user as a watcher of a single name.
+        :param user:
+        :param buddy_name:
+        :return:
+        """
+        key = buddy_name.lower()
+        self.watchers.setdefault(key, set()).add(user)
+        self.watching.setdefault(user, set()).add(key)
+
+    def unsubscribe(self, user):
+        """
+        Drops every watch held by a user that went offline.
+        :param user:
+        :return:
+        """
+        for key in self.watching.pop(user, ()):
+            watchers = self.watchers.get(key)
+            if watchers is not None:
+                watchers.discard(user)
+                if not watchers:
+                    del self.watchers[key]
+
+    def online(self, user):
+        """
+        Queues a bUpd telling the user's watchers it came online.
+        :param user:
+        :return:
+        """
+        self._changed(user.name, user.id)
+
+    def offline(self, user):
+        """
+        Queues a bUpd telling the user's watchers it went offline,
+        unless another session is still logged in under the same name.
+        :param user:
+        :return:
+        """
+        session = d.sessions.find(name=user.name)
+        if session is not None and session is not user:
+            return
+        self._changed(user.name, None)
+
+    def find(self, name):
+        """
+        Id of the user logged in under a name on any worker, None when offline.
+        :param name:
+        :return:
+        """
+        session = d.sessions.find(name=name)
+        if session is not None:
+            return session.id
+        remote = self.remote.get(str(name).lower())
+        return remote[1] if remote is not None else None
+
+    def _changed(self, name, user_id):
+        self.remote.pop(name.lower(), None)
+        if cluster.enabled:
+            self._changes[name] = user_id
+            self._schedule()
+        self._publish(name, user_id)
+
+    def _publish(self, name, user_id):
+        key = name.lower()
+        if key not in self.watchers:
+            return
+        if user_id is None:
+            frame = d.User.clean(tpl.buddy_update(name, False))
+        else:
+            frame = d.User.clean(tpl.buddy_update(name, True, user_id))
+        self._pending[key] = frame
+        self._schedule()
+
+    def _schedule(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self.flush())
+
+    def _on_presence(self, sender, data, fds):
+        """
+        Notifies the watchers on this worker of status changes on another one.
+        :param sender:
+        :param data:
+        :param fds:
+        :return:
+        """
+        for name, user_id in data["changes"].items():
+            key = name.lower()
+            if user_id is not None:
+                self.remote[key] = (name, user_id, sender)
+            elif self.remote.get(key, (None, None, sender))[2] == sender:
+                self.remote.pop(key, None)
+                if d.sessions.find(name=name) is not None:
+                    continue  # Still online here
+            else:
+                continue  # Went offline on a worker it had already left
+            self._publish(name, user_id)
+
+    def _on_hello(self, sender, data, fds):
+        """
+        A worker (re)started: its users are gone, and it needs to know who is online here.
+        :param sender:
+        :param data:
+        :param fds:
+        :return:
+        """
+        for key, (name, _, worker) in list(self.remote.items()):
+            if worker == sender:
+                del self.remote[key]
+                self._publish(name, None)
+        online = {usr.name: usr.id for usr in d.sessions if usr.name and "guest_" not in usr.name}
+        if online:
+            cluster.send(sender, "presence", {"changes": online})
+
+    async def flush(self):
+        """
+        Sends the pending status changes, one payload per watcher.
+        :return:
+        """
+        await asyncio.sleep(0)  # Let the handler that queued the changes finish its step
+        self._flush_task = None
+        pending, self._pending = self._pending, {}
+        changes, self._changes = self._changes, {}
+        if changes:
+            cluster.publish("presence", {"changes": changes})
+
+        outgoing = {}  # User -> list of encoded frames
+        for key, frame in pending.items():
+            for watcher in self.watchers.get(key, ()):
+                outgoing.setdefault(watcher, []).append(frame)
+
+        if not outgoing:
+            return
+        if logs.rooms.debug_enabled:
+            logs.rooms.log.debug(
+                f"Sending {len(pending)} presence changes to {len(outgoing)} watchers"
+            )
+        await asyncio.gather(
+            *[usr.send_bytes(b"".join(frames)) for usr, frames in outgoing.items()],
+            return_exceptions=True,
+        )
+
+
+presence = Presence()
@@ -0,0 +1,106 @@
+import asyncio
+import os
+import sys
+import threading
+from collections import Counter
+from time import perf_counter, sleep, strftime
+
+from loguru import logger as log
+
+
+def _frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread at a fixed interval from a background thread.
+    Stacks are counted in collapsed form (outermost;...;innermost), which flamegraph.pl and speedscope read directly.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()  # Collapsed stack -> samples
+        self.samples = 0
+        self.idle = 0  # Samples where the loop was waiting in the selector
+
+    def run(self, seconds: float):
+        """
+        Samples for the given duration, blocking the calling thread.
+        :param seconds:
+        :return:
+        """
+        deadline = perf_counter() + seconds
+        while perf_counter() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None and frame.f_code.co_filename.endswith("selectors.py"):
+                self.idle += 1
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+                self.samples += 1
+            sleep(self.interval)
+
+    def write_collapsed(self, path: str):
+        """
+        Writes the samples in collapsed stack format.
+        :param path:
+        :return:
+        """
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def top(self, count=5):
+        """
+        Functions with the most samples, as (name, self share, total share), leaving out the idle selector.
+        Self counts samples where the function was running, total those where it was on the stack.
+        :param count:
+        :return:
+        """
+        own = Counter()
+        total = Counter()
+        for stack, samples in self.stacks.items():
+            frames = stack.split(";")
+            if "selectors.py" in frames[-1]:
+                continue
+            own[frames[-1]] += samples
+            for name in set(frames):
+                total[name] += samples
+        if not self.samples:
+            return []
+        return [
+            (name, samples / self.samples, total[name] / self.samples)
+            for name, samples in own.most_common(count)
+        ]
+
+
+_running = threading.Lock()  # One profile at a time
+
+
+async def profile(seconds: float, directory: str, interval: float):
+    """
+    Profiles the event loop thread while the server keeps running and writes a collapsed stack file.
+    Returns the file path and the profiler, or None when a profile is already running.
+    :param seconds:
+    :param directory:
+    :param interval:
+    :return:
+    """
+    if not _running.acquire(blocking=False):
+        return None
+    try:
+        profiler = SamplingProfiler(threading.get_ident(), interval)
+        log.info(f"Profiling the event loop for {seconds}s")
+        await asyncio.to_thread(profiler.run, seconds)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"profile-{strftime('%Y%m%d-%H%M%S')}.collapsed")
+        await asyncio.to_thread(profiler.write_collapsed, path)
+        log.info(f"Wrote {profiler.samples} samples to {path}")
+        return path, profiler
+    finally:
+        _running.release()
@@ -0,0 +1,256 @@
+from charset_normalizer import from_bytes
+from loguru import logger as log
+from lxml import etree, objectify
+
+from lib.exceptions import MalformedFrame
+
+CDATA_OPEN = b"<![CDATA["
+CDATA_CLOSE = b"]]>"
+
+
+def append_new_line(file_name: str, text_to_append: str) -> None:
+    """Append given text as a new line at the end of file"""
+    # Open the file in append & read mode ('a+')
+    with open(file_name, "a+") as file_object:
+        # Move read cursor to the start of file.
+        file_object.seek(0)
+        # If file is not empty then append '\n'
+        data = file_object.read(100)
+        if len(data) > 0:
+            file_object.write("\n")
+        # Append text at the end of file
+        file_object.write(text_to_append)
+
+
+def decode_message(data: bytes) -> str:
+    """
+    Decodes a frame that lxml could not read as UTF-8, falling back to charset detection.
+    :param data:
+    :return:
+    """
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        try:
+            log.warning("Using fallback")
+            message = str(from_bytes(data).best())
+            log.warning(f"Decode failed on : {message}")
+            # Write the failed data into file for analysis later on.
+            append_new_line("unparsed.log", str(data))
+            return message
+        except Exception:
+            return ""
+
+
+def parse_xml(message: bytes):
+    """
+    Convert xml to a dictionary like object from a raw frame, only decoding it in Python if lxml can't.
+    :param message:
+    :return:
+    """
+    try:
+        return objectify.fromstring(message)
+    except etree.XMLSyntaxError:
+        try:
+            return objectify.fromstring(decode_message(message))
+        except Exception as e:
+            log.error(f"Parse Error Occurred! ({e}) ({message})")
+    except Exception as e:
+        log.error(
+            f"Parse Error Occurred! ({e}) (message)",
+        )
+
+
+class Var:
+    """
+    A <var n='' t=''>text</var> entry of a dataObj.
+    """
+
+    __slots__ = ("n", "t", "text", "vars")
+
+    def __init__(self, n, t, text, vars_=None):
+        self.n = n
+        self.t = t
+        self.text = text
+        self.vars = vars_ or []  # Nested vars, only present on odd payloads
+
+
+class DataObj:
+    """
+    Lightweight tree of a <dataObj>/<obj> payload: its vars and child objs in document order.
+    """
+
+    __slots__ = ("o", "t", "vars", "objs")
+
+    def __init__(self, o=None, t=None):
+        self.o = o
+        self.t = t
+        self.vars = []
+        self.objs = []
+
+    @property
+    def obj(self):
+        """
+        First child obj, mirrors objectify's `.obj` access.
+        :return:
+        """
+        if not self.objs:
+            raise AttributeError("no such child: obj")
+        return self.objs[0]
+
+    @property
+    def var(self):
+        """
+        First var, mirrors objectify's `.var` access.
+        :return:
+        """
+        if not self.vars:
+            raise AttributeError("no such child: var")
+        return self.vars[0]
+
+    def get_obj(self, name):
+        """
+        Returns the child obj with the given o attribute, or None.
+        :param name:
+        :return:
+        """
+        for obj in self.objs:
+            if obj.o == name:
+                return obj
+        return None
+
+
+def _build_data_obj(element) -> DataObj:
+    node = DataObj(element.get("o"), element.get("t"))
+    for child in element:
+        if child.tag == "var":
+            nested = None
+            if len(child):
+                nested = [
+                    Var(v.get("n"), v.get("t"), v.text) for v in child if v.tag == "var"
+                ]
+            node.vars.append(Var(child.get("n"), child.get("t"), child.text, nested))
+        elif child.tag == "obj":
+            node.objs.append(_build_data_obj(child))
+    return node
+
+
+def parse_data_obj(payload: bytes) -> DataObj:
+    """
+    Parses a dataObj payload in a single lxml pass, decoding it in Python only if lxml can't read it as UTF-8.
+    :param payload:
+    :return:
+    """
+    try:
+        return _build_data_obj(etree.fromstring(payload))
+    except etree.XMLSyntaxError:
+        pass
+    try:
+        return _build_data_obj(etree.fromstring(decode_message(payload)))
+    except etree.XMLSyntaxError:
+        # Charset detection guesses wrong on short payloads, latin-1 keeps every byte and the markup
+        return _build_data_obj(etree.fromstring(payload.decode("latin-1")))
+
+
+def _scan_attribute(frame: bytes, name: bytes, start: int, end: int):
+    for quote in (b"'", b'"'):
+        key = b" " + name + b"=" + quote
+        pos = frame.find(key, start, end)
+        if pos != -1:
+            pos += len(key)
+            close = frame.find(quote, pos, end)
+            if close != -1:
+                return frame[pos:close].decode("ascii", "replace")
+    return None
+
+
+class Envelope:
+    """
+    An inbound <msg><body action='' r=''> frame.
+    The action and room are scanned from the raw bytes; the CDATA payload is parsed once on demand,
+    and the full objectify tree is only built for handlers that read `body`.
+    """
+
+    __slots__ = ("raw", "action", "room", "_payload", "_data", "_xml")
+
+    def __init__(self, raw: bytes, action: str, room=None, xml=None):
+        self.raw = raw
+        self.action = action
+        self.room = room
+        self._payload = None
+        self._data = None
+        self._xml = xml
+
+    @property
+    def xml(self):
+        """
+        Full objectify tree of the frame, built on first use.
+        :return:
+        """
+        if self._xml is None:
+            self._xml = parse_xml(self.raw)
+            if self._xml is None:
+                raise MalformedFrame(self.action)
+        return self._xml
+
+    @property
+    def body(self):
+        return self.xml.body
+
+    @property
+    def payload_bytes(self) -> bytes:
+        """
+        Raw CDATA content of the body, i.e. the dataObj of asObj/asObjG/xtReq frames.
+        :return:
+        """
+        if self._payload is None:
+            body_open = self.raw.find(b"<body")
+            start = self.raw.find(b">", body_open) + 1
+            end = self.raw.rfind(CDATA_CLOSE)
+            if self.raw.startswith(CDATA_OPEN, start) and end != -1:
+                self._payload = self.raw[start + len(CDATA_OPEN) : end]
+            else:
+                self._payload = (self.body.text or "").encode("utf-8")
+        return self._payload
+
+    @property
+    def payload(self) -> str:
+        return decode_message(self.payload_bytes)
+
+    @property
+    def data(self) -> DataObj:
+        """
+        Parsed dataObj payload, shared by every handler that looks at this frame.
+        :return:
+        """
+        if self._data is None:
+            try:
+                self._data = parse_data_obj(self.payload_bytes)
+            except etree.XMLSyntaxError as e:
+                raise MalformedFrame(self.action) from e
+        return self._data
+
+    def __str__(self):
+        return self.raw.decode("utf-8", "replace")
+
+
+def scan_envelope(frame: bytes):
+    """
+    Reads the action and room of a frame without parsing it, falling back to a full parse for odd frames.
+    :param frame:
+    :return:
+    """
+    body_open = frame.find(b"<body")
+    if body_open != -1:
+        tag_end = frame.find(b">", body_open)
+        action = _scan_attribute(frame, b"action", body_open, tag_end)
+        if action is not None:
+            return Envelope(frame, action, _scan_attribute(frame, b"r", body_open, tag_end))
+    xml = parse_xml(frame)
+    if xml is None:
+        return None
+    try:
+        return Envelope(frame, xml.body.attrib["action"], xml.body.attrib.get("r"), xml)
+    except (AttributeError, KeyError) as e:
+        log.error(f"Frame without a body! ({e}) ({frame})")
+        return None
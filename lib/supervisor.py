@@ -0,0 +1,389 @@
+import errno
+import heapq
+import os
+import select
+import socket
+import subprocess
+from itertools import count
+from multiprocessing import Process, get_context
+from time import monotonic
+
+from loguru import logger as log
+
+from lib.config import get_config
+
+# Load Configuration
+config = get_config()
+
+# Exit codes the game servers use to talk to the supervisor
+RESTART = 42
+UPDATE = 43
+HANDED_OVER = 44
+
+POLICY_REQUEST = b"<policy-file-request/>\x00"
+POLICY_REPLY = b"<cross-domain-policy"
+
+
+class Supervisor:
+    """
+    Starts the apps in their own processes and keeps them running.
+    A single select() covers the process sentinels, the control pipe the game servers write to,
+    the health probe socket and the output of git pull, so an exit is handled as soon as it
+    happens and nothing polls. Crashed processes come back after an exponential backoff that resets
+    once a process has stayed up for `stable_s`. A game server reports "ready" once it serves
+    again, which gives the time to recover.
+    """
+
+    def __init__(self, apps: dict, colonies: dict):
+        """
+        :param apps: app name -> process target.
+        :param colonies: worker index -> app name of the game servers.
+        """
+        self.apps = apps
+        self.colonies = colonies
+        # Game servers start from a fresh interpreter, so a process started after an update runs the new code
+        self.spawn = get_context("spawn")
+        self.control, self.control_writer = self.spawn.Pipe(duplex=False)
+        self.processes = {}  # App name -> running process
+        self.pending = set()  # App names waiting for a backoff delay or an update before they restart
+        self.retiring = {}  # App name -> process handing its connections to the one in processes
+        self.started = {}  # App name -> start time of the running process
+        self.down_since = {}  # App name -> when it went down, until it is ready again
+        self.serving = set()  # Game servers that reported ready since they started
+        self.failures = {}  # App name -> crashes in a row
+        self.restarts = {}  # App name -> restarts after a crash
+        self.recoveries = []  # Seconds from crash to serving again
+        self.watched = {}  # Waitable -> callback once it is readable
+        self.writable = {}  # Waitable -> callback once it is writable
+        self.timers = []  # Heap of (when, sequence, callback)
+        self._sequence = count()
+        self.pull = None  # Running git pull
+        self.pull_output = b""
+        self.after_pull = []  # Callbacks waiting for the pull to finish
+        self.probe = None  # Socket of the running health probe
+        self.probe_request = b""  # Part of the request not sent yet
+        self.probe_reply = b""
+        self.probe_failures = 0
+
+        settings = config["supervisor"]
+        self.backoff_initial = float(settings["backoff_initial_s"])
+        self.backoff_max = float(settings["backoff_max_s"])
+        self.stable = float(settings["stable_s"])
+        self.probe_interval = float(settings["probe_interval_s"])
+        self.probe_timeout = float(settings["probe_timeout_s"])
+        self.probe_limit = int(settings["probe_failures"])
+        address = config["connection"]["address"]
+        self.probe_address = (
+            "127.0.0.1" if address in ("", "0.0.0.0") else address,
+            int(config["connection"]["port"]),
+        )
+        self.watched[self.control] = self.on_control
+
+    def run(self):
+        """
+        Starts every app and supervises them until all have completed.
+        :return:
+        """
+        for name in self.apps:
+            log.info(f"Starting : {name}")
+            self.start(name)
+        if self.probe_interval > 0:
+            self.schedule(self.probe_interval, self.start_probe)
+        while self.processes or self.pending:
+            timeout = None
+            if self.timers:
+                timeout = max(0.0, self.timers[0][0] - monotonic())
+            readable, writable, _ = select.select(
+                list(self.watched), list(self.writable), [], timeout
+            )
+            for ready in writable:
+                callback = self.writable.get(ready)
+                if callback is not None:
+                    callback()
+            for ready in readable:
+                callback = self.watched.get(ready)
+                if callback is not None:
+                    callback()
+            now = monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, callback = heapq.heappop(self.timers)
+                callback()
+        self.report()
+        log.info("All Processes are exited.")
+
+    def schedule(self, delay: float, callback):
+        heapq.heappush(self.timers, (monotonic() + delay, next(self._sequence), callback))
+
+    def start(self, name: str, resume=False):
+        """
+        Starts an app's process.
+        :param name:
+        :param resume: the new game server takes over the connections of the running one.
+        :return:
+        """
+        target = self.apps[name]
+        if name in self.colonies.values():
+            p = self.spawn.Process(
+                target=target,
+                kwargs={"control": self.control_writer, "resume": resume},
+            )
+        else:
+            p = Process(target=target)
+        p.start()
+        self.serving.discard(name)
+        self.processes[name] = p
+        self.started[name] = monotonic()
+        self.watched[p.sentinel] = lambda: self.on_exit(name, p)
+
+    def restart(self, name: str):
+        self.pending.discard(name)
+        self.start(name)
+
+    def on_exit(self, name: str, p):
+        """
+        Acts on the exit code of a process that ended.
+        :param name:
+        :param p:
+        :return:
+        """
+        del self.watched[p.sentinel]
+        p.join()
+        code = p.exitcode
+        if self.retiring.get(name) is p:
+            del self.retiring[name]
+            if code != HANDED_OVER:
+                log.error(f"{name} ended with {code} while handing over")
+            return
+        if self.processes.get(name) is not p:
+            return
+        old = self.retiring.pop(name, None)
+        if old is not None:
+            # The successor failed, the old process carries on once its handover times out,
+            # or exits with RESTART when the transfer had already started
+            log.error(f"Successor of {name} ended with {code}, keeping the running process")
+            self.processes[name] = old
+            self.down_since.pop(name, None)
+            return
+        del self.processes[name]
+        self.serving.discard(name)
+        if code == 0:
+            log.info(f"{name} Process Completed")
+            return
+        if name in self.colonies.values():
+            self.down_since.setdefault(name, monotonic())
+        if code == RESTART:
+            log.info("Process Restart Called: restarting!")
+            self.start(name)
+        elif code == UPDATE:
+            self.pending.add(name)
+            self.update(lambda: self.restart(name))
+        else:
+            self.crashed(name, code)
+
+    def crashed(self, name: str, code: int):
+        """
+        Restarts a crashed process, at once the first time and after a delay doubling with every
+        further crash in a row.
+        :param name:
+        :param code:
+        :return:
+        """
+        now = monotonic()
+        if now - self.started.get(name, now) >= self.stable:
+            self.failures[name] = 0
+        self.failures[name] = self.failures.get(name, 0) + 1
+        self.restarts[name] = self.restarts.get(name, 0) + 1
+        failures = self.failures[name]
+        delay = 0 if failures == 1 else min(self.backoff_initial * 2 ** (failures - 2), self.backoff_max)
+        log.error(
+            f"{name} ended with {code}, restarting in {delay:.1f}s "
+            f"(crash {self.failures[name]} in a row, {self.restarts[name]} restarts)"
+        )
+        self.pending.add(name)
+        self.schedule(delay, lambda: self.restart(name))
+
+    def on_control(self):
+        """
+        Handles a request from a game server.
+        :return:
+        """
+        request = self.control.recv()
+        kind = request.get("type")
+        if kind == "update":
+            self.update()
+        elif kind == "successor":
+            name = self.colonies[request["worker"]]
+            self.after_update(lambda: self.start_successor(name))
+        elif kind == "ready":
+            self.ready(self.colonies[request["worker"]])
+        else:
+            log.warning(f"Unknown request {request}")
+
+    def start_successor(self, name: str):
+        log.info(f"Starting a successor for {name}")
+        self.retiring[name] = self.processes[name]
+        self.down_since[name] = monotonic()
+        self.start(name, resume=True)
+
+    def ready(self, name: str):
+        """
+        A game server serves connections, ends the downtime started by a crash, restart or handover.
+        :param name:
+        :return:
+        """
+        self.serving.add(name)
+        since = self.down_since.pop(name, None)
+        if since is None:
+            return
+        seconds = monotonic() - since
+        self.recoveries.append(seconds)
+        log.info(f"{name} serving again after {seconds:.2f}s ({self.restarts.get(name, 0)} restarts)")
+
+    def update(self, then=None):
+        """
+        Runs git pull without blocking, callbacks registered meanwhile run once it is done.
+        :param then:
+        :return:
+        """
+        if then is not None:
+            self.after_pull.append(then)
+        if self.pull is not None:
+            return
+        log.info("Process Update Called: Updating!")
+        self.pull = subprocess.Popen(
+            ["git", "pull"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        self.pull_output = b""
+        self.watched[self.pull.stdout] = self.on_pull_output
+
+    def after_update(self, callback):
+        if self.pull is None:
+            callback()
+        else:
+            self.after_pull.append(callback)
+
+    def on_pull_output(self):
+        chunk = os.read(self.pull.stdout.fileno(), 65536)
+        if chunk:
+            self.pull_output += chunk
+            return
+        output = self.pull_output.decode(errors="replace")
+        del self.watched[self.pull.stdout]
+        self.pull.stdout.close()
+        code = self.pull.wait()
+        self.pull = None
+        if code != 0:
+            log.error(f"Update Failed! {output.strip()}")
+        elif "Already up to date" in output:
+            log.info(output.strip())
+        else:
+            log.info("Server Updated!")
+        callbacks, self.after_pull = self.after_pull, []
+        for callback in callbacks:
+            callback()
+
+    def start_probe(self):
+        """
+        Asks the game port for the policy file, the cheapest full round trip through a game server.
+        Probes are skipped while a game server is (re)starting.
+        :return:
+        """
+        self.schedule(self.probe_interval, self.start_probe)
+        if self.probe is not None or self.retiring:
+            return
+        if not self.serving.issuperset(self.colonies.values()):
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        code = sock.connect_ex(self.probe_address)
+        if code not in (0, errno.EINPROGRESS):
+            sock.close()
+            self.probe_failed(os.strerror(code))
+            return
+        self.probe = sock
+        self.probe_request = POLICY_REQUEST
+        self.probe_reply = b""
+        self.writable[sock] = self.on_probe_writable  # Once connected
+        probe = sock
+        self.schedule(self.probe_timeout, lambda: self.probe_expired(probe))
+
+    def on_probe_writable(self):
+        code = self.probe.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if code:
+            self.end_probe()
+            self.probe_failed(os.strerror(code))
+            return
+        try:
+            sent = self.probe.send(self.probe_request)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.end_probe()
+            self.probe_failed(str(e))
+            return
+        self.probe_request = self.probe_request[sent:]
+        if not self.probe_request:
+            del self.writable[self.probe]
+            self.watched[self.probe] = self.on_probe_data
+
+    def on_probe_data(self):
+        try:
+            data = self.probe.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.end_probe()
+            self.probe_failed(str(e))
+            return
+        self.probe_reply += data
+        if POLICY_REPLY in self.probe_reply:
+            self.end_probe()
+            self.probe_failures = 0
+        elif not data:
+            self.end_probe()
+            self.probe_failed("connection closed")
+
+    def probe_expired(self, probe):
+        if self.probe is probe:
+            self.end_probe()
+            self.probe_failed(f"no reply in {self.probe_timeout:.0f}s")
+
+    def end_probe(self):
+        self.writable.pop(self.probe, None)
+        self.watched.pop(self.probe, None)
+        self.probe.close()
+        self.probe = None
+
+    def probe_failed(self, reason: str):
+        """
+        Restarts the game servers once the port stopped answering several probes in a row.
+        With several workers a probe reaches whichever worker the kernel picks, so only a port
+        that fails every time counts as down.
+        :param reason:
+        :return:
+        """
+        self.probe_failures += 1
+        log.warning(f"Health probe failed ({reason}), {self.probe_failures} in a row")
+        if self.probe_failures < self.probe_limit:
+            return
+        self.probe_failures = 0
+        log.error("Game port unresponsive, restarting the game servers")
+        for name in self.colonies.values():
+            p = self.processes.get(name)
+            if p is not None and p.is_alive():
+                p.terminate()  # Its sentinel fires and the crash restarts it
+                self.schedule(self.probe_timeout, lambda p=p: p.is_alive() and p.kill())
+
+    def report(self):
+        """
+        Logs the restart counts and time to recover.
+        :return:
+        """
+        for name, restarts in self.restarts.items():
+            log.info(f"{name}: {restarts} restarts")
+        if self.recoveries:
+            recoveries = sorted(self.recoveries)
+            log.info(
+                f"Time to recover: mean {sum(recoveries) / len(recoveries):.2f}s, "
+                f"max {recoveries[-1]:.2f}s over {len(recoveries)} recoveries"
+            )
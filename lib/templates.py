@@ -0,0 +1,244 @@
+_ATTR_ESCAPES = str.maketrans(
+    {"&": "&amp;", "<": "&lt;", ">": "&gt;", "'": "&apos;", '"': "&quot;"}
+)
+_ATTR_SPECIAL = frozenset("&<>'\"")
+_TEXT_ESCAPES = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+MSG_CLOSE = "</body></msg>"
+DATA_OBJ_OPEN = "<dataObj><![CDATA[<dataObj>"
+DATA_OBJ_CLOSE = "</dataObj>]]></dataObj></body></msg>"
+POLICY = "<cross-domain-policy><allow-access-from domain='*' to-ports='{}' /></cross-domain-policy>"
+
+
+def escape_attr(value) -> str:
+    """
+    Escapes a value for use inside a quoted attribute.
+    Ids, counts and the usual short names need no escaping and are returned as they are.
+    :param value:
+    :return:
+    """
+    if type(value) is int:
+        return str(value)
+    text = str(value)
+    if _ATTR_SPECIAL.isdisjoint(text):
+        return text
+    return text.translate(_ATTR_ESCAPES)
+
+
+def escape_text(value) -> str:
+    """
+    Escapes element text, None becomes an empty string.
+    :param value:
+    :return:
+    """
+    if value is None:
+        return ""
+    return str(value).translate(_TEXT_ESCAPES)
+
+
+def cdata(value) -> str:
+    """
+    Wraps a value in a CDATA section, splitting any ']]>' it contains.
+    :param value:
+    :return:
+    """
+    text = "" if value is None else str(value)
+    if "]]>" in text:
+        text = text.replace("]]>", "]]]]><![CDATA[>")
+    return f"<![CDATA[{text}]]>"
+
+
+def policy(port) -> str:
+    return POLICY.format(port)
+
+
+def sys_msg(action: str, room=None, inner: str = "") -> str:
+    """
+    Builds a <msg t='sys'> envelope around the inner body.
+    :param action:
+    :param room: omitted from the body when None.
+    :param inner:
+    :return:
+    """
+    if room is None:
+        return f"<msg t='sys'><body action='{escape_attr(action)}'>{inner}{MSG_CLOSE}"
+    return (
+        f"<msg t='sys'><body action='{escape_attr(action)}' r='{escape_attr(room)}'>"
+        f"{inner}{MSG_CLOSE}"
+    )
+
+
+def var(n, t, value) -> str:
+    return f"<var n='{escape_attr(n)}' t='{escape_attr(t)}'>{escape_text(value)}</var>"
+
+
+def cdata_var(n, t, value) -> str:
+    return f"<var n='{escape_attr(n)}' t='{escape_attr(t)}'>{cdata(value)}</var>"
+
+
+def var_list(items) -> str:
+    """
+    Serializes parsed vars (anything with n, t and text) in order.
+    :param items:
+    :return:
+    """
+    return "".join([var(v.n, v.t, v.text) for v in items])
+
+
+def indexed_vars(values, t="s") -> str:
+    """
+    Serializes a sequence as vars named by their index.
+    :param values:
+    :param t:
+    :return:
+    """
+    return "".join([var(idx, t, value) for idx, value in enumerate(values)])
+
+
+def obj(o, t, inner: str) -> str:
+    return f"<obj t='{escape_attr(t)}' o='{escape_attr(o)}'>{inner}</obj>"
+
+
+def data_obj(room, user_id, inner: str) -> str:
+    """
+    Builds a dataObj message relayed from a user.
+    :param room:
+    :param user_id:
+    :param inner: content of the inner dataObj.
+    :return:
+    """
+    return (
+        f"<msg t='sys'><body action='dataObj' r='{escape_attr(room)}'>"
+        f"<user id='{escape_attr(user_id)}' />"
+        f"{DATA_OBJ_OPEN}{inner}{DATA_OBJ_CLOSE}"
+    )
+
+
+def xt(values) -> str:
+    """
+    Builds a %xt% string message.
+    :param values:
+    :return:
+    """
+    return "%xt%" + "".join([f"{value}%" for value in values])
+
+
+def join_failed(reason) -> str:
+    return sys_msg("joinKO", -1, f"<error msg='{escape_attr(reason)}' />")
+
+
+def user_gone(room, user_id) -> str:
+    return sys_msg("userGone", room, f"<user id='{escape_attr(user_id)}' />")
+
+
+def user_count(room, count) -> str:
+    return (
+        f"<msg t='sys'><body action='uCount' r='{escape_attr(room)}' u='{escape_attr(count)}'>"
+        f"{MSG_CLOSE}"
+    )
+
+
+def room_deleted(room_id) -> str:
+    return sys_msg("roomDel", None, f"<rm id='{escape_attr(room_id)}'/>")
+
+
+def public_message(room, user_id, text) -> str:
+    return sys_msg("pubMsg", room, f"<user id='{escape_attr(user_id)}' /><txt>{cdata(text)}</txt>")
+
+
+def private_message(room, user_id, text) -> str:
+    return sys_msg("prvMsg", room, f"<user id='{escape_attr(user_id)}' /><txt>{cdata(text)}</txt>")
+
+
+def admin_message(room, user_id, text) -> str:
+    return sys_msg("dmnMsg", room, f"<user id='{escape_attr(user_id)}' /><txt>{cdata(text)}</txt>")
+
+
+def buddy(name, online: bool, user_id=-1) -> str:
+    """
+    A <b> buddy entry, offline buddies always carry the id -1.
+    :param name:
+    :param online:
+    :param user_id:
+    :return:
+    """
+    if online:
+        return f"<b s='1' i='{escape_attr(user_id)}'><n>{cdata(name)}</n></b>"
+    return f"<b s='0' i='-1'><n>{cdata(name)}</n></b>"
+
+
+def buddy_update(name, online: bool, user_id=-1) -> str:
+    return sys_msg("bUpd", -1, buddy(name, online, user_id))
+
+
+def buddy_list(entries) -> str:
+    return sys_msg("bList", -1, f"<bList>{''.join(entries)}</bList>")
+
+
+def room_entry(room) -> str:
+    """
+    A <rm> entry of the room list.
+    :param room:
+    :return:
+    """
+    return (
+        f"<rm id='{escape_attr(room.id)}' priv='{escape_attr(room.priv)}'"
+        f" temp='{escape_attr(room.temp)}' game='{escape_attr(room.game)}'"
+        f" ucnt='{escape_attr(room.ucnt)}' maxu='{escape_attr(room.maxu)}' "
+        f"maxs='{escape_attr(room.maxs)}'><n>{cdata(room.name)}</n></rm>"
+    )
+
+
+def room_list(entries) -> str:
+    return sys_msg("rmList", 0, f"<rmList>{''.join(entries)}</rmList>")
+
+
+def room_user(user) -> str:
+    """
+    A <u> entry of the joinOK user list.
+    :param user:
+    :return:
+    """
+    return (
+        f"<u i='{escape_attr(user.id)}' m='{escape_attr(user.mod)}'>"
+        f"<n>{cdata(user.name)}</n><vars></vars></u>"
+    )
+
+
+def user_enter(room, user) -> str:
+    """
+    uER notification describing a user in a room.
+    :param room:
+    :param user:
+    :return:
+    """
+    return sys_msg(
+        "uER",
+        room,
+        f"<u i ='{escape_attr(user.id)}' m='{escape_attr(user.mod)}' s='0' p='2'>"
+        f"<n>{cdata(user.name)}</n><vars>"
+        f"{cdata_var('rank', 'n', user.rank)}{cdata_var('gamesPlayed', 'n', user.games_played)}"
+        f"</vars></u>",
+    )
+
+
+if __name__ == "__main__":
+    # Serialization throughput of the hottest relay messages.
+    from timeit import timeit
+    from types import SimpleNamespace
+
+    order = [SimpleNamespace(n=str(i), t="n", text=str(i * 7)) for i in range(8)]
+    loops = 100_000
+    cases = {
+        "orderUnit": lambda: data_obj(
+            6,
+            5,
+            f"{var('id', 's', 'orderUnit')}"
+            + obj("sub", "a", var("id", "n", 3) + obj("orderArray", "a", var_list(order))),
+        ),
+        "xtReq": lambda: xt([5, 6, "", 0, 2, "p1_154", 120, 340]),
+        "uCount": lambda: user_count(1, 12),
+    }
+    for name, case in cases.items():
+        seconds = timeit(case, number=loops)
+        print(f"{name}: {loops / seconds:,.0f} msg/s")
@@ -0,0 +1,169 @@
+import asyncio
+import sys
+import threading
+import traceback
+from collections import deque
+from contextlib import contextmanager
+from time import perf_counter, sleep
+
+from loguru import logger as log
+
+from lib import metrics
+
+LAG_WINDOW = 600  # Lag samples kept for the exported percentiles
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def sample_stack(thread_id, limit=None) -> str:
+    """
+    Formats the current stack of another thread, innermost call last.
+    :param thread_id:
+    :param limit:
+    :return:
+    """
+    frame = sys._current_frames().get(thread_id)
+    if frame is None:
+        return ""
+    return "".join(traceback.format_stack(frame, limit=limit))
+
+
+class Watchdog:
+    """
+    Measures how late the event loop runs a periodic tick and reports handlers that run too long.
+    A handler that is awaiting something is reported from the loop with its suspended stack;
+    a handler that blocks the loop is reported from a separate thread, which samples the loop thread's stack.
+    """
+
+    def __init__(self):
+        self.threshold = 0.1  # Seconds
+        self.interval = 0.05  # Seconds between loop ticks
+        self.lags = deque(maxlen=LAG_WINDOW)
+        self.inflight = {}  # Token -> [action, room, started, task, reported]
+        self.loop_thread = None
+        self._heartbeat = perf_counter()
+        self._task = None
+        self._thread = None
+        self._running = False
+
+    def start(self, threshold: float, interval: float):
+        """
+        Starts the loop tick and the watcher thread, must be called from the event loop.
+        :param threshold: seconds after which a handler or a stalled loop is reported.
+        :param interval: seconds between loop ticks.
+        :return:
+        """
+        self.threshold = threshold
+        self.interval = interval
+        self.loop_thread = threading.get_ident()
+        self._heartbeat = perf_counter()
+        self._running = True
+        self._task = asyncio.create_task(self._tick())
+        self._thread = threading.Thread(target=self._watch, name="watchdog", daemon=True)
+        self._thread.start()
+        log.info(f"Watchdog reporting handlers slower than {threshold * 1000:.0f}ms")
+
+    def stop(self):
+        self._running = False
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    @contextmanager
+    def handler(self, action, room):
+        """
+        Tracks a handler invocation, logging it once it finishes if it took longer than the threshold.
+        :param action:
+        :param room:
+        :return:
+        """
+        token = object()
+        started = perf_counter()
+        entry = [action, room, started, asyncio.current_task(), False]
+        self.inflight[token] = entry
+        try:
+            yield
+        finally:
+            del self.inflight[token]
+            elapsed = perf_counter() - started
+            if elapsed > self.threshold:
+                log.warning(f"Slow handler {action} (room {room}) took {elapsed * 1000:.1f}ms")
+
+    async def _tick(self):
+        while True:
+            expected = perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            now = perf_counter()
+            lag = max(0.0, now - expected)
+            self._heartbeat = now
+            self.lags.append(lag)
+            loop_lag.observe(lag)
+            for entry in list(self.inflight.values()):
+                action, room, started, task, reported = entry
+                if not reported and now - started > self.threshold:
+                    entry[4] = True
+                    stack = _task_stack(task)
+                    log.warning(
+                        f"Handler {action} (room {room}) running for {(now - started) * 1000:.0f}ms, "
+                        f"waiting at:\n{stack}"
+                    )
+
+    def _watch(self):
+        reported = None
+        while self._running:
+            sleep(self.interval)
+            heartbeat = self._heartbeat
+            stalled = perf_counter() - heartbeat
+            if stalled < self.threshold + self.interval or reported == heartbeat:
+                continue
+            reported = heartbeat
+            stack = sample_stack(self.loop_thread)
+            entries = list(self.inflight.values())
+            if entries:
+                current = f"in {entries[-1][0]} (room {entries[-1][1]})"
+            else:
+                current = "outside handlers"
+            log.warning(f"Event loop blocked for {stalled * 1000:.0f}ms {current}:\n{stack}")
+
+    def percentiles(self) -> dict:
+        """
+        Loop lag percentiles over the recent samples.
+        :return:
+        """
+        samples = sorted(self.lags)
+        if not samples:
+            return {}
+        return {
+            (str(q),): samples[min(int(len(samples) * q), len(samples) - 1)]
+            for q in (0.5, 0.9, 0.99, 1.0)
+        }
+
+
+def _task_stack(task) -> str:
+    """
+    Formats where a suspended task is waiting, following its chain of awaited coroutines.
+    :param task:
+    :return:
+    """
+    frames = []
+    awaited = task.get_coro() if task is not None else None
+    while awaited is not None:
+        frame = getattr(awaited, "cr_frame", None) or getattr(awaited, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append((frame, frame.f_lineno))
+        awaited = getattr(awaited, "cr_await", None) or getattr(awaited, "gi_yieldfrom", None)
+    return "".join(traceback.StackSummary.extract(frames).format())
+
+
+loop_lag = metrics.registry.histogram(
+    "loop_lag_seconds",
+    "Delay of the event loop tick behind its schedule.",
+    buckets=LAG_BUCKETS,
+)
+watchdog = Watchdog()
+metrics.registry.collected(
+    "loop_lag_recent_seconds",
+    "Event loop lag percentiles over the recent ticks.",
+    watchdog.percentiles,
+    labels=("quantile",),
+)
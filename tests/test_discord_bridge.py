@@ -0,0 +1,110 @@
+"""
+Lobby joins going from a game server through the socketpair to the bot's digests.
+"""
+import asyncio
+
+import lib.discord_bridge as bridge_module
+from lib import metrics
+from lib.discord_bridge import DiscordBridge, JoinFeed, channel, digest
+
+
+class FakeChannel:
+    """
+    Stands in for the Discord channel, failing the first `failures` sends.
+    """
+
+    def __init__(self, failures=0):
+        self.messages = []
+        self.failures = failures
+
+    async def send(self, text):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("Discord unreachable")
+        self.messages.append(text)
+
+
+def feed():
+    bot, game = channel()
+    joins = JoinFeed()
+    joins.attach(game)
+    return bot, joins
+
+
+async def settle(bridge):
+    while bridge._flush_task is not None:
+        await asyncio.sleep(0.01)
+
+
+def test_joins_within_the_window_share_one_digest():
+    async def scenario():
+        bot, joins = feed()
+        target = FakeChannel()
+        bridge = DiscordBridge(bot, window=0.05, min_interval=0)
+        bridge.start(target)
+        for name in ("alice", "bob", "carol"):
+            joins.publish(name)
+        await asyncio.sleep(0.01)
+        await settle(bridge)
+        joins.publish("dave")
+        await asyncio.sleep(0.01)
+        await settle(bridge)
+        return target.messages
+
+    assert asyncio.run(scenario()) == [
+        "alice, bob and carol have joined the lobby!",
+        "dave has joined the lobby!",
+    ]
+
+
+def test_joins_sent_while_the_bot_is_down_are_posted_on_start():
+    async def scenario():
+        bot, joins = feed()
+        joins.publish("alice")
+        joins.publish("bob")
+        target = FakeChannel()
+        bridge = DiscordBridge(bot, window=0.01, min_interval=0)
+        bridge.start(target)
+        await settle(bridge)
+        return target.messages
+
+    assert asyncio.run(scenario()) == ["alice and bob have joined the lobby!"]
+
+
+def test_publish_drops_joins_when_the_buffer_is_full():
+    bot, joins = feed()
+    before = metrics.discord_joins_dropped.values.get((), 0)
+    sent = 0
+    while metrics.discord_joins_dropped.values.get((), 0) == before:
+        joins.publish(f"player{sent}")  # Nobody reads, this must not block
+        sent += 1
+    assert sent > 1
+    # What made it into the buffer is still delivered
+    assert bot.recv(256) == b"player0"
+
+
+def test_failed_sends_are_retried_keeping_the_newest_names(monkeypatch):
+    monkeypatch.setattr(bridge_module, "RETRY_INITIAL", 0.01)
+
+    async def scenario():
+        bot, joins = feed()
+        target = FakeChannel(failures=2)
+        bridge = DiscordBridge(bot, window=0.01, min_interval=0, max_pending=3)
+        bridge.start(target)
+        for name in ("a", "b", "c", "d", "e"):
+            joins.publish(name)
+        await asyncio.sleep(0.01)
+        await settle(bridge)
+        return target.messages, bridge.dropped
+
+    messages, dropped = asyncio.run(scenario())
+    assert messages == ["c, d and e have joined the lobby!"]
+    assert dropped == 0  # Reported once the digest went out
+
+
+def test_digest_stops_at_the_message_limit():
+    names = [f"player{i:04}" for i in range(500)]
+    text, count = digest(names)
+    assert len(text) <= bridge_module.MAX_MESSAGE
+    assert 1 < count < len(names)
+    assert text.endswith(f"and {names[count - 1]} have joined the lobby!")
@@ -0,0 +1,175 @@
+"""
+Two workers sharing a port, each in its own process as the launcher runs them.
+"""
+import asyncio
+import multiprocessing
+import re
+import socket
+
+import pytest
+
+import lib.client as client
+
+WORKERS = 2
+CLIENTS = 12  # Enough connections for the kernel to spread them over both workers
+
+
+def login(name):
+    return (
+        "<msg t='sys'><body action='login' r='0'><login z='MLX'><nick><![CDATA["
+        f"{name}]]></nick><pword><![CDATA[]]></pword></login></body></msg>"
+    )
+
+
+def join(room_id, old=-1):
+    return (
+        f"<msg t='sys'><body action='joinRoom' r='{old}'><room id='{room_id}' pwd='' spec='0'"
+        f" leave='{int(old != -1)}' old='{old}' /></body></msg>"
+    )
+
+
+def public_message(room_id, text):
+    return f"<msg t='sys'><body action='pubMsg' r='{room_id}'><txt><![CDATA[{text}]]></txt></body></msg>"
+
+
+def run_worker(worker, port, directory, control):
+    settings = client.config
+    settings["connection"].update(address="127.0.0.1", port=str(port))
+    settings["workers"]["socket_dir"] = str(directory / "sockets")
+    settings["database"]["path"] = str(directory / "server.db")
+    settings["metrics"]["enabled"] = "false"
+    settings["watchdog"]["enabled"] = "false"
+    client.get_latest_version = lambda: int(settings["settings"]["version"])
+    client.start(worker, WORKERS, control=control)
+
+
+class Player:
+    def __init__(self, name):
+        self.name = name
+        self.id = None
+        self.frames = []
+
+    async def connect(self, port):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+        self.task = asyncio.create_task(self._read())
+        self.send(
+            "<msg t='sys'><body action='verChk' r='0'><ver v='175' /></body></msg>",
+            login(self.name),
+            join(1),
+        )
+        await self.wait_for(rb"logOK")
+        self.id = int(re.search(rb"logOK.*?id='(\d+)'", self.find(rb"logOK")).group(1))
+
+    async def _read(self):
+        buffer = b""
+        while data := await self.reader.read(65536):
+            *frames, buffer = (buffer + data).split(b"\0")
+            self.frames.extend(frames)
+
+    def send(self, *messages):
+        for message in messages:
+            self.writer.write(message.encode() + b"\0")
+
+    def find(self, pattern):
+        return next((frame for frame in self.frames if re.search(pattern, frame)), None)
+
+    async def wait_for(self, pattern, timeout=5.0):
+        async def found():
+            while self.find(pattern) is None:
+                await asyncio.sleep(0.02)
+            return self.find(pattern)
+
+        return await asyncio.wait_for(found(), timeout)
+
+
+@pytest.fixture
+def port(tmp_path):
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    context = multiprocessing.get_context("fork")
+    control, writer = context.Pipe(duplex=False)
+    processes = [
+        context.Process(target=run_worker, args=(worker, port, tmp_path, writer))
+        for worker in range(WORKERS)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        ready = set()
+        while len(ready) < WORKERS:
+            assert control.poll(15), "workers did not start"
+            ready.add(control.recv()["worker"])
+        yield port
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join(5)
+
+
+def test_lobby_lists_the_players_of_every_worker(port):
+    async def scenario():
+        players = [Player(f"player{i}") for i in range(CLIENTS)]
+        for player in players:
+            await player.connect(port)
+            await player.wait_for(rb"joinOK")
+        workers = {(player.id - 1) % WORKERS for player in players}
+        assert len(workers) == WORKERS, "all connections landed on one worker"
+
+        # The last one in gets everyone in its user list, the first one heard of everyone after it
+        first, last = players[0], players[-1]
+        user_list = last.find(rb"joinOK")
+        for player in players:
+            assert f"<u i='{player.id}'".encode() in user_list
+        for player in players[1:]:
+            await first.wait_for(rf"uER.*<u i ='{player.id}'".encode())
+
+        # Counts cover both workers, also after a player leaves
+        await first.wait_for(rf"uCount' r='1' u='{CLIENTS}'".encode())
+        last.writer.close()
+        await first.wait_for(rf"userGone' r='1'><user id='{last.id}'".encode())
+        await first.wait_for(rf"uCount' r='1' u='{CLIENTS - 1}'".encode())
+
+        for player in players[:-1]:
+            player.writer.close()
+
+    asyncio.run(scenario())
+
+
+def test_players_on_different_workers_share_lobby_messages_and_rooms(port):
+    async def scenario():
+        players = [Player(f"player{i}") for i in range(CLIENTS)]
+        for player in players:
+            await player.connect(port)
+        # Every worker hands out the ids it owns
+        by_worker = {}
+        for player in players:
+            by_worker.setdefault((player.id - 1) % WORKERS, []).append(player)
+        assert len(by_worker) == WORKERS, "all connections landed on one worker"
+        alice, bob = by_worker[0][0], by_worker[1][0]
+
+        bob.send(public_message(1, "hello from the other worker"))
+        await alice.wait_for(rb"hello from the other worker")
+
+        alice.send(
+            f"<msg t='sys'><body action='prvMsg' r='1'><txt rcp='{bob.id}'>"
+            "<![CDATA[psst]]></txt></body></msg>"
+        )
+        await bob.wait_for(rb"prvMsg.*psst")
+
+        alice.send(
+            "<msg t='sys'><body action='createRoom' r='1'><room tmp='1' gam='1' spec='0' exit='1'>"
+            "<name><![CDATA[duel]]></name><pwd><![CDATA[]]></pwd><max>2</max><vars></vars>"
+            "</room></body></msg>"
+        )
+        added = await bob.wait_for(rb"roomAdd.*duel")
+        room_id = int(re.search(rb"<rm id\s*=\s*'(\d+)'", added).group(1))
+        # Bob's connection moves to the worker owning the room
+        bob.send(join(room_id, old=1), public_message(room_id, "ready"))
+        await alice.wait_for(rb"uER.*" + bob.name.encode())
+        await alice.wait_for(rb"pubMsg.*ready")
+
+        for player in players:
+            player.writer.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,90 @@
+import argparse
+import random
+import sqlite3
+import tempfile
+from os.path import join
+from time import perf_counter
+
+from lib.database import UserDatabase
+
+BUDDIES_PER_USER = 20
+
+
+def populate(db, users):
+    """
+    Fills a fresh database with users, each with BUDDIES_PER_USER random buddies.
+
+    Args:
+        db: UserDatabase to fill.
+        users: Number of users to create.
+    """
+    db.conn.executemany(
+        "INSERT INTO users (id, username) VALUES (?, ?)",
+        ((i, f"user{i}") for i in range(1, users + 1)),
+    )
+    db.conn.executemany(
+        "INSERT OR IGNORE INTO buddies (user_id, buddy_id) VALUES (?, ?)",
+        (
+            (i, random.randint(1, users))
+            for i in range(1, users + 1)
+            for _ in range(BUDDIES_PER_USER)
+        ),
+    )
+    db.conn.commit()
+
+
+def drop_indexes(db):
+    """
+    Removes the buddy indexes to measure the schema before they were added.
+
+    Args:
+        db: UserDatabase to modify.
+    """
+    db.conn.execute("DROP INDEX IF EXISTS buddies_user_buddy")
+    db.conn.execute("DROP INDEX IF EXISTS buddies_buddy")
+    db.conn.commit()
+
+
+def time_lookups(db, users, lookups):
+    """
+    Times get_buddies for random users.
+
+    Args:
+        db: UserDatabase to query.
+        users: Number of users in the database.
+        lookups: Number of queries to run.
+
+    Returns:
+        Mean query time in milliseconds.
+    """
+    names = [f"user{random.randint(1, users)}" for _ in range(lookups)]
+    start = perf_counter()
+    for name in names:
+        db.get_buddies(name)
+    return (perf_counter() - start) / lookups * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Buddy list query time against the size of the buddies table. "
+        "Run from the repository root with python -m tools.buddy_benchmark"
+    )
+    parser.add_argument(
+        "--users", type=int, nargs="+", default=[1000, 10000, 50000, 100000]
+    )
+    parser.add_argument("--lookups", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'users':>8} {'buddy rows':>11} {'indexed ms':>11} {'unindexed ms':>13}")
+    with tempfile.TemporaryDirectory() as directory:
+        for count in args.users:
+            db = UserDatabase(join(directory, f"bench_{count}.db"))
+            populate(db, count)
+            rows = db.conn.execute("SELECT COUNT(*) FROM buddies").fetchone()[0]
+            indexed = time_lookups(db, count, args.lookups)
+            drop_indexes(db)
+            # Fewer lookups, each one scans the whole table
+            unindexed = time_lookups(db, count, max(args.lookups // 10, 1))
+            db.close()
+            print(f"{count:>8} {rows:>11} {indexed:>11.3f} {unindexed:>13.3f}")
+    print(f"SQLite {sqlite3.sqlite_version}")
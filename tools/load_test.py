@@ -0,0 +1,351 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from os.path import join
+
+POLICY_REQUEST = "<policy-file-request/>"
+LOBBY_ID = 1
+ACTION = re.compile(rb"action='(\w+)'(?: r='(-?\d+)')?")
+STAMP = re.compile(rb"[%>]L(\d+)[%<]")  # Send time embedded in relayed game traffic
+
+
+def ver_chk(version):
+    return f"<msg t='sys'><body action='verChk' r='0'><ver v='{version}' /></body></msg>"
+
+
+def login(name):
+    return (
+        f"<msg t='sys'><body action='login' r='0'><login z='MLX'><nick><![CDATA[{name}]]></nick>"
+        f"<pword><![CDATA[]]></pword></login></body></msg>"
+    )
+
+
+def get_room_list():
+    return "<msg t='sys'><body action='getRmList' r='-1'></body></msg>"
+
+
+def join_room(room_id, old=-1):
+    return (
+        f"<msg t='sys'><body action='joinRoom' r='{max(old, 1)}'><room id='{room_id}' pwd='' "
+        f"spec='0' leave='{int(old != -1)}' old='{old}' /></body></msg>"
+    )
+
+
+def create_room(name):
+    return (
+        f"<msg t='sys'><body action='createRoom' r='{LOBBY_ID}'><room tmp='1' gam='1' spec='0' exit='1'>"
+        f"<name><![CDATA[{name}]]></name><pwd><![CDATA[]]></pwd><max>4</max><vars></vars></room></body></msg>"
+    )
+
+
+def missile(room_id, pos):
+    """
+    xtReq missile order, the send time travels in the relayed 'option' field.
+    """
+    return (
+        f"<msg t='xt'><body action='xtReq' r='{room_id}'><![CDATA[<dataObj>"
+        f"<var n='name' t='s'>colony</var><var n='cmd' t='s'>m</var><obj t='o' o='param'>"
+        f"<var n='option' t='s'>L{time.perf_counter_ns()}</var><var n='pos' t='n'>{pos}</var>"
+        f"<var n='cmd' t='n'>2</var><obj t='o' o='x'><var n='tar' t='s'>p1_{pos}</var>"
+        f"<var n='px' t='n'>{random.randint(0, 800)}</var><var n='py' t='n'>{random.randint(0, 600)}</var>"
+        f"</obj></obj></dataObj>]]></body></msg>"
+    )
+
+
+def kill_unit(room_id, user_id):
+    """
+    asObjG killUnit, the send time travels in the relayed unit id.
+    """
+    return (
+        f"<msg t='sys'><body action='asObjG' r='{room_id}'><![CDATA[<dataObj>"
+        f"<var n='_$$_' t='s'>{user_id}</var><var n='id' t='s'>killUnit</var><obj t='o' o='sub'>"
+        f"<var n='p' t='n'>0</var><var n='ran' t='n'>0</var><var n='id' t='s'>L{time.perf_counter_ns()}</var>"
+        f"</obj></dataObj>]]></body></msg>"
+    )
+
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.latencies = []  # Nanoseconds from send to delivery, per delivered game frame
+        self.recording = False
+
+
+class SimulatedClient:
+    """
+    A Flash client: runs the login handshake, joins a room and plays.
+    """
+
+    def __init__(self, index, stats):
+        self.index = index
+        self.name = f"bench{index}"
+        self.stats = stats
+        self.user_id = 0
+        self.room = -1
+        self.reader = None
+        self.writer = None
+        self._waiters = {}  # Action -> future resolved with the room id of the next such frame
+        self._task = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self._task = asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self):
+        buffer = b""
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            *frames, buffer = (buffer + data).split(b"\x00")
+            now = time.perf_counter_ns()
+            for frame in frames:
+                self._on_frame(frame, now)
+
+    def _on_frame(self, frame, now):
+        stats = self.stats
+        if stats.recording:
+            stats.received += 1
+            stamp = STAMP.search(frame)
+            if stamp is not None:
+                stats.latencies.append(now - int(stamp.group(1)))
+            return
+        match = ACTION.search(frame)
+        if match is None:
+            return
+        action = match.group(1).decode()
+        if action == "logOK":
+            self.user_id = int(re.search(rb"id='(\d+)'", frame).group(1))
+        waiter = self._waiters.pop(action, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(int(match.group(2) or 0))
+
+    def send(self, message):
+        self.writer.write(message.encode() + b"\x00")
+
+    async def expect(self, action, timeout=10):
+        """
+        Waits for the next frame with the given action and returns its room id.
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[action] = waiter
+        return await asyncio.wait_for(waiter, timeout)
+
+    async def handshake(self, version):
+        joined = self.expect("joinOK")
+        self.send(POLICY_REQUEST)
+        self.send(ver_chk(version))
+        self.send(login(self.name))
+        self.send(get_room_list())
+        self.send(join_room(LOBBY_ID))
+        self.room = await joined
+
+    async def host_room(self):
+        joined = self.expect("joinOK")
+        self.send(create_room(f"bench room {self.index}"))
+        self.room = await joined
+        return self.room
+
+    async def enter_room(self, room_id):
+        joined = self.expect("joinOK")
+        self.send(join_room(room_id, self.room))
+        self.room = await joined
+
+    async def play(self, rate, duration, kill_ratio):
+        """
+        Sends game traffic at `rate` messages per second for `duration` seconds.
+        """
+        interval = 1 / rate
+        deadline = time.monotonic() + duration
+        await asyncio.sleep(random.random() * interval)  # Spread clients over the interval
+        while time.monotonic() < deadline:
+            if random.random() < kill_ratio:
+                self.send(kill_unit(self.room, self.user_id))
+            else:
+                self.send(missile(self.room, self.index % 4))
+            self.stats.sent += 1
+            await asyncio.sleep(interval)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self._task is not None:
+            self._task.cancel()
+
+
+def run_server(ready, db_path, log_level):
+    """
+    Starts lib.client.Server on a free localhost port in this process.
+    """
+    from loguru import logger as log
+
+    import lib.client as client
+    from lib.framing import FrameProtocol
+
+    log.remove()
+    log.add(sys.stderr, level=log_level)
+    client.config["database"]["path"] = db_path
+    client.config["metrics"]["port"] = "0"  # Any free port, the address is logged
+
+    async def serve():
+        server_obj = client.Server()
+        await server_obj.start()
+        server = await asyncio.get_running_loop().create_server(
+            lambda: FrameProtocol(server_obj.handle), "127.0.0.1", 0
+        )
+        ready.put((server.sockets[0].getsockname()[1], server_obj.version))
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def process_usage(pid):
+    """
+    CPU seconds and resident memory in bytes of a process, read from /proc.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+        return cpu, rss
+    except (OSError, StopIteration):
+        return None, None
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def run_benchmark(args, host, port, version, server_pid):
+    stats = Stats()
+    clients = [SimulatedClient(i, stats) for i in range(args.clients)]
+    _, rss_before = process_usage(server_pid) if server_pid else (None, None)
+
+    # Connect and log in, a batch at a time so the accept queue does not overflow
+    for start in range(0, len(clients), args.connect_batch):
+        batch = clients[start : start + args.connect_batch]
+        await asyncio.gather(*[c.connect(host, port) for c in batch])
+        await asyncio.gather(*[c.handshake(version) for c in batch])
+
+    # Fill rooms: the first client of each group creates it, the rest join
+    for start in range(0, len(clients), args.room_size):
+        group = clients[start : start + args.room_size]
+        room_id = await group[0].host_room()
+        await asyncio.gather(*[c.enter_room(room_id) for c in group[1:]])
+    rooms = (len(clients) + args.room_size - 1) // args.room_size
+    print(f"{len(clients)} clients logged in, {rooms} rooms", file=sys.stderr)
+
+    await asyncio.sleep(0.5)  # Let setup notifications drain
+    cpu_before, rss_after = process_usage(server_pid) if server_pid else (None, None)
+    stats.recording = True
+    started = time.monotonic()
+    await asyncio.gather(
+        *[c.play(args.rate, args.duration, args.kill_ratio) for c in clients]
+    )
+    await asyncio.sleep(args.drain)
+    elapsed = time.monotonic() - started
+    cpu_after, _ = process_usage(server_pid) if server_pid else (None, None)
+    stats.recording = False
+    for c in clients:
+        c.close()
+
+    latencies = sorted(stats.latencies)
+    result = {
+        "clients": len(clients),
+        "rooms": rooms,
+        "duration": round(elapsed, 2),
+        "sent_per_sec": round(stats.sent / elapsed, 1),
+        "delivered_per_sec": round(stats.received / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.5) / 1e6, 3),
+        "p99_ms": round(percentile(latencies, 0.99) / 1e6, 3),
+        "max_ms": round(latencies[-1] / 1e6 if latencies else 0.0, 3),
+    }
+    if cpu_before is not None and cpu_after is not None:
+        cpu_percent = (cpu_after - cpu_before) / elapsed * 100
+        result["server_cpu_percent"] = round(cpu_percent, 1)
+        result["cpu_percent_per_client"] = round(cpu_percent / len(clients), 4)
+    if rss_before is not None and rss_after is not None:
+        result["server_rss_mb"] = round(rss_after / 2**20, 1)
+        result["kb_per_client"] = round((rss_after - rss_before) / 1024 / len(clients), 1)
+    return result
+
+
+def print_report(result, baseline=None):
+    for key, value in result.items():
+        line = f"{key:>24}: {value}"
+        if baseline is not None and isinstance(baseline.get(key), (int, float)) and baseline[key]:
+            change = (value - baseline[key]) / baseline[key] * 100
+            line += f"  ({change:+.1f}% vs baseline {baseline[key]})"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulates Flash clients against a local server and reports throughput, "
+        "relay latency and server CPU/memory. Run from the repository root with "
+        "python -m tools.load_test"
+    )
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--room-size", type=int, default=4, help="players per game room")
+    parser.add_argument("--rate", type=float, default=10, help="game messages per second per client")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of game traffic")
+    parser.add_argument("--kill-ratio", type=float, default=0.2, help="share of asObjG killUnit messages")
+    parser.add_argument("--drain", type=float, default=1, help="seconds to wait for in-flight relays")
+    parser.add_argument("--connect-batch", type=int, default=50)
+    parser.add_argument(
+        "--connect", metavar="HOST:PORT:VERSION", help="use a running server instead of starting one"
+    )
+    parser.add_argument("--server-log-level", default="WARNING")
+    parser.add_argument("--json", metavar="PATH", help="write the results to a file")
+    parser.add_argument("--baseline", metavar="PATH", help="compare with results written by --json")
+    args = parser.parse_args()
+
+    server = None
+    server_pid = None
+    with tempfile.TemporaryDirectory() as directory:
+        if args.connect:
+            host, port, version = args.connect.split(":")
+            port = int(port)
+        else:
+            host = "127.0.0.1"
+            ready = multiprocessing.Queue()
+            server = multiprocessing.Process(
+                target=run_server,
+                args=(ready, join(directory, "bench.db"), args.server_log_level),
+                daemon=True,
+            )
+            server.start()
+            server_pid = server.pid
+            port, version = ready.get(timeout=60)
+        try:
+            result = asyncio.run(run_benchmark(args, host, port, version, server_pid))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.join()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+import argparse
+import asyncio
+import difflib
+import multiprocessing
+import re
+import sys
+import tempfile
+import time
+from collections import Counter
+from os import listdir
+from os.path import isdir, join
+
+from scapy.layers.inet import IP, TCP
+from scapy.packet import Raw
+from scapy.utils import rdpcap
+
+from tools.load_test import process_usage, run_server
+
+ACTION = re.compile(rb"action='(\w+)'")
+JOIN_OK = re.compile(rb"action='joinOK' r='(\d+)'")
+ROOM_ATTRIBUTE = re.compile(rb"( r='|<room id=')(\d+)'")
+NICK = re.compile(rb"(<nick><!\[CDATA\[)([^\]]+)(\]\]>)")
+VERSION = re.compile(rb"(<ver v=')(\d+)(')")
+NUMBER = re.compile(rb"\d+")
+
+
+class Session:
+    """
+    One recorded client connection: the frames it sent and the frames the server answered,
+    each with its offset in seconds from the first packet of the connection.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.sent = []  # (offset, frame) client -> server
+        self.received = []  # (offset, frame) server -> client
+
+    @property
+    def duration(self):
+        return self.sent[-1][0] if self.sent else 0.0
+
+
+def split_frames(chunks):
+    """
+    Reassembles timed TCP payloads into NUL delimited frames, stamped with the time their last byte arrived.
+
+    Args:
+        chunks: (time, payload) tuples in arrival order.
+
+    Returns:
+        List of (time, frame) tuples.
+    """
+    frames = []
+    buffer = b""
+    for stamp, payload in chunks:
+        *complete, buffer = (buffer + payload).split(b"\x00")
+        frames.extend((stamp, frame) for frame in complete if frame)
+    return frames
+
+
+def extract_sessions(path, port=25565):
+    """
+    Extracts every client connection to the server port from a capture.
+
+    Args:
+        path: The path to the pcap/pcapng file.
+        port: The server port.
+
+    Returns:
+        List of Session objects ordered by connection start.
+    """
+    streams = {}  # (client ip, client port) -> {"up": {seq: (time, payload)}, "down": {...}}
+    for packet in rdpcap(path):
+        if not (packet.haslayer(TCP) and packet.haslayer(Raw) and packet.haslayer(IP)):
+            continue
+        tcp = packet[TCP]
+        if tcp.dport == port:
+            key, direction = (packet[IP].src, tcp.sport), "up"
+        elif tcp.sport == port:
+            key, direction = (packet[IP].dst, tcp.dport), "down"
+        else:
+            continue
+        stream = streams.setdefault(key, {"up": {}, "down": {}})
+        # Keyed by sequence number so retransmissions are only counted once
+        stream[direction].setdefault(tcp.seq, (float(packet.time), bytes(packet[Raw].load)))
+
+    sessions = []
+    for (address, client_port), stream in streams.items():
+        up = [stream["up"][seq] for seq in sorted(stream["up"])]
+        down = [stream["down"][seq] for seq in sorted(stream["down"])]
+        if not up:
+            continue
+        start = min(chunk[0] for chunk in up + down)
+        session = Session(f"{path}:{address}:{client_port}")
+        session.sent = [(t - start, f) for t, f in split_frames(up)]
+        session.received = [(t - start, f) for t, f in split_frames(down)]
+        session.start = start
+        sessions.append(session)
+    sessions.sort(key=lambda s: s.start)
+    for session in sessions:
+        # Sessions start relative to the first connection of the capture
+        session.offset = session.start - sessions[0].start
+    return sessions
+
+
+class RoomMap:
+    """
+    Maps recorded room ids to the ids the replayed server assigned, shared by all sessions of one copy.
+    Recorded joinOK frames are lined up with the live ones to learn the mapping.
+    """
+
+    def __init__(self):
+        self.ids = {b"1": b"1", b"42": b"42", b"0": b"0"}
+
+    def learn(self, recorded, live):
+        if recorded is not None and live is not None:
+            self.ids[recorded] = live
+
+    def rewrite(self, frame):
+        return ROOM_ATTRIBUTE.sub(
+            lambda m: m.group(1) + self.ids.get(m.group(2), m.group(2)) + b"'", frame
+        )
+
+
+class Replayer:
+    def __init__(self, session, copy, room_map, args, version):
+        self.session = session
+        self.copy = copy
+        self.room_map = room_map
+        self.args = args
+        self.version = str(version).encode()
+        self.responses = []  # Frames received from the live server
+        self.recorded_joins = [
+            m.group(1) for _, f in session.received if (m := JOIN_OK.search(f))
+        ]
+        self.live_joins = 0
+        self.sent = 0
+
+    def _rewrite(self, frame):
+        frame = VERSION.sub(lambda m: m.group(1) + self.version + m.group(3), frame)
+        if self.copy:
+            frame = NICK.sub(
+                lambda m: m.group(1) + m.group(2) + f"_{self.copy}".encode() + m.group(3), frame
+            )
+        return self.room_map.rewrite(frame)
+
+    def _on_frame(self, frame):
+        self.responses.append(frame)
+        live = JOIN_OK.search(frame)
+        if live is not None:
+            if self.live_joins < len(self.recorded_joins):
+                self.room_map.learn(self.recorded_joins[self.live_joins], live.group(1))
+            self.live_joins += 1
+
+    async def _read(self, reader):
+        buffer = b""
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            *frames, buffer = (buffer + data).split(b"\x00")
+            for frame in frames:
+                if frame:
+                    self._on_frame(frame)
+
+    async def run(self, started):
+        speed = self.args.speed
+        if speed:
+            await asyncio.sleep(max(0.0, started + self.session.offset / speed - time.monotonic()))
+        reader, writer = await asyncio.open_connection(self.args.host, self.args.port)
+        reading = asyncio.create_task(self._read(reader))
+        connected = time.monotonic()
+        for offset, frame in self.session.sent:
+            if speed:
+                delay = connected + offset / speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                await asyncio.sleep(0)  # Keep ordering against the other sessions' sends
+            writer.write(self._rewrite(frame) + b"\x00")
+            self.sent += 1
+            await writer.drain()
+        await asyncio.sleep(self.args.linger)
+        writer.close()
+        reading.cancel()
+
+    def diff(self, full=False):
+        """
+        Compares the live responses with the recorded ones, by action or by frame with numbers masked.
+
+        Returns:
+            List of unified diff lines, empty when they match.
+        """
+        if full:
+            recorded = [NUMBER.sub(b"#", f).decode(errors="replace") for _, f in self.session.received]
+            live = [NUMBER.sub(b"#", f).decode(errors="replace") for f in self.responses]
+        else:
+            recorded = [action(f) for _, f in self.session.received]
+            live = [action(f) for f in self.responses]
+        return list(
+            difflib.unified_diff(recorded, live, "recorded", "replayed", lineterm="", n=1)
+        )
+
+
+def action(frame):
+    match = ACTION.search(frame)
+    return match.group(1).decode() if match else frame[:24].decode(errors="replace")
+
+
+def load_sessions(paths, port):
+    sessions = []
+    for path in paths:
+        if isdir(path):
+            files = [join(path, f) for f in sorted(listdir(path)) if "pcap" in f]
+        else:
+            files = [path]
+        for file in files:
+            sessions.extend(extract_sessions(file, port))
+    return sessions
+
+
+async def replay(sessions, args, version):
+    replayers = []
+    for copy in range(args.multiply):
+        room_map = RoomMap()
+        replayers.extend(Replayer(session, copy, room_map, args, version) for session in sessions)
+
+    started = time.monotonic()
+    results = await asyncio.gather(
+        *[r.run(started) for r in replayers], return_exceptions=True
+    )
+    elapsed = time.monotonic() - started - args.linger
+    for replayer, result in zip(replayers, results):
+        if isinstance(result, Exception):
+            print(f"{replayer.session.name} (copy {replayer.copy}) failed: {result!r}")
+    return replayers, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replays the client side of captured sessions against a server and diffs the "
+        "responses with the recorded ones. Run from the repository root with python -m tools.replay"
+    )
+    parser.add_argument("captures", nargs="*", default=["snaps"], help="pcap files or directories")
+    parser.add_argument("--port", type=int, default=25565, help="server port in the captures")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="time compression, 1 keeps the recorded timing, 0 sends as fast as possible",
+    )
+    parser.add_argument("--multiply", type=int, default=1, help="concurrent copies of every session")
+    parser.add_argument("--linger", type=float, default=1.0, help="seconds to wait for responses")
+    parser.add_argument("--diff", choices=["none", "actions", "frames"], default="actions")
+    parser.add_argument("--connect", metavar="HOST:PORT:VERSION", help="use a running server")
+    parser.add_argument("--server-log-level", default="WARNING")
+    args = parser.parse_args()
+
+    sessions = load_sessions(args.captures, args.port)
+    if not sessions:
+        print("No sessions found")
+        return
+    recorded = sum(len(s.sent) for s in sessions)
+    print(f"{len(sessions)} sessions, {recorded} client frames, x{args.multiply}")
+
+    server = None
+    with tempfile.TemporaryDirectory() as directory:
+        if args.connect:
+            args.host, port, version = args.connect.split(":")
+            args.port = int(port)
+        else:
+            args.host = "127.0.0.1"
+            ready = multiprocessing.Queue()
+            server = multiprocessing.Process(
+                target=run_server,
+                args=(ready, join(directory, "replay.db"), args.server_log_level),
+                daemon=True,
+            )
+            server.start()
+            args.port, version = ready.get(timeout=60)
+        cpu_before, _ = process_usage(server.pid) if server else (None, None)
+        try:
+            replayers, elapsed = asyncio.run(replay(sessions, args, version))
+            cpu_after, rss = process_usage(server.pid) if server else (None, None)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.join()
+
+    sent = sum(r.sent for r in replayers)
+    received = sum(len(r.responses) for r in replayers)
+    print(f"Replayed {sent} frames in {elapsed:.2f}s ({sent / elapsed:,.0f} frames/s)")
+    print(f"Received {received} frames ({received / elapsed:,.0f} frames/s)")
+    if cpu_before is not None and cpu_after is not None:
+        print(f"Server CPU {(cpu_after - cpu_before) / elapsed * 100:.1f}%, RSS {rss / 2**20:.1f}MB")
+
+    if args.diff == "none":
+        return
+    mismatched = 0
+    for replayer in replayers:
+        lines = replayer.diff(full=args.diff == "frames")
+        if lines:
+            mismatched += 1
+            print(f"--- {replayer.session.name} (copy {replayer.copy})")
+            print("\n".join(lines))
+    totals = Counter(action(f) for r in replayers for f in r.responses)
+    print(f"{mismatched}/{len(replayers)} sessions differ from the recording")
+    print("Responses by action: " + ", ".join(f"{a}={n}" for a, n in totals.most_common()))
+    sys.exit(1 if mismatched else 0)
+
+
+if __name__ == "__main__":
+    main()